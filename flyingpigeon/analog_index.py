@@ -0,0 +1,268 @@
+"""
+Analog index
+------------
+
+Spatial analog calculations compare a target sample to the candidate samples of every cell of a grid. Reading these
+samples from netCDF through ocgis usually takes longer than the comparison itself, and the same candidate datasets are
+queried over and over. An :class:`AnalogIndex` stores the candidate samples of a dataset and time range in a set of
+`.npy` files that are memory-mapped when loaded, along with the per-cell moments and the grid description needed to
+write the results.
+
+Indices are stored in the server cache directory, under a key built from the candidate files, the climate indices and
+the time range. Candidate files are identified by their real path, modification time and size, so that the files
+linked by pywps from `file://` inputs share the index of their target. Modifying a file changes the key, so a stale
+index is never used. The least recently used indices are removed when the cache exceeds its size or age limit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from ocgis import RequestDataset
+
+from flyingpigeon import dissimilarity as dd
+from flyingpigeon.ocgisDissimilarity import get_coordinates, get_cube
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+# Increment when the layout of the files changes.
+VERSION = 1
+
+
+class AnalogIndex(object):
+    """Candidate samples of a grid, ready for spatial analog calculations.
+
+    Parameters
+    ----------
+    samples : ndarray (c,m,d)
+      Candidate samples for each of the `c` grid cells, with NaNs for invalid values.
+    lon, lat : ndarray (c,)
+      Coordinates of each cell.
+    coords : dict
+      Grid coordinate variables, keyed by name, as (dimensions, units, values) tuples.
+    dims : sequence
+      Names of the grid dimensions.
+    shape : sequence
+      Size of the grid dimensions.
+    time : ndarray (m,), optional
+      Numeric time values of the samples.
+    time_units, calendar : str, optional
+      Units and calendar of the time values.
+    """
+    _arrays = ['samples', 'count', 'mean', 'var', 'lon', 'lat']
+
+    def __init__(self, samples, lon, lat, coords, dims, shape, time=None, time_units=None, calendar=None,
+                 count=None, mean=None, var=None):
+        self.samples = samples
+        self.lon = lon
+        self.lat = lat
+        self.coords = coords
+        self.dims = list(dims)
+        self.shape = list(shape)
+        self.time = time
+        self.time_units = time_units
+        self.calendar = calendar
+
+        if count is None:
+            valid = ~np.isnan(samples).any(-1)
+            count = valid.sum(1)
+            data = np.where(valid[..., np.newaxis], samples, 0.)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = data.sum(1, dtype=np.float64) / count[:, np.newaxis]
+                dev = np.where(valid[..., np.newaxis], samples - mean[:, np.newaxis], 0.)
+                var = (dev ** 2).sum(1) / (count[:, np.newaxis] - 1)
+        self.count = count
+        self.mean = mean
+        self.var = var
+
+    @classmethod
+    def from_field(cls, field, indices):
+        """Read the candidate samples of the given indices from an ocgis Field."""
+        variable = field[indices[0]]
+        time_axis = variable.dimension_names.index(field.time.dimensions[0].name)
+        dims = [dim for i, dim in enumerate(variable.dimension_names) if i != time_axis]
+        shape = [n for i, n in enumerate(variable.shape) if i != time_axis]
+
+        # Keep single precision values, other types are converted to double precision.
+        samples = np.ma.masked_invalid(get_cube(field, indices, time_axis))
+        if samples.dtype != np.float32:
+            samples = samples.astype(np.float64)
+        samples = np.ma.filled(samples, np.nan)
+        lon, lat = get_coordinates(field)
+        coords = {}
+        for coord in [field.grid.x, field.grid.y]:
+            coords[coord.name] = (list(coord.dimension_names), coord.units, coord.get_value())
+        time = field.time
+        return cls(samples, lon, lat, coords, dims, shape, time.get_value(), time.units, time.calendar)
+
+    def save(self, path):
+        """Write the index to the `path` directory.
+
+        The files are first written to a temporary directory and then moved in place, so that concurrent
+        requests never read a partial index.
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        tmp = tempfile.mkdtemp(dir=parent)
+        for name in self._arrays:
+            np.save(os.path.join(tmp, name + '.npy'), getattr(self, name))
+
+        meta = {'version': VERSION, 'dims': self.dims, 'shape': [int(n) for n in self.shape], 'coords': {},
+                'time_units': self.time_units, 'calendar': self.calendar}
+        if self.time is not None:
+            np.save(os.path.join(tmp, 'time.npy'), self.time)
+        for i, (name, (dims, units, value)) in enumerate(self.coords.items()):
+            np.save(os.path.join(tmp, 'coord{}.npy'.format(i)), value)
+            meta['coords'][name] = {'dims': dims, 'units': units, 'file': 'coord{}.npy'.format(i)}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another request wrote the same index in the meantime.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by :meth:`save`, memory-mapping the samples."""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != VERSION:
+            raise ValueError("Analog index version {} is not supported.".format(meta['version']))
+
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in cls._arrays}
+        coords = {}
+        for name, c in meta['coords'].items():
+            coords[name] = (c['dims'], c['units'], np.load(os.path.join(path, c['file'])))
+        time_path = os.path.join(path, 'time.npy')
+        time = np.load(time_path) if os.path.exists(time_path) else None
+        return cls(coords=coords, dims=meta['dims'], shape=meta['shape'], time=time, time_units=meta['time_units'],
+                   calendar=meta['calendar'], **arrays)
+
+    def seuclidean(self, x, min_samples=5):
+        """Standardized Euclidean distance of every cell, computed from the stored moments.
+
+        Parameters
+        ----------
+        x : ndarray (n,d) or Target
+          Reference sample.
+        min_samples : int
+          Minimum number of valid values in a candidate sample. Cells with fewer values are set to NaN.
+        """
+        x = dd.prepare(x)
+        out = np.sqrt(((self.mean - x.mean) ** 2 / x.var).sum(-1))
+        out[self.count < min_samples] = np.nan
+        return out
+
+    def screen(self, x, fraction=None, threshold=None, min_samples=5):
+        """Select the cells worth comparing with an expensive metric, without reading the samples.
+
+        See :func:`flyingpigeon.dissimilarity.screen`.
+        """
+        return dd.select_cells(self.seuclidean(x, min_samples), fraction, threshold)
+
+
+def index_key(resources, indices, time_range=None):
+    """Return the key identifying the index of the given candidate files, indices and time range."""
+    files = sorted(json.dumps(file_key(path)) for path in resources)
+    desc = json.dumps([VERSION, files, list(indices), [str(t) for t in (time_range or [])]])
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+def file_key(path):
+    """Return the description of a candidate file used in the index key.
+
+    pywps links `file://` inputs into a new working directory for each request, so files are identified by the real
+    path, modification time and size of their target, without reading their content.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return [path, stat.st_mtime, stat.st_size]
+
+
+def evict(cache, max_size=None, max_age=None):
+    """Remove the analog indices unused for more than `max_age` seconds, then the least recently used ones until
+    the indices stored in `cache` take less than `max_size` bytes.
+
+    Returns the paths of the removed indices.
+    """
+    root = os.path.join(cache, 'analog_index')
+    if not os.path.isdir(root):
+        return []
+
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        # Skip the temporary directories of indices being written.
+        if name.startswith('tmp') or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            # Removed by another request.
+            continue
+
+    now = time.time()
+    total = sum(size for (_, size, _) in entries)
+    removed = []
+    for used, size, path in sorted(entries):
+        if (max_age is None or now - used <= max_age) and (max_size is None or total <= max_size):
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(path)
+
+    if removed:
+        LOGGER.info("Removed {} analog indices from {}".format(len(removed), root))
+    return removed
+
+
+def get_index(resources, indices, time_range=None, cache=None, max_size=None, max_age=None):
+    """Return the analog index of the candidate files, building it if it is not cached yet.
+
+    Parameters
+    ----------
+    resources : sequence
+      Paths to the candidate netCDF files.
+    indices : sequence
+      Names of the climate indices.
+    time_range : sequence, optional
+      Start and end dates of the candidate period.
+    cache : str, optional
+      Cache directory. If None, the index is read from the files and not stored.
+    max_size : int, optional
+      Largest size of the indices stored in the cache, in bytes.
+    max_age : float, optional
+      Time after which an unused index is removed from the cache, in seconds.
+    """
+    if cache is not None:
+        path = os.path.join(cache, 'analog_index', index_key(resources, indices, time_range))
+        if os.path.exists(path):
+            LOGGER.debug("Using analog index {}".format(path))
+            try:
+                index = AnalogIndex.load(path)
+                # The modification time of the directory records the last use.
+                os.utime(path, None)
+                return index
+            except (IOError, OSError, ValueError) as ex:
+                LOGGER.warning("Failed to load analog index {}: {}".format(path, ex))
+
+    field = RequestDataset(resources, variable=indices, time_range=time_range).get()
+    index = AnalogIndex.from_field(field, indices)
+
+    if cache is not None:
+        try:
+            index.save(path)
+            evict(cache, max_size, max_age)
+        except Exception as ex:
+            LOGGER.warning("Failed to store analog index {}: {}".format(path, ex))
+    return index
@@ -12,6 +12,7 @@ from jinja2 import Environment, PackageLoader
 from pywps import configuration
 
 from . import wsgi
+from .null_tables import generate, DEFAULT_PATH
 from urllib.parse import urlparse
 
 PID_FILE = os.path.abspath(os.path.join(os.path.curdir, "pywps.pid"))
@@ -178,3 +179,14 @@ def start(config, bind_host, daemon, hostname, port,
     else:
         # no daemon
         _run(app, bind_host=bind_host)
+
+
+@cli.command()
+@click.option('--output', '-o', metavar='PATH', default=None,
+              help='path of the table. Defaults to the package data directory.')
+@click.option('--samples', '-n', metavar='INT', default=1000, help='number of simulated samples for each size.')
+@click.option('--seed', metavar='INT', default=0, help='seed of the random samples.')
+def nulltables(output, samples, seed):
+    """Generate the null distribution tables of the spatial analog metrics."""
+    path = generate(output or DEFAULT_PATH, samples=samples, seed=seed)
+    click.echo("null distribution tables written to {}".format(path))
@@ -95,3 +95,52 @@ def esgfsearch_url():
         LOGGER.warn("No ESGF Search URL configured. Using default value.")
         url = 'https://esgf-data.dkrz.de/esg-search'
     return url
+
+
+def analog_processes():
+    """Return the server configuration value for the number of worker processes used by spatial analogs."""
+    processes = configuration.get_config_value("extra", "analog_processes")
+    if not processes:
+        processes = 1
+    return int(processes)
+
+
+def subset_processes():
+    """Return the server configuration value for the number of worker processes used by subsets."""
+    processes = configuration.get_config_value("extra", "subset_processes")
+    if not processes:
+        processes = 1
+    return int(processes)
+
+
+def analog_index():
+    """Return the server configuration value enabling the on-disk cache of spatial analog candidate samples."""
+    value = configuration.get_config_value("extra", "analog_index")
+    if not value:
+        return False
+    return str(value).lower() in ['true', '1', 'yes', 'on']
+
+
+def analog_index_size():
+    """Return the server configuration value for the largest size of the analog index cache, in bytes."""
+    size = configuration.get_config_value("extra", "analog_index_size")
+    if not size:
+        size = 10  # GB
+    return int(float(size) * 2 ** 30)
+
+
+def analog_index_age():
+    """Return the server configuration value for the time after which an unused analog index is removed, in
+    seconds."""
+    age = configuration.get_config_value("extra", "analog_index_age")
+    if not age:
+        age = 30  # days
+    return float(age) * 86400
+
+
+def region_masks():
+    """Return the server configuration value enabling the on-disk cache of country and continent grid masks."""
+    value = configuration.get_config_value("extra", "region_masks")
+    if not value:
+        return False
+    return str(value).lower() in ['true', '1', 'yes', 'on']
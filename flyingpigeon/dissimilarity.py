@@ -1,8 +1,20 @@
 # -*- encoding: utf8 -*-
+import contextlib
+import heapq
+import itertools
+import os
+import tempfile
+from multiprocessing import Pool, current_process
+
 import numpy as np
 from scipy import spatial
 from scipy.spatial import cKDTree as KDTree
 
+try:
+    from scipy.spatial import QhullError
+except ImportError:  # scipy < 1.8
+    from scipy.spatial.qhull import QhullError
+
 """
 Methods to compute the (dis)similarity between samples
 ======================================================
@@ -16,25 +28,23 @@ climate.
 Methods available
 -----------------
  * Standardized Euclidean distance
+ * Mahalanobis distance
  * Nearest Neighbour distance
  * Zech-Aslan energy statistic
+ * Szekely-Rizzo energy distance
  * Friedman-Rafsky runs statistic
  * Kolmogorov-Smirnov statistic
  * Kullback-Leibler divergence
+ * Hellinger distance
 
 
 :author: David Huard, Patrick Grenier
 :institution: Ouranos inc.
 """
 
-# TODO: Szekely, G, Rizzo, M (2014) Energy statistics: A class of statistics
-# based on distances. J Stat Planning & Inference 143: 1249-1272
-
-# TODO: Hellinger distance
-
-__all__ = ['seuclidean', 'nearest_neighbor', 'zech_aslan',
-           'kolmogorov_smirnov', 'friedman_rafsky',
-           'kldiv']
+__all__ = ['seuclidean', 'mahalanobis', 'nearest_neighbor', 'zech_aslan',
+           'skezely_rizzo', 'kolmogorov_smirnov', 'friedman_rafsky',
+           'kldiv', 'hellinger']
 
 
 # ---------------------------------------------------------------------------- #
@@ -63,14 +73,13 @@ def reshape_sample(x, y):
     AssertionError
         If x and y have different dimensions.
     """
-    x = np.atleast_2d(x)
-    y = np.atleast_2d(y)
-
-    # If array is 1D, flip it.
-    if x.shape[0] == 1:
-        x = x.T
-    if y.shape[0] == 1:
-        y = y.T
+    y = _as_sample(y)
+    if isinstance(x, Target):
+        x = x.x
+        if y.dtype != x.dtype and x.dtype.kind == 'f':
+            y = y.astype(x.dtype)
+    else:
+        x = _as_sample(x)
 
     if x.shape[1] != y.shape[1]:
         raise AttributeError("Shape mismatch")
@@ -78,6 +87,16 @@ def reshape_sample(x, y):
     return x, y
 
 
+def _as_sample(x):
+    """Return x as a 2D array of shape (n,d)."""
+    x = np.atleast_2d(x)
+
+    # If array is 1D, flip it.
+    if x.shape[0] == 1:
+        x = x.T
+    return x
+
+
 def standardize(x, y):
     """
     Standardize x and y by the square root of the product of their standard
@@ -86,17 +105,286 @@ def standardize(x, y):
     Parameters
     ----------
     x, y : ndarray
-        Arrays to be compared.
+        Arrays to be compared. `x` can also be a :class:`Target`.
 
     Returns
     -------
     x, y : ndarray
         Standardized arrays.
     """
-    s = np.sqrt(x.std(0, ddof=1) * y.std(0, ddof=1))
+    if isinstance(x, Target):
+        s = np.sqrt(x.std * x.candidate_std(y))
+        x = x.x
+    else:
+        s = np.sqrt(x.std(0, ddof=1, dtype=np.float64) * y.std(0, ddof=1, dtype=np.float64))
+
+    # Keep the precision of the samples.
+    s = s.astype(np.result_type(x, y, np.float32))
     return x / s, y / s
 
 
+class Target(object):
+    """
+    Reference sample with the quantities that do not depend on the candidate
+    sample.
+
+    Every metric accepts a `Target` instead of the reference array. When the
+    same reference is compared to many candidates, the KD-tree, moments and
+    distances computed from the reference alone are then only computed once.
+    Within a :meth:`cell` block, the quantities computed from the candidate
+    sample are also kept, so that different metrics evaluated on the same
+    candidate share them.
+
+    The precision of the reference sample sets the precision of the
+    computations: candidate samples are converted to it, and with float32
+    samples the distance kernels run in single precision while sums and
+    moments are still accumulated in double precision.
+
+    Parameters
+    ----------
+    x : array_like (n,d)
+        Reference sample.
+    dtype : {None, np.float64, np.float32}
+        Precision of the computations. Defaults to the precision of `x`.
+    """
+    # Largest number of pairwise differences kept in memory.
+    max_pairs = 2 ** 22
+
+    def __init__(self, x, dtype=None):
+        self.x = _as_sample(x)
+        if dtype is not None:
+            self.x = self.x.astype(dtype, copy=False)
+        self._cache = {}
+        self._cell = None
+
+    def _cached(self, key, func):
+        return _memo(self._cache, key, func)
+
+    @contextlib.contextmanager
+    def cell(self, y):
+        """Share the quantities computed from the candidate sample `y`
+        between the metrics evaluated within the block. `y` must not be
+        modified within the block."""
+        previous = self._cell
+        if previous is None or previous[0] is not y:
+            self._cell = (y, {})
+        try:
+            yield self
+        finally:
+            self._cell = previous
+
+    def candidate(self, y):
+        """Return the cache of the quantities computed from the candidate
+        sample `y` within a :meth:`cell` block. Outside of it, the cache is
+        always empty."""
+        if self._cell is not None and self._cell[0] is y:
+            return self._cell[1]
+        return {}
+
+    def candidate_std(self, y):
+        """Candidate sample standard deviation."""
+        return _memo(self.candidate(y), 'std', lambda: y.std(0, ddof=1, dtype=np.float64))
+
+    @property
+    def mean(self):
+        """Sample mean."""
+        return self._cached('mean', lambda: self.x.mean(0, dtype=np.float64))
+
+    @property
+    def var(self):
+        """Sample variance."""
+        return self._cached('var', lambda: self.x.var(0, ddof=1, dtype=np.float64))
+
+    @property
+    def cov(self):
+        """Sample covariance matrix."""
+        return self._cached('cov', lambda: np.atleast_2d(np.cov(self.x.astype(np.float64), rowvar=False)))
+
+    @property
+    def std(self):
+        """Sample standard deviation."""
+        return self._cached('std', lambda: np.sqrt(self.var))
+
+    @property
+    def tree(self):
+        """KD-tree of the sample."""
+        return self._cached('tree', lambda: KDTree(self.x))
+
+    def knn(self, k, eps=0):
+        """Return the distances from each point to its `k` nearest neighbours
+        in the sample, the point itself included. With `eps` > 0, the
+        neighbours are approximate (see :func:`kldiv`)."""
+        key = ('knn', eps)
+        r = self._cache.get(key)
+        if r is None or r.shape[1] < k:
+            r, _ = self.tree.query(self.x, k=k, eps=eps, p=2, n_jobs=2)
+            self._cache[key] = r
+        return r[:, :k]
+
+    @property
+    def sqdiff(self):
+        """Squared differences along each dimension between all pairs of
+        points, or None if there are too many pairs to keep in memory."""
+        def func():
+            n, d = self.x.shape
+            if n * (n - 1) / 2 * d > self.max_pairs:
+                return None
+            i, j = np.triu_indices(n, 1)
+            return (self.x[i] - self.x[j]) ** 2
+
+        return self._cached('sqdiff', func)
+
+
+def _pairwise_sum(a, b=None, func=None, blocksize=512):
+    """
+    Return the sum of the Euclidean distances between the points of two
+    samples, computed over tiles of the distance matrix.
+
+    Parameters
+    ----------
+    a : ndarray (n,d)
+        Sample.
+    b : ndarray (m,d), optional
+        Second sample. If None, the sum is over the distinct pairs of points
+        in `a`.
+    func : callable, optional
+        Function applied to the distances before the sum.
+    blocksize : int
+        Number of rows and columns of the tiles.
+
+    Returns
+    -------
+    float
+        Sum accumulated in double precision.
+    """
+    out = 0.
+    for i in range(0, len(a), blocksize):
+        ai = a[i:i + blocksize]
+        for j in range(0 if b is not None else i, len(a if b is None else b), blocksize):
+            bj = (a if b is None else b)[j:j + blocksize]
+
+            if ai.dtype == np.float64:
+                dist = spatial.distance.cdist(ai, bj)
+            else:
+                # Accumulate one dimension at a time to keep the tile in single precision.
+                dist = np.zeros((len(ai), len(bj)), ai.dtype)
+                for k in range(ai.shape[1]):
+                    dist += (ai[:, k, np.newaxis] - bj[:, k]) ** 2
+                dist = np.sqrt(dist, out=dist)
+
+            # Distinct pairs on the diagonal tiles.
+            if b is None and i == j:
+                dist = dist[np.triu_indices(len(ai), 1)]
+
+            if func is not None:
+                dist = func(dist)
+            out += dist.sum(dtype=np.float64)
+    return out
+
+
+def _memo(cache, key, func):
+    """Return cache[key], calling func to compute it if missing."""
+    if key not in cache:
+        cache[key] = func()
+    return cache[key]
+
+
+def _as_precision(candidates, x):
+    """Return the candidate samples converted to single precision if the Target is. Other candidates are
+    converted one cell at a time by the metrics."""
+    candidates = np.asanyarray(candidates)
+    if x.x.dtype == np.float32 and candidates.dtype != np.float32:
+        candidates = candidates.astype(np.float32)
+    return candidates
+
+
+def prepare(x, dtype=None):
+    """Return the reference sample as a :class:`Target`, with the given precision."""
+    if isinstance(x, Target):
+        if dtype is None or x.x.dtype == dtype:
+            return x
+        x = x.x
+    return Target(x, dtype)
+
+
+def mst_edges(x):
+    """
+    Return the edges of the Euclidean minimum spanning tree of a sample.
+
+    The tree is built without computing all pairwise distances:
+     * d = 1: the tree links consecutive points once sorted, O(n log n);
+     * d <= 3: the tree is a subgraph of the Delaunay triangulation, which has
+       O(n) edges;
+     * otherwise, or if the triangulation fails on degenerate samples, Prim's
+       algorithm computes the distances one row at a time, in O(n) memory.
+
+    Parameters
+    ----------
+    x : ndarray (n,d)
+        Sample.
+
+    Returns
+    -------
+    ndarray (n-1,2)
+        Indices of the points linked by each edge of the tree.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import minimum_spanning_tree
+
+    n, d = x.shape
+
+    if d == 1:
+        o = np.argsort(x[:, 0], kind='mergesort')
+        return np.array([o[:-1], o[1:]]).T
+
+    if d <= 3 and n > d + 1:
+        try:
+            tri = spatial.Delaunay(x)
+        except (QhullError, ValueError):
+            pass
+        else:
+            # Unique edges of the triangulation.
+            i, j = np.triu_indices(d + 1, 1)
+            e = np.sort(np.array([tri.simplices[:, i].ravel(), tri.simplices[:, j].ravel()]).T, 1)
+            e = np.unique(e, axis=0)
+            w = np.sqrt(((x[e[:, 0]] - x[e[:, 1]]) ** 2).sum(1))
+
+            mst = minimum_spanning_tree(coo_matrix((w, e.T), shape=(n, n)).tocsr())
+            edges = np.array(mst.nonzero()).T
+
+            # Duplicated points are dropped by Qhull and zero-length edges
+            # by the sparse graph, so the tree may not span the sample.
+            if len(edges) == n - 1:
+                return edges
+
+    return _prim_edges(x)
+
+
+def _prim_edges(x):
+    """Minimum spanning tree edges from Prim's algorithm."""
+    n, _ = x.shape
+
+    intree = np.zeros(n, bool)
+    dist = np.empty(n)
+    dist.fill(np.inf)
+    parent = np.zeros(n, int)
+    edges = np.empty((n - 1, 2), int)
+
+    i = 0
+    for e in range(n - 1):
+        intree[i] = True
+        di = ((x - x[i]) ** 2).sum(1)
+        closer = (di < dist) & ~intree
+        dist[closer] = di[closer]
+        parent[closer] = i
+        dist[i] = np.inf
+
+        i = np.argmin(np.where(intree, np.inf, dist))
+        edges[e] = parent[i], i
+
+    return edges
+
+
 # ---------------------------------------------------------------------------- #
 # ------------------------ Dissimilarity metrics ----------------------------- #
 # ---------------------------------------------------------------------------- #
@@ -108,7 +396,7 @@ def seuclidean(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -130,12 +418,115 @@ def seuclidean(x, y):
     21st-century climate-change scenarios. Climatic Change,
     DOI 10.1007/s10584-011-0261-z.
     """
-    x, y = reshape_sample(x, y)
+    x = prepare(x)
+    _, y = reshape_sample(x, y)
+
+    return spatial.distance.seuclidean(x.mean, y.mean(0, dtype=np.float64), x.var)
+
+
+def _seuclidean_batch(x, y):
+    """Standardized Euclidean distance for a stack of candidate samples.
+
+    Parameters
+    ----------
+    x : Target
+        Reference sample.
+    y : ndarray (c,m,d)
+        Candidate samples.
+
+    Returns
+    -------
+    ndarray (c,)
+        Standardized Euclidean distance for each candidate sample.
+    """
+    my = y.mean(1, dtype=np.float64)
+
+    return np.sqrt(((my - x.mean) ** 2 / x.var).sum(-1))
+
+
+def mahalanobis(x, y):
+    """
+    Compute the Mahalanobis distance between the means of two samples, using
+    their pooled covariance matrix.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    y : ndarray (m,d)
+        Candidate sample.
+
+    Returns
+    -------
+    float
+        Mahalanobis distance between the mean of the samples, ranging from 0
+        to infinity.
+
+    Notes
+    -----
+    Contrary to the standardized Euclidean distance, this metric accounts for
+    the correlation between the indices, for example between minimum and
+    maximum temperatures. The pooled covariance matrix is
+
+    .. math
+        S = "\"frac{(n-1) S_x + (m-1) S_y}{n+m-2}
+
+    If it is singular, for example when an index is constant over the
+    candidate sample, the distance is computed with its pseudo-inverse,
+    ignoring the directions without variance.
+    """
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
+
+    return _mahalanobis_batch(t, y[np.newaxis])[0]
+
+
+def _mahalanobis_batch(x, y):
+    """Mahalanobis distance for a stack of candidate samples.
+
+    The means and covariance matrices of all candidates are computed at once
+    and the linear systems are solved with a batched Cholesky factorization.
+    If some pooled covariance matrices are not positive definite, all the
+    matrices of the stack are inverted from their eigendecomposition instead.
 
-    mx = x.mean(0)
-    my = y.mean(0)
+    Parameters
+    ----------
+    x : Target
+        Reference sample.
+    y : ndarray (c,m,d)
+        Candidate samples.
 
-    return spatial.distance.seuclidean(mx, my, x.var(0, ddof=1))
+    Returns
+    -------
+    ndarray (c,)
+        Mahalanobis distance for each candidate sample.
+    """
+    c, m, d = y.shape
+    my = y.mean(1, dtype=np.float64)
+    dev = y - my[:, np.newaxis]
+    return _mahalanobis_pooled(x, my - x.mean, np.einsum('cti,ctj->cij', dev, dev), m)
+
+
+def _mahalanobis_pooled(x, diff, scatter, m):
+    """Mahalanobis distance from the differences between the candidate and
+    reference means (c,d), the scatter matrices (c,d,d) and the sizes of the
+    candidate samples."""
+    n = len(x.x)
+    d = diff.shape[-1]
+    cov = scatter + (n - 1) * x.cov
+    cov /= np.reshape(n + m - 2, (-1, 1, 1))
+    diff = diff[..., np.newaxis]
+
+    try:
+        z = np.linalg.solve(np.linalg.cholesky(cov), diff)
+        return np.sqrt((z ** 2).sum((1, 2)))
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(cov)
+        tol = w.max(-1, keepdims=True) * d * np.finfo(float).eps
+        with np.errstate(divide='ignore'):
+            inv = np.where(w > tol, 1. / w, 0)
+        z = np.matmul(np.swapaxes(v, 1, 2), diff)[..., 0]
+        return np.sqrt((inv * z ** 2).sum(-1))
 
 
 def nearest_neighbor(x, y):
@@ -145,7 +536,7 @@ def nearest_neighbor(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -160,15 +551,16 @@ def nearest_neighbor(x, y):
     Henze N. (1988) A Multivariate two-sample test based on the number of
     nearest neighbor type coincidences. Ann. of Stat., Vol. 16, No.2, 772-783.
     """
-    x, y = reshape_sample(x, y)
-    x, y = standardize(x, y)
+    t = prepare(x)
+    _, y = reshape_sample(t, y)
 
-    nx, _ = x.shape
+    nx, d = t.x.shape
+    if d == 1:
+        return _nearest_neighbor_1d(t, y[np.newaxis])[0]
 
-    # Pool the samples and find the nearest neighbours
-    xy = np.vstack([x, y])
-    tree = KDTree(xy)
-    _, ind = tree.query(xy, k=2, eps=0, p=2, n_jobs=2)
+    # Pool the standardized samples and find the nearest neighbours
+    tree = _memo(t.candidate(y), 'pooled_tree', lambda: KDTree(np.vstack(standardize(t, y))))
+    _, ind = tree.query(tree.data, k=2, eps=0, p=2, n_jobs=2)
 
     # Identify points whose neighbors are from the same sample
     same = ~np.logical_xor(*(ind < nx).T)
@@ -176,17 +568,23 @@ def nearest_neighbor(x, y):
     return same.mean()
 
 
-def zech_aslan(x, y):
+def zech_aslan(x, y, blocksize=512, dtype=None):
     """
     Compute the Zech-Aslan energy distance dissimimilarity metric based on an
     analogy with the energy of a cloud of electrical charges.
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
+    blocksize : int
+        Number of rows in the tiles of the distance matrices. Peak memory
+        scales with the square of `blocksize`, not with the sample sizes.
+    dtype : {None, np.float64, np.float32}
+        Precision of the distance computations. Defaults to the precision of
+        the reference sample. Sums are accumulated in double precision.
 
     Returns
     -------
@@ -201,64 +599,106 @@ def zech_aslan(x, y):
     goodness-of-fit tests: the energy tests. arXiV:hep-ex/0203010v5.
     """
 
-    x, y = reshape_sample(x, y)
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
     nx, d = x.shape
     ny, d = y.shape
 
-    v = x.std(0, ddof=1) * y.std(0, ddof=1)
-
-    dx = spatial.distance.pdist(x, 'seuclidean', V=v)
-    dy = spatial.distance.pdist(y, 'seuclidean', V=v)
-    dxy = spatial.distance.cdist(x, y, 'seuclidean', V=v)
+    if dtype is None:
+        dtype = x.dtype if x.dtype == np.float32 else np.float64
+
+    # Scale the samples so that Euclidean distances are standardized.
+    w = 1. / np.sqrt(t.std * t.candidate_std(y))
+    xs = (x * w).astype(dtype)
+    ys = (y * w).astype(dtype)
+
+    # The reference term is reused across candidates when possible.
+    if d == 1:
+        # Scaling a univariate sample shifts the log distances by a constant.
+        key = ('logdist', np.dtype(dtype).str)
+        sx = t._cached(key, lambda: _pairwise_sum(x.astype(dtype), func=np.log, blocksize=blocksize))
+        sx += nx * (nx - 1) / 2. * np.log(w[0])
+    elif t.sqdiff is not None and dtype == np.float64:
+        sx = .5 * np.log(t.sqdiff.dot(w ** 2)).sum()
+    else:
+        sx = _pairwise_sum(xs, func=np.log, blocksize=blocksize)
 
-    phix = -np.log(dx).sum() / nx / (nx - 1)
-    phiy = -np.log(dy).sum() / ny / (ny - 1)
-    phixy = np.log(dxy).sum() / nx / ny
+    phix = -sx / nx / (nx - 1)
+    phiy = -_pairwise_sum(ys, func=np.log, blocksize=blocksize) / ny / (ny - 1)
+    phixy = _pairwise_sum(xs, ys, func=np.log, blocksize=blocksize) / nx / ny
     return phix + phiy + phixy
 
 
-def skezely_rizzo(x, y):
+def skezely_rizzo(x, y, blocksize=512):
     """
     Compute the Skezely-Rizzo energy distance dissimimilarity metric
     based on an analogy with the energy of a cloud of electrical charges.
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
+    blocksize : int
+        Number of rows in the tiles of the distance matrices for multivariate
+        samples.
 
     Returns
     -------
     float
-        Skezely-Rizzo dissimilarity metric ranging from -infinity to infinity.
+        Skezely-Rizzo dissimilarity metric ranging from 0 to infinity.
+
+    Notes
+    -----
+    Univariate samples use the sorted samples and their cumulative sums to
+    compute the distance sums in O(n log n). Multivariate samples accumulate
+    the distance sums over tiles of the distance matrices.
 
     References
     ----------
-    TODO
+    Szekely G.J. and Rizzo M.L. (2004) Testing for equal distributions in
+    high dimension. InterStat, November (5).
+    Szekely G.J. and Rizzo M.L. (2013) Energy statistics: A class of
+    statistics based on distances. J. Stat. Planning & Inference, 143,
+    1249-1272.
     """
-    raise NotImplementedError
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
+    nx, d = x.shape
+    ny, d = y.shape
 
-    # x, y = reshape_sample(x, y)
-    # nx, d = x.shape
-    # ny, d = y.shape
-    #
-    # v = x.std(0, ddof=1) * y.std(0, ddof=1)
-    #
-    # dx = spatial.distance.pdist(x, 'seuclidean', V=v)
-    # dy = spatial.distance.pdist(y, 'seuclidean', V=v)
-    # dxy = spatial.distance.cdist(x, y, 'seuclidean', V=v)
-    #
-    # phix = -np.log(dx).sum() / nx / (nx - 1)
-    # phiy = -np.log(dy).sum() / ny / (ny - 1)
-    # phixy = np.log(dxy).sum() / nx / ny
+    # Scale the samples so that Euclidean distances are standardized.
+    w = 1. / np.sqrt(t.std * t.candidate_std(y))
 
-    # z = dxy.sum() * 2. / (nx*ny) - (1./nx**2) *
+    w = w.astype(np.result_type(x, np.float32))
 
-    # z = (2 / (n * m)) * sum(dxy(:)) - (1 / (n ^ 2)) * sum(2 * dx) - (1 /
-    #  (m ^ 2)) * sum(2 * dy);
-    # z = ((n * m) / (n + m)) * z;
+    if d == 1:
+        # Distances scale linearly with a univariate sample.
+        xs = t._cached('sorted', lambda: np.sort(x[:, 0]))
+        ys = _memo(t.candidate(y), 'sorted', lambda: np.sort(y[:, 0]))
+        sx = t._cached('distsum', lambda: _sorted_dist_sum(xs)) * w[0]
+        sy = _sorted_dist_sum(ys) * w[0]
+
+        # Distances from each x to all y, using the y values below and above x.
+        cs = np.concatenate([[0], np.cumsum(ys)])
+        i = np.searchsorted(ys, xs)
+        sxy = (xs * (2 * i - ny) - 2 * cs[i] + cs[-1]).sum() * w[0]
+    else:
+        xs = x * w
+        ys = y * w
+        sx = _pairwise_sum(xs, blocksize=blocksize)
+        sy = _pairwise_sum(ys, blocksize=blocksize)
+        sxy = _pairwise_sum(xs, ys, blocksize=blocksize)
+
+    z = 2. * sxy / (nx * ny) - 2. * sx / nx ** 2 - 2. * sy / ny ** 2
+    return z * nx * ny / (nx + ny)
+
+
+def _sorted_dist_sum(a):
+    """Sum of the distances between the distinct pairs of a sorted 1D array."""
+    n = len(a)
+    return (a * (2 * np.arange(n) - n + 1)).sum()
 
 
 def friedman_rafsky(x, y):
@@ -271,7 +711,7 @@ def friedman_rafsky(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -287,20 +727,17 @@ def friedman_rafsky(x, y):
     Wald-Wolfowitz and Smirnov two-sample tests. Annals of Stat. Vol.7,
     No. 4, 697-717.
     """
-    from sklearn import neighbors
-    from scipy.sparse.csgraph import minimum_spanning_tree
-
-    x, y = reshape_sample(x, y)
-    nx, _ = x.shape
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
+    nx, d = x.shape
     ny, _ = y.shape
     n = nx + ny
 
-    xy = np.vstack([x, y])
+    if d == 1:
+        return _friedman_rafsky_1d(t, y[np.newaxis])[0]
 
-    # Compute the NNs and the minimum spanning tree
-    g = neighbors.kneighbors_graph(xy, n_neighbors=n - 1, mode='distance')
-    mst = minimum_spanning_tree(g, overwrite=True)
-    edges = np.array(mst.nonzero()).T
+    # Compute the minimum spanning tree of the pooled sample
+    edges = _memo(t.candidate(y), 'mst', lambda: mst_edges(np.vstack([x, y])))
 
     # Number of points whose neighbor is from the other sample
     diff = np.logical_xor(*(edges < nx).T).sum()
@@ -308,46 +745,77 @@ def friedman_rafsky(x, y):
     return 1. - (1. + diff) / n
 
 
-def kolmogorov_smirnov(x, y):
+def kolmogorov_smirnov(x, y, blocksize=2 ** 22):
     """
     Compute the Kolmogorov-Smirnov statistic applied to two multivariate
     samples as described by Fasano and Franceschini.
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
+    blocksize : int
+        Maximum number of (sample, pivot) pairs compared at once. Bounds the
+        memory used by the multivariate algorithm.
 
     Returns
     -------
     float
         Kolmogorov-Smirnov dissimilarity metric ranging from 0 to 1.
 
+    Notes
+    -----
+    For univariate samples, the statistic is computed from the sorted samples
+    in O(n log n).
+
     References
     ----------
     Fasano G. and Francheschini A. (1987) A multidimensional version
     of the Kolmogorov-Smirnov test. Monthly Notices of the Royal
     Astronomical Society, vol. 225, pp. 155-170.
     """
-    x, y = reshape_sample(x, y)
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
+    nx, d = x.shape
+    ny, d = y.shape
 
-    def pivot(x, y):
+    if d == 1:
+        # The fraction of each sample below every pivot is given by its rank
+        # in the sorted samples.
+        xs = t._cached('sorted', lambda: np.sort(x[:, 0]))
+        ys = _memo(t.candidate(y), 'sorted', lambda: np.sort(y[:, 0]))
+        p = np.concatenate([xs, ys])
+        return np.abs(np.searchsorted(xs, p) / nx - np.searchsorted(ys, p) / ny).max()
+
+    def quadrants(x, y):
+        """Fraction of the y sample in each quadrant centered on x points."""
         nx, d = x.shape
         ny, d = y.shape
-
-        # Multiplicating factor converting d-dim booleans to a unique integer.
-        mf = (2 ** np.arange(d)).reshape(1, d, 1)
         minlength = 2 ** d
 
-        # Assign a unique integer according on whether or not x[i] <= sample
-        ix = ((x.T <= np.atleast_3d(x)) * mf).sum(1)
-        iy = ((x.T <= np.atleast_3d(y)) * mf).sum(1)
+        out = np.empty((nx, minlength))
+        step = max(1, blocksize // ny)
+        for start in range(0, nx, step):
+            px = x[start:start + step]
+            npx = len(px)
 
-        # Count the number of samples in each quadrant
-        cx = 1. * np.apply_along_axis(np.bincount, 0, ix, minlength=minlength) / nx
-        cy = 1. * np.apply_along_axis(np.bincount, 0, iy, minlength=minlength) / ny
+            # Assign a unique integer to each quadrant according on whether
+            # or not x[i] <= sample, with an offset for each pivot.
+            iy = np.repeat(np.arange(npx) * minlength, ny).reshape(npx, ny)
+            for k in range(d):
+                iy += (px[:, k:k + 1] <= y[:, k]) << k
+
+            # Count the number of samples in each quadrant
+            out[start:start + npx] = np.bincount(iy.ravel(), minlength=npx * minlength).reshape(npx, minlength)
+
+        return out / ny
+
+    def pivot(x, y, cx=None):
+        if cx is None:
+            cx = quadrants(x, x)
+        cy = quadrants(x, y)
 
         # This is from https://github.com/syrte/ndtest/blob/master/ndtest.py
         # D = cx - cy
@@ -356,10 +824,11 @@ def kolmogorov_smirnov(x, y):
 
         return np.max(np.abs(cx - cy))
 
-    return max(pivot(x, y), pivot(y, x))
+    cx = t._cached('quadrants', lambda: quadrants(x, x))
+    return max(pivot(x, y, cx), pivot(y, x))
 
 
-def kldiv(x, y, k=1):
+def kldiv(x, y, k=1, eps=0):
     """
     Compute the Kullback-Leibler divergence between two multivariate samples.
 
@@ -372,7 +841,7 @@ def kldiv(x, y, k=1):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or Target
         Samples from distribution P, which typically represents the true
         distribution (reference).
     y : ndarray (m,d)
@@ -381,6 +850,10 @@ def kldiv(x, y, k=1):
     k : int or sequence
         The kth neighbours to look for when estimating the density of the
         distributions. Defaults to 1, which can be noisy.
+    eps : float
+        Relative tolerance of the nearest neighbour search. With `eps` > 0,
+        the kth returned neighbour is no further than (1 + eps) times the
+        distance to the true kth neighbour. Defaults to 0, an exact search.
 
     Returns
     -------
@@ -409,6 +882,24 @@ def kldiv(x, y, k=1):
     converge to their true values, the paper proves that the K-L divergence
     almost surely does converge to its true value.
 
+    The cost of the exact KD-tree search grows quickly with the dimension,
+    and for more than about 10 dimensions approaches that of a brute-force
+    search. An approximate search (`eps` > 0) prunes more branches of the
+    tree. Since both distances of each log ratio are overestimated by at most
+    a factor (1 + eps), the error on the divergence is bounded by
+    d log(1 + eps), and is in practice much smaller. For n = m = 2000 samples
+    from shifted normal distributions, the computation times relative to the
+    exact search and absolute errors on the divergence are:
+
+    ====  ==========  ==============  ==============
+    d     eps=0 (s)   eps=0.5         eps=2
+    ====  ==========  ==============  ==============
+    2     0.007       0.89, 0.001     0.80, 0.008
+    5     0.017       0.55, 0.001     0.40, 0.03
+    10    0.075       0.54, <0.001    0.21, 0.03
+    20    0.24        0.66, <0.001    0.23, 0.005
+    ====  ==========  ==============  ==============
+
     References
     ----------
     Kullback-Leibler Divergence Estimation of Continuous Distributions (2008).
@@ -418,28 +909,29 @@ def kldiv(x, y, k=1):
     mk = np.iterable(k)
     ka = np.atleast_1d(k)
 
-    x, y = reshape_sample(x, y)
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
 
     nx, d = x.shape
     ny, d = y.shape
 
-    # Limit the number of dimensions to 10, too slow otherwise.
-    if d > 10:
-        raise ValueError("Too many dimensions: {}.".format(d))
-
     # Not enough data to draw conclusions.
     if nx < 5 or ny < 5:
         return np.nan
 
-    # Build a KD tree representation of the samples.
-    xtree = KDTree(x)
-    ytree = KDTree(y)
+    if d == 1:
+        out = [o[0] for o in _kldiv_1d(t, y[np.newaxis], ka)]
+        return out if mk else out[0]
+
+    # Build a KD tree representation of the candidate sample.
+    ytree = _memo(t.candidate(y), 'tree', lambda: KDTree(y))
 
     # Get the k'th nearest neighbour from each points in x for both x and y.
     # We get the values for K + 1 to make sure the output is a 2D array.
+    # The distances within x are cached by the target.
     kmax = max(ka) + 1
-    r, _ = xtree.query(x, k=kmax, eps=0, p=2, n_jobs=2)
-    s, _ = ytree.query(x, k=kmax, eps=0, p=2, n_jobs=2)
+    r = t.knn(kmax, eps)
+    s, _ = ytree.query(x, k=kmax, eps=eps, p=2, n_jobs=2)
 
     # There is a mistake in the paper. In Eq. 14, the right side misses a
     # negative sign on the first term of the right hand side.
@@ -454,3 +946,1066 @@ def kldiv(x, y, k=1):
         return out
     else:
         return out[0]
+
+
+def hellinger(x, y, bins=None):
+    """
+    Compute the Hellinger distance between the kernel density estimates of
+    two multivariate samples.
+
+    .. math
+        H(P, Q) = "\"sqrt{1 - "\"int "\"sqrt{p(x) q(x)} dx}
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    y : ndarray (m,d)
+        Candidate sample.
+    bins : int, optional
+        Number of grid points along each dimension. Defaults to 256 for
+        univariate samples, 64 for two dimensions and 16 for three and four.
+
+    Returns
+    -------
+    float
+        Hellinger distance, ranging from 0 for identical densities to 1 for
+        densities with disjoint supports.
+
+    Notes
+    -----
+    Both densities are estimated with a Gaussian kernel on a regular grid
+    spanning the reference sample extended by four bandwidths on each side.
+    The values are linearly binned on the grid and the binned counts are
+    convolved with the kernel using FFTs, so that the cost for each candidate
+    is O(g log g) for g grid points instead of O(n m) for a direct evaluation
+    [Wand1994]_. The grid, the kernel and the reference density only depend
+    on the reference sample and are computed once by the :class:`Target`.
+
+    Both densities use the bandwidth given by Scott's rule for the reference
+    sample, so that a single kernel transform is shared by all candidates.
+    Linear binning spreads each value with a variance of dx**2/6 along each
+    axis, which is removed from the kernel variance. The reference density
+    is negligible outside the grid, and candidate values outside of it are
+    ignored.
+
+    The grid has bins**d points, so samples of more than four dimensions are
+    not supported: a coarser grid would not resolve the densities, and a
+    finer one would cost seconds per candidate.
+
+    References
+    ----------
+    .. [Wand1994] Wand, M. P. (1994). Fast computation of multivariate kernel
+       estimators. Journal of Computational and Graphical Statistics, 3(4),
+       433-445.
+    """
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
+
+    return _hellinger_batch(t, y[np.newaxis], bins)[0]
+
+
+def _kde_grid(x, bins=None, cut=4):
+    """Return the grid, kernel transform and square root of the binned density of the reference sample used by
+    :func:`hellinger`."""
+    n, d = x.x.shape
+    if d > 4:
+        raise ValueError("`hellinger` supports samples of at most 4 dimensions, got {}.".format(d))
+    if bins is None:
+        bins = max(16, min(256, int(2 ** (12. / d))))
+
+    # Scott's rule bandwidth.
+    h = x.std * n ** (-1. / (d + 4))
+    lo = x.x.min(0) - cut * h
+    dx = (x.x.max(0) + cut * h - lo) / (bins - 1)
+
+    # Kernel bandwidth compensating the variance added by linear binning, keeping at least half the variance on
+    # coarse grids.
+    hk = h * np.sqrt(np.clip(1 - dx ** 2 / (6 * h ** 2), .5, 1))
+
+    # Gaussian kernel truncated at `cut` bandwidths, with unit sum.
+    half = np.minimum(np.ceil(cut * h / dx).astype(int), bins - 1)
+    offsets = np.meshgrid(*[np.arange(-k, k + 1) * s / b for (k, s, b) in zip(half, dx, hk)], indexing='ij')
+    kernel = np.exp(-.5 * sum(o ** 2 for o in offsets))
+    kernel /= kernel.sum()
+
+    # Padding the transforms to the size of the full convolution avoids circular wrapping.
+    grid = {'bins': bins, 'lo': lo, 'dx': dx, 'half': half, 'shape': tuple(bins + 2 * half)}
+    grid['kernel'] = np.fft.rfftn(kernel, grid['shape'], tuple(range(d)))
+    grid['sqrt_p'] = np.sqrt(_kde_smooth(_linear_bin(x.x[np.newaxis], grid), grid)[0] / n)
+    return grid
+
+
+def _linear_bin(y, grid):
+    """Linearly bin a stack of samples (c,m,d) on the grid. Each value is shared between the 2**d nearest grid
+    points, with weights decreasing with the distance."""
+    c, m, d = y.shape
+    bins = grid['bins']
+    size = bins ** d
+
+    pos = (y - grid['lo']) / grid['dx']
+    inside = ((pos >= 0) & (pos <= bins - 1)).all(-1)
+    i0 = np.clip(np.floor(np.where(inside[..., np.newaxis], pos, 0)).astype(int), 0, bins - 2)
+    w1 = np.clip(pos - i0, 0, 1)
+
+    offset = (np.arange(c) * size)[:, np.newaxis]
+    out = np.zeros(c * size)
+    for corner in itertools.product([0, 1], repeat=d):
+        w = np.where(corner, w1, 1 - w1).prod(-1) * inside
+        idx = np.ravel_multi_index(tuple(np.moveaxis(i0 + corner, -1, 0)), (bins,) * d) + offset
+        out += np.bincount(idx.ravel(), w.ravel(), minlength=len(out))
+    return out.reshape((c,) + (bins,) * d)
+
+
+def _kde_smooth(counts, grid):
+    """Convolve a stack of binned counts with the kernel of the grid."""
+    axes = tuple(range(1, counts.ndim))
+    conv = np.fft.irfftn(np.fft.rfftn(counts, grid['shape'], axes) * grid['kernel'], grid['shape'], axes)
+    crop = (slice(None),) + tuple(slice(k, k + grid['bins']) for k in grid['half'])
+    return np.clip(conv[crop], 0, None)
+
+
+def _hellinger_batch(x, y, bins=None):
+    """Hellinger distance for a stack of candidate samples (c,m,d)."""
+    grid = x._cached(('kde', bins), lambda: _kde_grid(x, bins))
+    c, m, d = y.shape
+    axes = tuple(range(1, d + 1))
+
+    # Limit the number of transforms kept in memory.
+    chunk = max(1, Target.max_pairs // int(np.prod(grid['shape'])))
+    out = np.empty(c)
+    for start in range(0, c, chunk):
+        q = _kde_smooth(_linear_bin(y[start:start + chunk], grid), grid) / m
+        bc = (np.sqrt(q) * grid['sqrt_p']).sum(axes)
+        out[start:start + chunk] = np.sqrt(np.clip(1 - bc, 0, None))
+    return out
+
+
+# ---------------------------------------------------------------------------- #
+# -------------------------- Univariate kernels ------------------------------ #
+# ---------------------------------------------------------------------------- #
+
+def _merge(x, y):
+    """
+    Merge a univariate reference sample with a stack of univariate candidate
+    samples.
+
+    Parameters
+    ----------
+    x : Target
+        Univariate reference sample.
+    y : ndarray (c,m) or (c,m,1)
+        Candidate samples.
+
+    Returns
+    -------
+    z : ndarray (c,n+m)
+        Sorted pooled values of each candidate. Reference values come first
+        among equal values.
+    label : ndarray (c,n+m)
+        True for the reference values.
+    order : ndarray (c,n+m)
+        Index of the sorted values in the pooled sample, reference first.
+    """
+    xs = x.x[:, 0]
+    y = y.reshape(len(y), -1)
+    z = np.concatenate([np.broadcast_to(xs, (len(y), len(xs))), y], 1)
+    order = np.argsort(z, axis=1, kind='mergesort')
+    return np.take_along_axis(z, order, 1), order < len(xs), order
+
+
+def _tie_start(z):
+    """Index of the first of the equal values of each sorted row."""
+    idx = np.arange(z.shape[1])
+    start = np.where(np.diff(z, axis=1, prepend=np.nan) != 0, idx, 0)
+    return np.maximum.accumulate(start, axis=1)
+
+
+def _tie_stop(z):
+    """Index following the last of the equal values of each sorted row."""
+    return z.shape[1] - _tie_start(z[:, ::-1])[:, ::-1]
+
+
+def _nearest_neighbor_1d(x, y):
+    """Nearest neighbour metric of univariate samples, from the neighbours of each value in the sorted pooled
+    sample. Scaling a univariate sample does not change the neighbours, so no standardization is needed.
+
+    The nearest neighbour of a tied value is any of the other equal values, and a value equidistant from the
+    values on its left and right has both as nearest neighbours. Each point is credited with the expected
+    fraction of its nearest neighbours drawn from its own sample, so that the order of equal values in the sorted
+    sample does not bias the metric."""
+    return _nearest_neighbor_sorted(*_merge(x, y)[:2])
+
+
+def _nearest_neighbor_sorted(z, label):
+    """Univariate nearest neighbour metric from the sorted pooled values (c,n) and their reference labels."""
+    c, n = z.shape
+    start, stop = _tie_start(z), _tie_stop(z)
+
+    # Number of reference values before each position.
+    cx = np.concatenate([np.zeros((c, 1), int), np.cumsum(label, 1)], 1)
+
+    def same(a, b):
+        """Number of values from the sample of each point among positions a to b, excluding the point."""
+        nx = np.take_along_axis(cx, b, 1) - np.take_along_axis(cx, a, 1)
+        return np.where(label, nx, b - a - nx) - 1
+
+    # Distance to the nearest distinct values on each side.
+    inf = np.full((c, 1), np.inf)
+    zp = np.concatenate([inf * -1, z, inf], 1)
+    left = z - np.take_along_axis(zp, start, 1)
+    right = np.take_along_axis(zp, stop + 1, 1) - z
+
+    # Positions of the nearest neighbours of untied values: the tied values on the nearest side(s).
+    lo = np.where(left <= right, np.take_along_axis(start, np.maximum(start - 1, 0), 1), start)
+    hi = np.where(right <= left, np.take_along_axis(stop, np.minimum(stop, n - 1), 1), stop)
+
+    tied = stop - start > 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(tied, same(start, stop), same(lo, hi)) / (np.where(tied, stop - start, hi - lo) - 1.)
+    return frac.mean(1)
+
+
+def _friedman_rafsky_1d(x, y):
+    """Friedman-Rafsky metric of univariate samples, for which the minimum spanning tree links the successive
+    sorted values.
+
+    Equal values are linked by zero length edges forming any spanning tree of them, and successive distinct
+    values by an edge between any of their tied values. The number of edges linking both samples is the
+    expectation over these trees, so that the order of equal values in the sorted sample does not bias the
+    metric."""
+    return _friedman_rafsky_sorted(*_merge(x, y)[:2])
+
+
+def _friedman_rafsky_sorted(z, label):
+    """Univariate Friedman-Rafsky metric from the sorted pooled values (c,n) and their reference labels."""
+    c, n = z.shape
+    start, stop = _tie_start(z), _tie_stop(z)
+
+    # Size and number of reference values of the group of equal values at each position.
+    cx = np.concatenate([np.zeros((c, 1), int), np.cumsum(label, 1)], 1)
+    g = (stop - start).astype(float)
+    gx = np.take_along_axis(cx, stop, 1) - np.take_along_axis(cx, start, 1)
+    gy = g - gx
+
+    # Each of the g(g-1)/2 pairs of equal values is an edge of 2/g of their spanning trees.
+    head = start == np.arange(n)
+    within = np.where(head, 2. * gx * gy / g, 0).sum(1)
+
+    # Edge between a random value of each group and of the previous one.
+    prev = np.maximum(start - 1, 0)
+    px, pg = np.take_along_axis(gx, prev, 1), np.take_along_axis(g, prev, 1)
+    between = np.where(head & (start > 0), (gx * (pg - px) + gy * px) / (g * pg), 0).sum(1)
+
+    diff = within + between
+    return 1. - (1. + diff) / n
+
+
+def _kolmogorov_smirnov_1d(x, y):
+    """Kolmogorov-Smirnov metric of univariate samples, from the cumulative counts of each sample along the
+    sorted pooled sample."""
+    z, label, _ = _merge(x, y)
+    nx = len(x.x)
+    ny = z.shape[1] - nx
+
+    # Number of values of each sample strictly below each pooled value.
+    start = _tie_start(z)
+    cx = np.take_along_axis(np.cumsum(label, 1) - label, start, 1)
+    cy = np.take_along_axis(np.cumsum(~label, 1) - ~label, start, 1)
+    return np.abs(cx / nx - cy / ny).max(1)
+
+
+def _skezely_rizzo_1d(x, y):
+    """Szekely-Rizzo metric of univariate samples, from the cumulative sums of the sorted samples."""
+    nx = len(x.x)
+    y = y.reshape(len(y), -1)
+    ny = y.shape[1]
+    w = 1. / np.sqrt(x.std[0] * y.std(1, ddof=1, dtype=np.float64))
+
+    z, label, _ = _merge(x, y)
+    ys = np.sort(y, axis=1)
+    xs = x._cached('sorted', lambda: np.sort(x.x[:, 0]))
+    sx = x._cached('distsum', lambda: _sorted_dist_sum(xs))
+    sy = (ys * (2 * np.arange(ny) - ny + 1)).sum(1, dtype=np.float64)
+
+    # Distances from each x to all y, using the y values below and above x.
+    cs = np.concatenate([np.zeros((len(y), 1)), np.cumsum(ys, 1, dtype=np.float64)], 1)
+    i = (np.cumsum(~label, 1) - ~label)[label].reshape(len(y), nx)
+    sxy = (xs * (2 * i - ny) - 2 * np.take_along_axis(cs, i, 1) + cs[:, -1:]).sum(1)
+
+    zz = 2. * sxy / (nx * ny) - 2. * sx / nx ** 2 - 2. * sy / ny ** 2
+    return zz * w * nx * ny / (nx + ny)
+
+
+def _kldiv_1d(x, y, k=1, eps=0):
+    """Kullback-Leibler divergence of univariate samples. The kth nearest candidate values of each reference
+    value are among the k values on each side of it in the sorted candidate sample, so the KD-tree search is
+    replaced by a search in a window of 2k values. The search is exact, and `eps` is ignored."""
+    mk = np.iterable(k)
+    ka = np.atleast_1d(k)
+    kmax = max(ka)
+
+    nx = len(x.x)
+    y = y.reshape(len(y), -1)
+    ny = y.shape[1]
+    if nx < 5 or ny < 5:
+        out = np.full((len(ka), len(y)), np.nan)
+        return out if mk else out[0]
+
+    z, label, order = _merge(x, y)
+    ys = np.sort(y, axis=1)
+
+    # Number of candidate values strictly below each reference value, and reference value indices.
+    below = (np.cumsum(~label, 1) - ~label)[label].reshape(len(y), nx)
+    xi = order[label].reshape(len(y), nx)
+    xv = z[label].reshape(len(y), nx)
+
+    # Distances to the candidate values in a window around each reference value.
+    idx = below[..., np.newaxis] + np.arange(-kmax, kmax)
+    valid = (idx >= 0) & (idx < ny)
+    yv = np.take_along_axis(ys[:, np.newaxis, :], idx.clip(0, ny - 1), 2)
+    s = np.sort(np.where(valid, np.abs(yv - xv[..., np.newaxis]), np.inf), axis=2)
+
+    r = x.knn(kmax + 1)[xi]
+    out = []
+    for ki in ka:
+        out.append(-np.log(r[..., ki] / s[..., ki - 1]).sum(1) / nx + np.log(ny / (nx - 1.)))
+
+    return out if mk else out[0]
+
+
+# Metrics that can be evaluated over a stack of candidate samples at once.
+_batch_metrics = {'seuclidean': _seuclidean_batch,
+                  'mahalanobis': _mahalanobis_batch,
+                  'hellinger': _hellinger_batch}
+
+# Metrics of univariate samples that can be evaluated over a stack of candidate samples at once.
+_univariate_metrics = {'nearest_neighbor': _nearest_neighbor_1d,
+                       'friedman_rafsky': _friedman_rafsky_1d,
+                       'kolmogorov_smirnov': _kolmogorov_smirnov_1d,
+                       'skezely_rizzo': _skezely_rizzo_1d,
+                       'kldiv': _kldiv_1d}
+
+
+# ---------------------------------------------------------------------------- #
+# -------------------------- Significance ------------------------------------ #
+# ---------------------------------------------------------------------------- #
+
+def permutation_test(x, y, dist='nearest_neighbor', permutations=199, seed=None):
+    """
+    Compute a dissimilarity metric and its significance with a permutation
+    test.
+
+    The pooled sample is randomly split into samples of the same sizes as
+    the reference and candidate samples, and the p-value is the fraction of
+    splits at least as dissimilar as the original samples. The permutations
+    are evaluated as a batch of sample labels. For metrics defined on the
+    pooled sample (nearest neighbours, minimum spanning tree, pairwise
+    distances, sums of squares), the structures computed from the pooled
+    sample are shared by all permutations, and only the labels change.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    y : ndarray (m,d)
+        Candidate sample.
+    dist : str
+        Name of the dissimilarity metric.
+    permutations : int
+        Number of random permutations.
+    seed : int or RandomState, optional
+        Seed of the random permutations.
+
+    Returns
+    -------
+    statistic : float
+        Dissimilarity metric.
+    pvalue : float
+        Probability of a dissimilarity at least as large if both samples were
+        drawn from the same distribution.
+
+    Notes
+    -----
+    The metrics standardizing the samples by their standard deviations keep
+    the scaling of the original samples for all permutations.
+    """
+    if dist not in __all__:
+        raise ValueError("`dist` should be one of {}".format(__all__))
+
+    t = prepare(x)
+    x, y = reshape_sample(t, y)
+    nx, ny = len(x), len(y)
+
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+
+    # Each row flags the points of the pooled sample assigned to the reference.
+    labels = rng.rand(permutations, nx + ny).argsort(1) < nx
+
+    with t.cell(y):
+        stat = globals()[dist](t, y)
+        func = _permutation_stats.get(dist)
+        if func is not None:
+            null = func(t, y, labels)
+        else:
+            null = _perm_generic(dist, t, y, labels)
+
+    if np.isnan(stat):
+        return stat, np.nan
+    return stat, (1. + (null >= stat).sum()) / (permutations + 1.)
+
+
+def _perm_seuclidean(t, y, labels):
+    z = np.vstack([t.x, y])
+    nx = labels[0].sum()
+    ny = len(z) - nx
+    lx = labels.astype(float)
+    sx, sx2 = lx.dot(z), lx.dot(z ** 2)
+    mx = sx / nx
+    my = (z.sum(0) - sx) / ny
+    vx = (sx2 - nx * mx ** 2) / (nx - 1)
+    return np.sqrt(((my - mx) ** 2 / vx).sum(-1))
+
+
+def _perm_sorted(t, y, labels):
+    """Sorted pooled values of univariate samples, repeated for each permutation, and the permuted labels in the
+    same order. The order of the pooled values does not depend on the permutation."""
+    pooled = np.concatenate([t.x[:, 0], y[:, 0]])
+    order = _memo(t.candidate(y), 'order', lambda: np.argsort(pooled, kind='mergesort'))
+    return np.broadcast_to(pooled[order], labels.shape), labels[:, order]
+
+
+def _perm_nearest_neighbor(t, y, labels):
+    if t.x.shape[1] == 1:
+        return _nearest_neighbor_sorted(*_perm_sorted(t, y, labels))
+    tree = _memo(t.candidate(y), 'pooled_tree', lambda: KDTree(np.vstack(standardize(t, y))))
+    _, ind = tree.query(tree.data, k=2, eps=0, p=2, n_jobs=2)
+    return (labels[:, ind[:, 0]] == labels[:, ind[:, 1]]).mean(1)
+
+
+def _perm_friedman_rafsky(t, y, labels):
+    if t.x.shape[1] == 1:
+        return _friedman_rafsky_sorted(*_perm_sorted(t, y, labels))
+    edges = _memo(t.candidate(y), 'mst', lambda: mst_edges(np.vstack([t.x, y])))
+    diff = (labels[:, edges[:, 0]] != labels[:, edges[:, 1]]).sum(1)
+    return 1. - (1. + diff) / labels.shape[1]
+
+
+def _pooled_sums(t, y, labels, func=None):
+    """Sums of the distances within the reference, within the candidate and
+    between both samples of each permutation, from the pooled distance
+    matrix. Returns None if the matrix does not fit in memory."""
+    n = labels.shape[1]
+    if n * n > t.max_pairs:
+        return None
+
+    w = 1. / np.sqrt(t.std * t.candidate_std(y))
+    dist = spatial.distance.squareform(spatial.distance.pdist(np.vstack([t.x, y]) * w))
+    if func is not None:
+        dist = func(dist + np.eye(n))
+    np.fill_diagonal(dist, 0)
+
+    lx = labels.astype(float)
+    dx = lx.dot(dist)
+    sx = (dx * lx).sum(1) / 2.
+    sxy = (dx * (1 - lx)).sum(1)
+    sy = (dist.sum() - 2 * sx - 2 * sxy) / 2.
+    return sx, sy, sxy
+
+
+def _perm_skezely_rizzo(t, y, labels):
+    sums = _pooled_sums(t, y, labels)
+    if sums is None:
+        return _perm_generic('skezely_rizzo', t, y, labels)
+    sx, sy, sxy = sums
+    nx = labels[0].sum()
+    ny = labels.shape[1] - nx
+    z = 2. * sxy / (nx * ny) - 2. * sx / nx ** 2 - 2. * sy / ny ** 2
+    return z * nx * ny / (nx + ny)
+
+
+def _perm_zech_aslan(t, y, labels):
+    sums = _pooled_sums(t, y, labels, np.log)
+    if sums is None:
+        return _perm_generic('zech_aslan', t, y, labels)
+    sx, sy, sxy = sums
+    nx = labels[0].sum()
+    ny = labels.shape[1] - nx
+    return -sx / nx / (nx - 1) - sy / ny / (ny - 1) + sxy / nx / ny
+
+
+def _perm_generic(dist, t, y, labels):
+    pooled = np.vstack([t.x, y])
+    return np.array([globals()[dist](pooled[lab], pooled[~lab]) for lab in labels])
+
+
+# Metrics whose permutations are evaluated from the pooled sample structures.
+_permutation_stats = {'seuclidean': _perm_seuclidean,
+                      'nearest_neighbor': _perm_nearest_neighbor,
+                      'friedman_rafsky': _perm_friedman_rafsky,
+                      'skezely_rizzo': _perm_skezely_rizzo,
+                      'zech_aslan': _perm_zech_aslan}
+
+
+# ---------------------------------------------------------------------------- #
+# -------------------------- Grid-wide evaluation ---------------------------- #
+# ---------------------------------------------------------------------------- #
+
+def spatial_analog(x, candidates, dist='seuclidean', blocksize=1000, min_samples=5, processes=1, mask=None,
+                   kwds=None, dtype=None):
+    """
+    Compute the dissimilarity between a reference sample and the candidate
+    samples of every grid cell.
+
+    Candidate samples are compressed in bulk by removing the time steps with
+    invalid values. Metrics supporting it are evaluated over blocks of complete
+    cells at once, the other cells are evaluated one at a time. When many
+    metrics are requested, they share the compressed candidate sample and the
+    quantities derived from it.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    candidates : ndarray (c,m,d)
+        Candidate samples for each of the `c` grid cells. NaNs and masked
+        values are removed from each sample before the comparison.
+    dist : str or sequence
+        Name of the dissimilarity metric, or sequence of names.
+    blocksize : int
+        Number of grid cells processed at once.
+    min_samples : int
+        Minimum number of valid values in a candidate sample. Cells with fewer
+        values are set to NaN.
+    processes : int
+        Number of worker processes. If larger than 1, the grid is split into
+        tiles evaluated in a process pool. The candidate samples are shared
+        with the workers through a memory-mapped file.
+    mask : ndarray (c,), optional
+        Boolean array of the cells to evaluate, for example from
+        :func:`screen`. Other cells are set to NaN.
+    kwds : dict, optional
+        Keyword arguments of the metrics, keyed by metric name, for example
+        ``{'kldiv': {'eps': 1}}``.
+    dtype : {None, np.float64, np.float32}
+        Precision of the computations, see :class:`Target`. Defaults to the
+        precision of the reference sample. In single precision, the
+        candidate samples are converted to float32 and use half the memory.
+
+    Returns
+    -------
+    ndarray (c,) or dict
+        Dissimilarity metric for each candidate sample. If `dist` is a
+        sequence, a dictionary keyed by metric name.
+    """
+    md, dists = _check_dist(dist)
+
+    x = prepare(x, dtype)
+    candidates = _candidate_cube(candidates, x)
+    nc = candidates.shape[0]
+
+    if _use_pool(processes, nc, blocksize):
+        with CandidatePool(candidates, processes) as pool:
+            return pool.spatial_analog(x, dist, blocksize, min_samples, mask, kwds)
+
+    out = _spatial_analog(x, candidates, dists, blocksize, min_samples, mask, kwds)
+    return out if md else out[dist]
+
+
+def _check_dist(dist):
+    """Return whether `dist` is a sequence of metrics, and the list of metric names."""
+    md = not isinstance(dist, str)
+    dists = list(dist) if md else [dist]
+
+    for name in dists:
+        if name not in __all__:
+            raise ValueError("`dist` should be one of {}".format(__all__))
+    return md, dists
+
+
+def _candidate_cube(candidates, x):
+    """Return the candidate samples as a masked (c,m,d) array in the precision of the Target."""
+    candidates = np.ma.masked_invalid(_as_precision(candidates, x))
+    if candidates.ndim == 2:
+        candidates = candidates[:, :, np.newaxis]
+
+    if x.x.shape[1] != candidates.shape[2]:
+        raise AttributeError("Shape mismatch")
+    return candidates
+
+
+def _spatial_analog(x, candidates, dists, blocksize, min_samples, mask, kwds):
+    """Evaluate the metrics over the masked candidate cube, serially."""
+    nc, m, d = candidates.shape
+    if mask is None:
+        mask = np.ones(nc, bool)
+    kwds = kwds or {}
+
+    out = {}
+    for name in dists:
+        out[name] = np.empty(nc)
+        out[name].fill(np.nan)
+
+    for start in range(0, nc, blocksize):
+        block = candidates[start:start + blocksize]
+        data = np.ma.getdata(block)
+
+        # Time steps where all indices are valid.
+        valid = ~np.ma.getmaskarray(block).any(-1)
+        count = valid.sum(1)
+
+        # The 5 value threshold is arbitrary.
+        todo = {}
+        for name in dists:
+            todo[name] = mask[start:start + blocksize] & (count >= min_samples)
+
+            batch = _batch_metrics.get(name)
+            if batch is None and d == 1:
+                batch = _univariate_metrics.get(name)
+            if batch is not None:
+                complete = todo[name] & (count == m)
+                if complete.any():
+                    out[name][start:start + blocksize][complete] = batch(x, data[complete], **kwds.get(name, {}))
+                    todo[name] &= ~complete
+
+        for i in np.flatnonzero(np.any(list(todo.values()), 0)):
+            y = data[i].compress(valid[i], 0)
+            with x.cell(y):
+                for name in dists:
+                    if todo[name][i]:
+                        out[name][start + i] = globals()[name](x, y, **kwds.get(name, {}))
+
+    return out
+
+
+def sliding_analog(x, candidates, windows, dist='seuclidean', blocksize=1000, min_samples=5, processes=1,
+                   kwds=None):
+    """
+    Compute the dissimilarity between a reference sample and the candidate
+    samples of every grid cell over a sequence of time windows.
+
+    The standardized Euclidean and Mahalanobis distances only depend on the
+    first two moments of the candidate samples. They are computed for all
+    windows from the cumulative sums of the candidate values and of their
+    products along time, so that each window costs a difference instead of a
+    pass over its values. The other metrics are recomputed for each window
+    with :func:`spatial_analog`, sharing the quantities computed from the
+    reference sample and, with many processes, a single :class:`CandidatePool`.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    candidates : ndarray (c,m,d)
+        Candidate samples for each of the `c` grid cells over the full period.
+    windows : sequence
+        Sequence of (start, stop) indices along the time axis of the
+        candidates.
+    dist : str or sequence
+        Name of the dissimilarity metric, or sequence of names.
+    blocksize : int
+        Number of grid cells processed at once.
+    min_samples : int
+        Minimum number of valid values in a candidate sample.
+    processes : int
+        Number of worker processes.
+    kwds : dict, optional
+        Keyword arguments of the metrics, keyed by metric name.
+
+    Returns
+    -------
+    ndarray (w,c) or dict
+        Dissimilarity metric for each window and candidate sample. If `dist`
+        is a sequence, a dictionary keyed by metric name.
+    """
+    md, dists = _check_dist(dist)
+
+    x = prepare(x)
+    candidates = _candidate_cube(candidates, x)
+    nc, m, d = candidates.shape
+
+    out = {}
+    moments = [name for name in dists if name in ('seuclidean', 'mahalanobis')]
+    if moments:
+        # Cumulative sums over the time steps where all indices are valid. Values are centred on the reference
+        # mean to limit the cancellation in the differences of the sums.
+        valid = ~np.ma.getmaskarray(candidates).any(-1)
+        data = np.where(valid[..., np.newaxis], np.ma.getdata(candidates) - x.mean, 0)
+        csum = np.zeros((nc, m + 1, d))
+        np.cumsum(data, 1, out=csum[:, 1:])
+        ccount = np.zeros((nc, m + 1), int)
+        np.cumsum(valid, 1, out=ccount[:, 1:])
+        if 'mahalanobis' in dists:
+            cprod = np.zeros((nc, m + 1, d, d))
+            np.cumsum(data[..., np.newaxis] * data[..., np.newaxis, :], 1, out=cprod[:, 1:])
+
+        for name in moments:
+            out[name] = np.empty((len(windows), nc))
+            out[name].fill(np.nan)
+
+        for i, (start, stop) in enumerate(windows):
+            count = ccount[:, stop] - ccount[:, start]
+            ok = count >= min_samples
+            # Difference between the candidate and reference means.
+            diff = (csum[ok, stop] - csum[ok, start]) / count[ok, np.newaxis]
+            if 'seuclidean' in dists:
+                out['seuclidean'][i, ok] = np.sqrt((diff ** 2 / x.var).sum(-1))
+            if 'mahalanobis' in dists:
+                n = count[ok, np.newaxis, np.newaxis]
+                scatter = cprod[ok, stop] - cprod[ok, start] - n * diff[:, :, np.newaxis] * diff[:, np.newaxis]
+                out['mahalanobis'][i, ok] = _mahalanobis_pooled(x, diff, scatter, count[ok])
+
+    others = [name for name in dists if name not in moments]
+    if others:
+        with CandidatePool(candidates, processes if nc > blocksize else 1) as pool:
+            res = [pool.spatial_analog(x, others, blocksize, min_samples, kwds=kwds, window=w) for w in windows]
+        for name in others:
+            out[name] = np.array([r[name] for r in res]).reshape(len(windows), nc)
+
+    return out if md else out[dist]
+
+
+def significance(x, candidates, dist='nearest_neighbor', permutations=199, seed=None, blocksize=1000,
+                 min_samples=5, processes=1, mask=None):
+    """
+    Compute the p-value of the dissimilarity between a reference sample and
+    the candidate samples of every grid cell with a permutation test.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    candidates : ndarray (c,m,d)
+        Candidate samples for each of the `c` grid cells.
+    dist : str
+        Name of the dissimilarity metric.
+    permutations : int
+        Number of random permutations for each cell.
+    seed : int, optional
+        Seed of the random permutations. The permutations of each cell are
+        seeded from it and the cell index, so results do not depend on the
+        number of processes.
+    blocksize : int
+        Number of grid cells processed at once.
+    min_samples : int
+        Minimum number of valid values in a candidate sample.
+    processes : int
+        Number of worker processes.
+    mask : ndarray (c,), optional
+        Boolean array of the cells to evaluate.
+
+    Returns
+    -------
+    ndarray (c,)
+        P-value of the dissimilarity metric for each candidate sample.
+
+    See Also
+    --------
+    permutation_test
+    """
+    return _significance(x, candidates, dist, permutations, seed, blocksize, min_samples, processes, mask, 0)
+
+
+def _significance(x, candidates, dist, permutations, seed, blocksize, min_samples, processes, mask, offset):
+    if dist not in __all__:
+        raise ValueError("`dist` should be one of {}".format(__all__))
+
+    x = prepare(x)
+    candidates = _candidate_cube(candidates, x)
+
+    nc = candidates.shape[0]
+    if mask is None:
+        mask = np.ones(nc, bool)
+
+    if _use_pool(processes, nc, blocksize):
+        tiles = [(start, stop, (dist, permutations, seed, blocksize, min_samples, 1, mask[start:stop], start))
+                 for (start, stop) in _tiles(nc, blocksize, processes)]
+        with CandidatePool(candidates, processes) as pool:
+            return np.concatenate(pool.map(_significance_tile, x, tiles))
+
+    out = np.empty(nc)
+    out.fill(np.nan)
+
+    for start in range(0, nc, blocksize):
+        block = candidates[start:start + blocksize]
+        data = np.ma.getdata(block)
+        valid = ~np.ma.getmaskarray(block).any(-1)
+        todo = mask[start:start + blocksize] & (valid.sum(1) >= min_samples)
+
+        for i in np.flatnonzero(todo):
+            cell = offset + start + i
+            rng = np.random.RandomState(None if seed is None else (seed, cell))
+            y = data[i].compress(valid[i], 0)
+            out[start + i] = permutation_test(x, y, dist, permutations, rng)[1]
+
+    return out
+
+
+def screen(x, candidates, fraction=None, threshold=None, min_samples=5):
+    """
+    Select the cells worth comparing with an expensive metric.
+
+    All cells are first compared using the standardized Euclidean distance
+    between the sample means, which is evaluated over blocks of cells at
+    once. Cells that are obviously dissimilar can then be skipped by
+    :func:`spatial_analog`.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    candidates : ndarray (c,m,d)
+        Candidate samples for each of the `c` grid cells.
+    fraction : float, optional
+        Fraction of the valid cells to keep, the most similar first.
+    threshold : float, optional
+        Keep the cells whose standardized Euclidean distance is below this
+        threshold.
+    min_samples : int
+        Minimum number of valid values in a candidate sample.
+
+    Returns
+    -------
+    ndarray (c,)
+        Boolean array, True for cells to evaluate.
+    """
+    se = spatial_analog(x, candidates, 'seuclidean', min_samples=min_samples)
+    return select_cells(se, fraction, threshold)
+
+
+def select_cells(se, fraction=None, threshold=None):
+    """
+    Return the cells to keep given their standardized Euclidean distance.
+
+    Parameters
+    ----------
+    se : ndarray (c,)
+        Standardized Euclidean distance of each cell, NaN for invalid cells.
+    fraction : float, optional
+        Fraction of the valid cells to keep, the most similar first.
+    threshold : float, optional
+        Keep the cells whose distance is below this threshold.
+
+    Returns
+    -------
+    ndarray (c,)
+        Boolean array, True for cells to evaluate.
+    """
+    keep = ~np.isnan(se)
+
+    if threshold is not None:
+        keep &= se <= threshold
+
+    if fraction is not None:
+        n = int(np.ceil(fraction * (~np.isnan(se)).sum()))
+        rank = np.argsort(np.where(np.isnan(se), np.inf, se), kind='mergesort')
+        best = np.zeros(len(se), bool)
+        best[rank[:n]] = True
+        keep &= best
+
+    return keep
+
+
+def best_analogs(x, candidates, k=20, dist='seuclidean', blocksize=1000, min_samples=5, processes=1, mask=None,
+                 kwds=None):
+    """
+    Return the `k` grid cells whose candidate sample is the most similar to
+    the reference sample.
+
+    The grid is evaluated in blocks and only a heap of the `k` best cells is
+    kept in memory. With many processes, the grid is evaluated in a process
+    pool as with :func:`spatial_analog`, and only the metric of each cell is
+    kept until the best cells are selected.
+
+    Parameters
+    ----------
+    x : ndarray (n,d) or Target
+        Reference sample.
+    candidates : ndarray (c,m,d)
+        Candidate samples for each of the `c` grid cells.
+    k : int
+        Number of analogs.
+    dist : str
+        Name of the dissimilarity metric.
+    blocksize : int
+        Number of grid cells processed at once.
+    min_samples : int
+        Minimum number of valid values in a candidate sample.
+    processes : int
+        Number of worker processes.
+    mask : ndarray (c,), optional
+        Boolean array of the cells to evaluate, for example from
+        :func:`screen`.
+    kwds : dict, optional
+        Keyword arguments of the metrics, keyed by metric name.
+
+    Returns
+    -------
+    index : ndarray (k,)
+        Index of the best cells, sorted from the most similar.
+    value : ndarray (k,)
+        Dissimilarity metric of the best cells.
+    """
+    x = prepare(x)
+    nc = len(candidates)
+
+    if _use_pool(processes, nc, blocksize):
+        blocks = [(0, spatial_analog(x, candidates, dist, blocksize, min_samples, processes, mask, kwds))]
+    else:
+        blocks = ((start, spatial_analog(x, candidates[start:start + blocksize], dist, blocksize, min_samples,
+                                         mask=None if mask is None else mask[start:start + blocksize], kwds=kwds))
+                  for start in range(0, nc, blocksize))
+
+    # Heap of (-value, -index) so the least similar cell is on top.
+    heap = []
+    for start, val in blocks:
+
+        # Only the k best cells of the block can enter the heap.
+        ind = np.flatnonzero(~np.isnan(val))
+        if len(ind) > k:
+            ind = ind[np.argpartition(val[ind], k - 1)[:k]]
+
+        for i in ind:
+            item = (-val[i], -(start + i))
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    heap.sort(reverse=True)
+    index = np.array([-i for _, i in heap], int)
+    value = np.array([-v for v, _ in heap])
+    return index, value
+
+
+class CandidatePool(object):
+    """
+    Process pool sharing the candidate samples of a grid with its workers.
+
+    The candidate samples are written once to a memory-mapped file and the
+    workers are started once, so that many reference samples or time windows
+    are compared with the grid without repeating either step. With a single
+    process, or within a daemonic process such as a pywps worker, the grid is
+    evaluated serially.
+
+    Parameters
+    ----------
+    candidates : ndarray (c,m,d)
+        Candidate samples for each of the `c` grid cells.
+    processes : int
+        Number of worker processes.
+
+    Examples
+    --------
+    >>> with CandidatePool(candidates, 4) as pool:
+    ...     maps = [pool.spatial_analog(x, 'kldiv') for x in targets]
+    """
+
+    def __init__(self, candidates, processes=1):
+        self.candidates = candidates
+        self.processes = processes
+        self._cubes = {}
+        self._tmp = None
+        self._pool = None
+
+    def __enter__(self):
+        if self.processes > 1 and not current_process().daemon:
+            self._tmp = tempfile.TemporaryDirectory()
+            try:
+                path = os.path.join(self._tmp.name, 'candidates.npy')
+                candidates = np.ma.masked_invalid(self.candidates)
+                dtype = candidates.dtype if candidates.dtype.kind == 'f' else np.float64
+                np.save(path, np.ma.filled(candidates.astype(dtype), np.nan))
+                self._pool = Pool(self.processes, initializer=_init_worker, initargs=(path,))
+            except Exception:
+                self.__exit__()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+        self._pool = self._tmp = None
+
+    def _cube(self, x):
+        """Masked candidate cube in the precision of the Target, prepared once."""
+        return _memo(self._cubes, x.x.dtype, lambda: _candidate_cube(self.candidates, x))
+
+    def map(self, func, x, tiles):
+        """Evaluate `func` over the (start, stop, args) tiles of the grid in the workers."""
+        return self._pool.map(_run_tile, [(func, x.x, start, stop, args) for (start, stop, args) in tiles])
+
+    def spatial_analog(self, x, dist='seuclidean', blocksize=1000, min_samples=5, mask=None, kwds=None,
+                       window=None):
+        """Compute the dissimilarity between a reference sample and the
+        candidate samples of every grid cell, see :func:`spatial_analog`.
+        `window` is an optional (start, stop) slice of the time axis of the
+        candidates."""
+        md, dists = _check_dist(dist)
+        x = prepare(x)
+        nc = len(self.candidates)
+        t0, t1 = window or (None, None)
+
+        if self._pool is None or nc <= blocksize:
+            out = _spatial_analog(x, self._cube(x)[:, t0:t1], dists, blocksize, min_samples, mask, kwds)
+            return out if md else out[dist]
+
+        if mask is None:
+            mask = np.ones(nc, bool)
+        tiles = [(start, stop, (dist, blocksize, min_samples, mask[start:stop], kwds, window))
+                 for (start, stop) in _tiles(nc, blocksize, self.processes)]
+        out = self.map(_analog_tile, x, tiles)
+
+        if not md:
+            return np.concatenate(out)
+        return {name: np.concatenate([o[name] for o in out]) for name in dists}
+
+
+# State of the pool workers, set once by `_init_worker`.
+_worker = {}
+
+
+def _init_worker(path):
+    _worker['candidates'] = np.load(path, mmap_mode='r')
+
+
+def _worker_target(x):
+    """Return the Target of the reference sample, kept between the tiles of the same reference."""
+    t = _worker.get('target')
+    if t is None or t.x.dtype != x.dtype or not np.array_equal(t.x, x):
+        t = _worker['target'] = Target(x)
+    return t
+
+
+def _analog_tile(x, start, stop, args):
+    dist, blocksize, min_samples, mask, kwds, window = args
+    t0, t1 = window or (None, None)
+    tile = _worker['candidates'][start:stop, t0:t1]
+    return spatial_analog(_worker_target(x), tile, dist, blocksize, min_samples, mask=mask, kwds=kwds)
+
+
+def _significance_tile(x, start, stop, args):
+    tile = _worker['candidates'][start:stop]
+    return _significance(_worker_target(x), tile, *args)
+
+
+def _run_tile(args):
+    func, x, start, stop, fargs = args
+    return func(x, start, stop, fargs)
+
+
+def _use_pool(processes, nc, blocksize):
+    """Return whether to evaluate the grid in a process pool. Daemonic processes, such as pywps workers, cannot
+    have children and evaluate the grid serially."""
+    return processes > 1 and nc > blocksize and not current_process().daemon
+
+
+def _tiles(nc, blocksize, processes):
+    """Split the grid into tiles that are a multiple of the block size, with a few tiles per worker to
+    balance the load."""
+    ntiles = min(4 * processes, int(np.ceil(nc / blocksize)))
+    size = int(np.ceil(nc / ntiles / blocksize)) * blocksize
+    return [(start, min(start + size, nc)) for start in range(0, nc, size)]
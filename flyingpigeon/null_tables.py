@@ -0,0 +1,151 @@
+"""
+Null distribution tables
+------------------------
+
+For standardized samples, the null distribution of the `nearest_neighbor`, `friedman_rafsky` and
+`kolmogorov_smirnov` metrics, that is their distribution when both samples are drawn from the same distribution,
+depends mainly on the sample sizes `n` and `m` and on the dimension `d`. The quantiles of these distributions are
+tabulated once by simulation (see the `flyingpigeon nulltables` command) and stored in the package data directory.
+The p-value of the dissimilarity of every cell of a spatial analog map is then interpolated from the table instead of
+being estimated with permutations.
+"""
+
+import os
+
+import numpy as np
+
+from flyingpigeon import dissimilarity as dd
+
+# Increment when the layout of the table changes.
+VERSION = 1
+
+# Metrics whose null distribution is tabulated.
+METRICS = ['nearest_neighbor', 'friedman_rafsky', 'kolmogorov_smirnov']
+
+# Default sample sizes, dimensions and probabilities of the quantiles.
+SIZES = [10, 20, 30, 50, 100, 200]
+DIMS = [1, 2, 3, 4]
+PROBS = np.concatenate([np.linspace(.01, .9, 90), [.92, .94, .95, .96, .97, .98, .99, .995, .999]])
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'data', 'null_tables.npz')
+
+
+def generate(path=DEFAULT_PATH, sizes=SIZES, dims=DIMS, samples=1000, seed=0, metrics=METRICS):
+    """Simulate the null distribution of the metrics and write the table of their quantiles.
+
+    Parameters
+    ----------
+    path : str
+      Output file path.
+    sizes : sequence
+      Sample sizes of the reference and candidate samples.
+    dims : sequence
+      Dimensions of the samples.
+    samples : int
+      Number of simulated pairs of samples for each (n, m, d).
+    seed : int
+      Seed of the random samples.
+    metrics : sequence
+      Names of the metrics.
+    """
+    rng = np.random.RandomState(seed)
+    values = np.empty((len(metrics), len(sizes), len(sizes), len(dims), len(PROBS)))
+
+    for k, d in enumerate(dims):
+        for i, n in enumerate(sizes):
+            for j, m in enumerate(sizes):
+                stats = np.empty((len(metrics), samples))
+                for s in range(samples):
+                    x = dd.Target(rng.randn(n, d))
+                    y = rng.randn(m, d)
+                    for t, name in enumerate(metrics):
+                        stats[t, s] = getattr(dd, name)(x, y)
+                values[:, i, j, k] = np.percentile(stats, PROBS * 100, axis=1).T
+
+    np.savez_compressed(path, version=VERSION, metrics=metrics, sizes=sizes, dims=dims, probs=PROBS,
+                        values=values, samples=samples)
+    return path
+
+
+class NullTable(object):
+    """Quantiles of the null distribution of the metrics, as written by :func:`generate`."""
+    def __init__(self, path=DEFAULT_PATH):
+        with np.load(path) as data:
+            if int(data['version']) != VERSION:
+                raise ValueError("Null table version {} is not supported.".format(int(data['version'])))
+            self.metrics = list(data['metrics'])
+            self.sizes = data['sizes']
+            self.dims = list(data['dims'])
+            self.probs = data['probs']
+            self.values = data['values']
+
+    def covers(self, dist, d):
+        """Return whether the null distribution of metric `dist` is tabulated for dimension `d`."""
+        return dist in self.metrics and d in self.dims
+
+    def quantiles(self, dist, n, m, d):
+        """Return the quantiles of the null distribution for sample sizes `n` and `m`, bilinearly interpolated in
+        the logarithm of the sample sizes. Sizes outside the table are clipped to its range.
+
+        Parameters
+        ----------
+        dist : str
+          Name of the metric.
+        n : int
+          Size of the reference sample.
+        m : array_like (c,)
+          Size of the candidate samples.
+        d : int
+          Dimension of the samples.
+
+        Returns
+        -------
+        ndarray (c, q)
+          Quantiles at probabilities `probs` for each candidate sample size.
+        """
+        if dist not in self.metrics:
+            raise ValueError("No null table for `{}`.".format(dist))
+        if d not in self.dims:
+            raise ValueError("No null table for dimension {}.".format(d))
+
+        table = self.values[self.metrics.index(dist), :, :, self.dims.index(d)]
+        grid = np.log(self.sizes)
+
+        def weights(size):
+            v = np.clip(np.log(np.maximum(size, 1)), grid[0], grid[-1])
+            i = np.clip(np.searchsorted(grid, v, side='right') - 1, 0, len(grid) - 2)
+            return i, (v - grid[i]) / (grid[i + 1] - grid[i])
+
+        i, wi = weights(np.float64(n))
+        j, wj = weights(np.atleast_1d(m).astype(float))
+        wj = wj[:, np.newaxis]
+        return (1 - wi) * ((1 - wj) * table[i, j] + wj * table[i, j + 1]) \
+            + wi * ((1 - wj) * table[i + 1, j] + wj * table[i + 1, j + 1])
+
+    def pvalue(self, dist, stat, n, m, d):
+        """Return the p-value of the dissimilarities `stat` of candidate samples of sizes `m`.
+
+        P-values beyond the tabulated probabilities are clipped, so the smallest p-value is 1 - max(probs).
+        """
+        stat = np.atleast_1d(stat)
+        q = np.maximum.accumulate(self.quantiles(dist, n, np.broadcast_to(m, stat.shape), d), axis=1)
+
+        # Linear interpolation of the cumulative probability of each statistic in its quantiles.
+        k = np.clip((q <= stat[:, np.newaxis]).sum(1), 1, len(self.probs) - 1)
+        rows = np.arange(len(stat))
+        q0, q1 = q[rows, k - 1], q[rows, k]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.clip(np.where(q1 > q0, (stat - q0) / (q1 - q0), 1.), 0, 1)
+        out = 1 - (self.probs[k - 1] + frac * (self.probs[k] - self.probs[k - 1]))
+        out[np.isnan(stat)] = np.nan
+        return out
+
+
+_tables = {}
+
+
+def get_table(path=DEFAULT_PATH):
+    """Return the null table stored at `path`, loading it once per process."""
+    if path not in _tables:
+        _tables[path] = NullTable(path)
+    return _tables[path]
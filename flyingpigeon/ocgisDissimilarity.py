@@ -1,10 +1,15 @@
 from flyingpigeon import dissimilarity as dd
+from flyingpigeon import null_tables
+from collections import OrderedDict
+import logging
 import numpy as np
-from ocgis.util.helpers import iter_array
+from scipy.spatial import cKDTree
 from ocgis.calc.base import AbstractParameterizedFunction, AbstractFieldFunction
 from ocgis.collection.field import Field
 from ocgis.constants import NAME_DIMENSION_TEMPORAL
 
+LOGGER = logging.getLogger("PYWPS")
+
 metrics = dd.__all__
 
 # NOTE: This code builds on ocgis branch v-2.0.0.dev1
@@ -20,11 +25,14 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
     standard_name = 'dissimilarity_metric'
     description = 'Metric evaluating the dissimilarity between two ' \
                   'multivariate samples'
-    parms_definition = {'dist': str, 'target': Field, 'candidate': tuple}
+    parms_definition = {'dist': str, 'target': Field, 'candidate': tuple, 'processes': int,
+                        'prune': float, 'threshold': float, 'eps': float, 'permutations': int,
+                        'null_table': bool, 'precision': str}
     required_variables = ['candidate', 'target']
     _potential_dist = metrics
 
-    def calculate(self, target=None, candidate=None, dist='seuclidean'):
+    def calculate(self, target=None, candidate=None, dist='seuclidean', processes=1, prune=None,
+                  threshold=None, eps=0, permutations=0, null_table=False, precision='float64'):
         """
 
         Parameters
@@ -35,25 +43,64 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         candidate : tuple
             Sequence of variable names identifying climate indices on which
             the comparison will be performed.
-        dist : {'seuclidean', 'nearest_neighbor', 'zech_aslan',
-           'kolmogorov_smirnov', 'friedman_rafsky', 'kldiv'}
-            Name of the distance measure, or dissimilarity metric.
+        dist : {'seuclidean', 'mahalanobis', 'nearest_neighbor', 'zech_aslan', 'skezely_rizzo',
+           'kolmogorov_smirnov', 'friedman_rafsky', 'kldiv', 'hellinger'}
+            Name of the distance measure, or dissimilarity metric. Many metrics
+            can be computed in a single pass by separating their names with
+            commas.
+        processes : int
+            Number of worker processes evaluating tiles of the grid.
+        prune : float
+            If set, all cells are first screened with the standardized
+            Euclidean distance and the metric is only computed for this
+            fraction of the cells, the most similar first.
+        threshold : float
+            If set, the metric is only computed for cells whose standardized
+            Euclidean distance is below this threshold.
+        eps : float
+            Relative tolerance of the approximate nearest neighbour search of
+            the `kldiv` metric. Defaults to 0, an exact search. See
+            :func:`flyingpigeon.dissimilarity.kldiv` for the accuracy and
+            speed tradeoff.
+        permutations : int
+            If larger than 0, the significance of the dissimilarity of each
+            cell is estimated with this number of random permutations.
+        null_table : bool
+            If True, the p-values of the metrics with a tabulated null
+            distribution (see :mod:`flyingpigeon.null_tables`) are
+            interpolated from the table instead. For dimensions outside the
+            table, they are estimated with `permutations` if set, and are
+            NaN otherwise.
+        precision : {'float64', 'float32'}
+            Precision of the candidate values and of the distance
+            computations. Sums and moments are accumulated in double
+            precision in both cases.
+
+        Notes
+        -----
+        A single metric is stored in the `dissimilarity` variable. With many
+        metrics, each one is stored in a `dissimilarity_<dist>` variable.
+        P-values are similarly stored in `pvalue` or `pvalue_<dist>`
+        variables, for the metrics whose significance is requested.
+
+        When screening, cells that are not evaluated are set to NaN and
+        flagged by the `pruned` variable.
         """
-        if dist not in self._potential_dist:
-            raise ValueError("`dist` should be one of {}".format(self._potential_dist))
+        dists = dist.split(',')
+        for name in dists:
+            if name not in self._potential_dist:
+                raise ValueError("`dist` should be one of {}".format(self._potential_dist))
 
-        # Get the function from the module.
-        metric = getattr(dd, dist)
+        if precision not in ['float64', 'float32']:
+            raise ValueError("`precision` should be one of ['float64', 'float32']")
+        dtype = np.dtype(precision)
 
         for var in candidate:
             if var not in target.keys():
                 raise ValueError("{} not in candidate Field.".format(var))
 
         # Build the (n,d) array for the target sample.
-        ref = np.array([target[c].get_value().squeeze() for c in candidate]).T
-
-        if ref.ndim != 2:
-            raise ValueError("`ref` array should be two-dimensional.")
+        ref = get_sample(target, candidate)
 
         # Create the fill variable based on the first candidate variable.
         variable = self.field[candidate[0]]
@@ -61,45 +108,168 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         time_axis = crosswalk.index(NAME_DIMENSION_TEMPORAL)
         fill_dimensions = list(variable.dimensions)
         fill_dimensions.pop(time_axis)
-        fill = self.get_fill_variable(variable,
-                                      'dissimilarity', fill_dimensions,
-                                      self.file_only,
-                                      add_repeat_record_archetype_name=True)
-        fill.units = ''
+
         # ================== #
         # Metric computation #
         # ================== #
 
-        # Iterator over every dimension except time
-        itr = iter_array(fill)
+        # Read the candidate values once into a (cells, time, indices) array.
+        cube = get_cube(self.field, candidate, time_axis)
+        if dtype == np.float32:
+            cube = cube.astype(dtype, copy=False)
 
-        arr = self.get_variable_value(fill)
-        for ind in itr:
+        target = dd.Target(ref, dtype)
+        if prune is None and threshold is None:
+            mask = None
+        else:
+            mask = dd.screen(target, cube, fraction=prune, threshold=threshold)
 
-            # Build target array
-            dind = list(ind)
-            dind.insert(time_axis, slice(None))
-            data = np.array([self.field[c][dind].get_value().squeeze() for c in
-                             candidate])
+        kwds = {'kldiv': {'eps': eps}} if eps else None
+        values = dissimilarity_maps(target, cube, dists, processes, mask, kwds, permutations, null_table)
 
-            p = np.ma.masked_invalid(data).T
+        fills = []
+        for fill_name, value in values.items():
+            fill = self.get_fill_variable(variable,
+                                          fill_name, fill_dimensions,
+                                          self.file_only,
+                                          add_repeat_record_archetype_name=True)
+            fill.units = ''
+            fills.append(fill)
 
-            # Compress masked values from target array.
-            pc = p.compress(~p.mask.any(1), 0)
+            arr = self.get_variable_value(fill)
+            arr.data[...] = value.reshape(arr.shape)
 
-            # Compute the actual metric value. The 5 value threshold is
-            # arbitrary.
-            if pc.shape[0] >= 5:
-                arr.data[ind] = metric(ref, pc)
-            else:
-                arr.data[ind] = np.nan
+            # Add the output variable to calculations variable collection. This
+            # is what is returned by the execute() call.
+            self.vc.add_variable(fill)
 
-        # Add the output variable to calculations variable collection. This
-        # is what is returned by the execute() call.
-        self.vc.add_variable(fill)
+        if mask is not None:
+            pruned = self.get_fill_variable(variable, 'pruned', fill_dimensions, self.file_only,
+                                            add_repeat_record_archetype_name=True)
+            pruned.units = ''
+            self.get_variable_value(pruned).data[...] = (~mask).reshape(arr.shape)
+            self.vc.add_variable(pruned)
 
         # Create a well-formed climatology time variable for the full time extent (with bounds).
         tgv = self.field.time.get_grouping('all')
         # Replaces the time value on the field.
         self.field.set_time(tgv)
-        fill.units = ''
+        for fill in fills:
+            fill.units = ''
+
+
+def dissimilarity_maps(target, cube, dists, processes=1, mask=None, kwds=None, permutations=0, null_table=False):
+    """Return the dissimilarity metrics of every cell and their p-values, keyed by output variable name.
+
+    Parameters
+    ----------
+    target : Target
+        Reference sample.
+    cube : ndarray (c,m,d)
+        Candidate samples of every cell.
+    dists : sequence
+        Names of the dissimilarity metrics.
+    processes : int
+        Number of worker processes.
+    mask : ndarray (c,), optional
+        Boolean array of the cells to evaluate.
+    kwds : dict, optional
+        Keyword arguments of the metrics, keyed by metric name.
+    permutations : int
+        If larger than 0, the number of random permutations estimating the p-values.
+    null_table : bool
+        If True, interpolate the p-values from the null tables when they cover the metric and dimension.
+
+    Notes
+    -----
+    See :meth:`Dissimilarity.calculate` for the names of the variables.
+    """
+    d = target.x.shape[1]
+
+    # Metrics whose p-value is interpolated from the null tables or computed with permutations.
+    table = null_tables.get_table() if null_table else None
+    tabulated = [name for name in dists if table is not None and table.covers(name, d)]
+    permuted = [name for name in dists if name not in tabulated and permutations > 0]
+
+    # Metrics with a null table, but not for this dimension.
+    untabulated = [name for name in dists if null_table and name in null_tables.METRICS and name not in tabulated]
+    missing = [name for name in untabulated if name not in permuted]
+    if untabulated:
+        LOGGER.warning("No null table for {} indices: the p-values of {} are {}.".format(
+            d, ", ".join(untabulated), "estimated with permutations" if permutations > 0 else "NaN"))
+
+    stats = dd.spatial_analog(target, cube, dists, processes=processes, mask=mask, kwds=kwds)
+    pvalues = {}
+    if tabulated:
+        count = (~np.ma.getmaskarray(np.ma.masked_invalid(cube)).any(-1)).sum(1)
+        pvalues.update({name: table.pvalue(name, stats[name], len(target.x), count, d) for name in tabulated})
+    pvalues.update({name: dd.significance(target, cube, name, permutations, processes=processes, mask=mask)
+                    for name in permuted})
+    pvalues.update({name: np.full(len(cube), np.nan) for name in missing})
+
+    out = OrderedDict()
+    for prefix, names, values in [('dissimilarity', dists, stats), ('pvalue', tabulated + permuted + missing, pvalues)]:
+        for name in names:
+            out[prefix if len(dists) == 1 else prefix + '_' + name] = values[name]
+    return out
+
+
+def get_sample(field, candidate):
+    """Return the (n,d) target sample of the given indices from a single-location field."""
+    ref = np.array([field[c].get_value().squeeze() for c in candidate]).T
+
+    if ref.ndim != 2:
+        raise ValueError("`ref` array should be two-dimensional.")
+    return ref
+
+
+def get_cube(field, candidate, time_axis=None):
+    """Read the values of the given indices into a (cells, time, indices) array.
+
+    Parameters
+    ----------
+    field : ocgis Field
+        Candidate field.
+    candidate : sequence
+        Names of the climate indices.
+    time_axis : int
+        Position of the time dimension in the index variables. Guessed from the
+        field time dimension if not given.
+    """
+    if time_axis is None:
+        time_axis = field[candidate[0]].dimension_names.index(field.time.dimensions[0].name)
+
+    cube = np.stack([np.moveaxis(field[c].get_value(), time_axis, -1)
+                     for c in candidate], -1)
+    return cube.reshape(-1, *cube.shape[-2:])
+
+
+def get_coordinates(field):
+    """Return the x (longitude) and y (latitude) coordinates of each grid cell, in the order of the cells
+    returned by `get_cube`."""
+    x = field.grid.x.get_value()
+    y = field.grid.y.get_value()
+    if x.ndim == 1:
+        x, y = np.meshgrid(x, y)
+    return x.ravel(), y.ravel()
+
+
+def nearest_cells(field, lon, lat):
+    """Return the index, in the order of the cells returned by `get_cube`, of the grid cell nearest to each
+    (lon, lat) location.
+
+    On grids spanning at most 360 degrees of longitude, the longitudes are periodic: a location at -72 is matched
+    to the cells at 288 on a 0 to 360 grid.
+    """
+    x, y = get_coordinates(field)
+    lon = np.atleast_1d(lon).astype(float)
+    lat = np.atleast_1d(lat).astype(float)
+    tree = cKDTree(np.column_stack([x, y]))
+    if x.max() - x.min() > 360:
+        return tree.query(np.column_stack([lon, lat]))[1]
+
+    # Query the location wrapped into the grid range and its image one period to the west, then keep the nearest.
+    lon = (lon - x.min()) % 360 + x.min()
+    dist, index = tree.query(np.column_stack([lon, lat]))
+    wdist, windex = tree.query(np.column_stack([lon - 360, lat]))
+    return np.where(wdist < dist, windex, index)
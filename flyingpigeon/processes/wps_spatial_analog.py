@@ -4,32 +4,45 @@ Process for spatial analog calculations.
 Author: David Huard (huard.david@ouranos.ca),
 """
 
+import csv
+import json
 import logging
 import datetime as dt
+import os
 
 import netCDF4 as nc
+import numpy as np
 import ocgis
 
 from ocgis import FunctionRegistry, RequestDataset, OcgOperations
 from pywps import ComplexInput, ComplexOutput
-from pywps import Format
+from pywps import Format, FORMATS
 from pywps import LiteralInput
 from pywps import Process
 from pywps.app.Common import Metadata
 from pywps.ext_autodoc import MetadataUrl
 from shapely.geometry import Point
 
+from flyingpigeon.analog_index import get_index
+from flyingpigeon.config import analog_index, analog_index_age, analog_index_size, analog_processes, Paths
 from flyingpigeon.ocg_utils import call
 from flyingpigeon.utils import extract_archive
 # from flyingpigeon.utils import rename_complexinputs
 # from flyingpigeon.log import init_process_logger
 
+from flyingpigeon import dissimilarity as dd
 from flyingpigeon.ocgisDissimilarity import Dissimilarity, metrics
+from flyingpigeon.ocgisDissimilarity import dissimilarity_maps, get_cube, get_sample, nearest_cells
+import flyingpigeon as fp
 
 LOGGER = logging.getLogger("PYWPS")
+paths = Paths(fp)
 
 FunctionRegistry.append(Dissimilarity)
 
+# FORMATS has no CSV entry in pywps 4.2.
+CSV = Format('text/csv', extension='.csv')
+
 
 class SpatialAnalogProcess(Process):
     def __init__(self):
@@ -60,10 +73,12 @@ class SpatialAnalogProcess(Process):
                          ]),
 
             LiteralInput('location', 'Target coordinates (lon,lat)',
-                         abstract="Geographical coordinates (lon,lat) of the target location.",
+                         abstract="Geographical coordinates (lon,lat) of the target location. With many "
+                                  "locations, the candidate dataset is read once and the dissimilarity maps "
+                                  "are stacked along a `target` dimension.",
                          data_type='string',
                          min_occurs=1,
-                         max_occurs=1,
+                         max_occurs=500,
                          ),
 
             LiteralInput('indices', 'Indices',
@@ -74,14 +89,91 @@ class SpatialAnalogProcess(Process):
                          ),
 
             LiteralInput('dist', "Distance",
-                         abstract="Dissimilarity metric comparing distributions.",
+                         abstract="Dissimilarity metric comparing distributions. Many metrics can be computed "
+                                  "in a single pass, each one stored in a `dissimilarity_<dist>` variable.",
                          data_type='string',
                          min_occurs=0,
-                         max_occurs=1,
+                         max_occurs=len(metrics),
                          default='kldiv',
                          allowed_values=metrics,
                          ),
 
+            LiteralInput('eps', 'Nearest neighbour tolerance',
+                         abstract="Relative tolerance of the approximate nearest neighbour search used by the "
+                                  "`kldiv` metric. Larger values are faster with many indices but less accurate. "
+                                  "Defaults to 0, an exact search.",
+                         data_type='float',
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('permutations', 'Number of permutations',
+                         abstract="If set, the significance of the dissimilarity of each cell is estimated with "
+                                  "this number of random permutations of the pooled samples, and stored in the "
+                                  "`pvalue` output variable. Only supported with a single location, "
+                                  "without `top_k` or `window`.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('null_table', 'Tabulated significance',
+                         abstract="If True, the significance of the nearest_neighbor, friedman_rafsky and "
+                                  "kolmogorov_smirnov metrics is interpolated from precomputed tables of their null "
+                                  "distribution, at almost no cost, instead of being estimated with permutations. "
+                                  "Only supported with a single location, without `top_k` or `window`.",
+                         data_type='boolean',
+                         min_occurs=0,
+                         max_occurs=1,
+                         default=False,
+                         ),
+
+            LiteralInput('precision', 'Precision',
+                         abstract="Precision of the candidate values and of the distance computations. Single "
+                                  "precision halves the memory used by the candidate values.",
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=1,
+                         default='float64',
+                         allowed_values=['float64', 'float32'],
+                         ),
+
+            LiteralInput('prune', 'Screening fraction',
+                         abstract="Fraction of the candidate cells on which the dissimilarity metric is computed. "
+                                  "All cells are first screened with the standardized Euclidean distance, "
+                                  "and only the most similar are compared with the selected metric. "
+                                  "Other cells are flagged in the `pruned` output variable. "
+                                  "Defaults to all cells. Not supported with `window`.",
+                         data_type='float',
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('top_k', 'Number of best analogs',
+                         abstract="If set, only the given number of most similar candidate cells are returned, "
+                                  "ranked in a table, instead of the dissimilarity over the entire grid. "
+                                  "Requires a single distance, used to rank the cells.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('window', 'Moving window length',
+                         abstract="If set, the dissimilarity is computed over moving windows of this number of "
+                                  "years spanning the candidate period, and the maps are stacked along time.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('step', 'Moving window step',
+                         abstract="Number of years between the start of successive moving windows.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         default=1,
+                         ),
+
             LiteralInput('dateStartCandidate', 'Candidate start date',
                          abstract="Beginning of period (YYYY-MM-DD) for candidate data. "
                                   "Defaults to first entry.",
@@ -123,6 +215,13 @@ class SpatialAnalogProcess(Process):
                           as_reference=True,
                           supported_formats=[Format('application/x-netcdf')]
                           ),
+
+            ComplexOutput('table', 'Best analogs',
+                          abstract="Table of the best analog cells (rank, lon, lat, dissimilarity), "
+                                   "returned instead of the grid when `top_k` is set.",
+                          as_reference=True,
+                          supported_formats=[CSV, FORMATS.JSON]
+                          ),
         ]
 
         super(SpatialAnalogProcess, self).__init__(
@@ -165,14 +264,53 @@ class SpatialAnalogProcess(Process):
             target = extract_archive(
                 resources=[inpt.file for inpt in request.inputs['target']],
                 dir_output=self.workdir)
-            location = request.inputs['location'][0].data
+            locations = [el.data for el in request.inputs['location']]
+            location = locations[0]
             indices = [el.data for el in request.inputs['indices']]
-            dist = request.inputs['dist'][0].data
+            dist = [el.data for el in request.inputs['dist']]
             start_candidate = request.inputs['dateStartCandidate'][0].data
             end_candidate = request.inputs['dateEndCandidate'][0].data
             start_target = request.inputs['dateStartTarget'][0].data
             end_target = request.inputs['dateEndTarget'][0].data
             point = Point(*map(float, location.split(',')))
+            if 'prune' in request.inputs:
+                prune = request.inputs['prune'][0].data
+            else:
+                prune = None
+            if 'top_k' in request.inputs:
+                top_k = request.inputs['top_k'][0].data
+            else:
+                top_k = None
+            if 'eps' in request.inputs:
+                eps = request.inputs['eps'][0].data
+            else:
+                eps = 0
+            metric_kwds = {'kldiv': {'eps': eps}} if eps else None
+            if 'permutations' in request.inputs:
+                permutations = request.inputs['permutations'][0].data
+            else:
+                permutations = 0
+            null_table = 'null_table' in request.inputs and request.inputs['null_table'][0].data
+            if 'precision' in request.inputs:
+                precision = request.inputs['precision'][0].data
+            else:
+                precision = 'float64'
+            if 'window' in request.inputs:
+                window = request.inputs['window'][0].data
+                step = request.inputs['step'][0].data
+            else:
+                window = None
+            if top_k is not None and len(locations) > 1:
+                raise ValueError("`top_k` is only supported with a single location.")
+            if top_k is not None and len(dist) > 1:
+                raise ValueError("`top_k` ranks the cells with a single `dist`, got {}.".format(", ".join(dist)))
+            if window is not None and (top_k is not None or len(locations) > 1):
+                raise ValueError("`window` is only supported with a single location and without `top_k`.")
+            if window is not None and prune is not None:
+                raise ValueError("`prune` is not supported with `window`.")
+            if (permutations or null_table) and (top_k is not None or window is not None or len(locations) > 1):
+                raise ValueError("`permutations` and `null_table` are only supported with a single location, "
+                                 "without `top_k` or `window`.")
         except Exception as ex:
             msg = 'Failed to parse input parameter {}'.format(ex)
             LOGGER.error(msg)
@@ -183,6 +321,11 @@ class SpatialAnalogProcess(Process):
         LOGGER.debug("init took {}".format(dt.datetime.now() - tic))
         response.update_status('Processed input parameters', 3)
 
+        if len(locations) > 1:
+            return self._multi_target(request, response, candidate, target, locations, indices, dist, prune,
+                                      [start_candidate, end_candidate], [start_target, end_target], tic,
+                                      metric_kwds, precision)
+
         ######################################
         # Extract target time series
         ######################################
@@ -219,30 +362,84 @@ class SpatialAnalogProcess(Process):
         ######################################
 
         response.update_status('Computing spatial analog', 6)
+
+        if window is not None:
+            try:
+                cindex = self._candidate_index(candidate, indices, [start_candidate, end_candidate])
+                dates = nc.num2date(cindex.time, cindex.time_units, cindex.calendar)
+                windows = get_windows(dates, window, step)
+                if not windows:
+                    raise ValueError("The candidate period is shorter than the window.")
+
+                ref = dd.Target(get_sample(target_ts, indices), precision)
+                values = dd.sliding_analog(ref, cindex.samples, [(a, b) for (a, b, _, _) in windows], dist,
+                                           processes=analog_processes(), kwds=metric_kwds)
+
+                output = write_windows(os.path.join(self.workdir, 'spatial_analog.nc'), cindex, windows, values,
+                                       dist=",".join(dist),
+                                       indices=",".join(indices),
+                                       target_location=location,
+                                       window=window,
+                                       target_time_range="{},{}".format(start_target, end_target)
+                                       )
+
+            except Exception as ex:
+                msg = 'Spatial analog failed: {}'.format(ex)
+                LOGGER.exception(msg)
+                raise Exception(msg)
+
+            response.outputs['output'].file = output
+            response.update_status('Execution completed', 100)
+            LOGGER.debug("Total execution took {}".format(dt.datetime.now() - tic))
+            return response
+
+        if top_k is not None:
+            try:
+                cindex = self._candidate_index(candidate, indices, [start_candidate, end_candidate])
+                lon, lat = cindex.lon, cindex.lat
+                if len(cindex.samples) != len(lon):
+                    # Cells along extra dimensions (e.g. realizations) have no location of their own.
+                    raise ValueError("`top_k` requires candidate indices defined on the grid only, found "
+                                     "dimensions {} for {} grid cells.".format(cindex.dims, len(lon)))
+
+                ref = dd.Target(get_sample(target_ts, indices), precision)
+                mask = None if prune is None else cindex.screen(ref, fraction=prune)
+                index, value = dd.best_analogs(ref, cindex.samples, top_k, dist[0], processes=analog_processes(),
+                                               mask=mask, kwds=metric_kwds)
+                table = write_table(os.path.join(self.workdir, 'spatial_analog'), lon[index], lat[index], value,
+                                    fmt=response.outputs['table'].data_format)
+
+            except Exception as ex:
+                msg = 'Spatial analog failed: {}'.format(ex)
+                LOGGER.exception(msg)
+                raise Exception(msg)
+
+            response.outputs['table'].file = table
+            response.update_status('Execution completed', 100)
+            LOGGER.debug("Total execution took {}".format(dt.datetime.now() - tic))
+            return response
+
         try:
-            output = call(resource=candidate,
-                          calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
-                                 'kwds': {'dist': dist, 'target': target_ts,
-                                          'candidate': indices}}],
-                          time_range=[start_candidate, end_candidate],
-                          dir_output=self.workdir,
-                          )
+            # The candidate samples are read from the analog index, like the other branches.
+            cindex = self._candidate_index(candidate, indices, [start_candidate, end_candidate])
+            ref = dd.Target(get_sample(target_ts, indices), precision)
+            mask = None if prune is None else cindex.screen(ref, fraction=prune)
+            values = dissimilarity_maps(ref, cindex.samples, dist, analog_processes(), mask, metric_kwds,
+                                        permutations, null_table)
+
+            output = write_map(os.path.join(self.workdir, 'spatial_analog.nc'), cindex, values, mask,
+                               dist=",".join(dist),
+                               indices=",".join(indices),
+                               target_location=location,
+                               candidate_time_range="{},{}".format(start_candidate, end_candidate),
+                               target_time_range="{},{}".format(start_target, end_target)
+                               )
 
         except Exception as ex:
             msg = 'Spatial analog failed: {}'.format(ex)
             LOGGER.exception(msg)
             raise Exception(msg)
 
-        add_metadata(output,
-                     dist=dist,
-                     indices=",".join(indices),
-                     target_location=location,
-                     candidate_time_range="{},{}".format(start_candidate,
-                                                         end_candidate),
-                     target_time_range="{},{}".format(start_target,
-                                                      end_target)
-                     )
-
         response.update_status('Computed spatial analog', 95)
 
         response.outputs['output'].file = output
@@ -251,11 +448,238 @@ class SpatialAnalogProcess(Process):
         LOGGER.debug("Total execution took {}".format(dt.datetime.now() - tic))
         return response
 
+    def _multi_target(self, request, response, candidate, target, locations, indices, dist, prune,
+                      candidate_range, target_range, tic, metric_kwds=None, precision='float64'):
+        """Compute the dissimilarity maps of many target locations over a single read of the candidate."""
+        try:
+            lon, lat = np.array([list(map(float, loc.split(','))) for loc in locations]).T
+
+            # Extract all target samples in one nearest-cell lookup.
+            tfield = RequestDataset(target, variable=indices, time_range=target_range).get()
+            samples = get_cube(tfield, indices)[nearest_cells(tfield, lon, lat)]
+        except Exception as ex:
+            msg = 'Target extraction failed {}'.format(ex)
+            LOGGER.debug(msg)
+            raise Exception(msg)
+
+        response.update_status('Extracted target series', 5)
+
+        try:
+            cindex = self._candidate_index(candidate, indices, candidate_range)
+
+            # The candidate cube and the worker pool are prepared once for all targets.
+            values = {name: [] for name in dist}
+            with dd.CandidatePool(cindex.samples, analog_processes()) as pool:
+                for i, sample in enumerate(samples):
+                    ref = dd.Target(sample, precision)
+                    mask = None if prune is None else cindex.screen(ref, fraction=prune)
+                    out = pool.spatial_analog(ref, dist, mask=mask, kwds=metric_kwds)
+                    for name in dist:
+                        values[name].append(out[name])
+                    response.update_status('Computed spatial analog of target {}'.format(i + 1),
+                                           6 + int(88 * (i + 1) / len(samples)))
+
+            output = write_stacked(os.path.join(self.workdir, 'spatial_analog.nc'), cindex, lon, lat,
+                                   values,
+                                   dist=",".join(dist),
+                                   indices=",".join(indices),
+                                   candidate_time_range="{},{}".format(*candidate_range),
+                                   target_time_range="{},{}".format(*target_range)
+                                   )
+
+        except Exception as ex:
+            msg = 'Spatial analog failed: {}'.format(ex)
+            LOGGER.exception(msg)
+            raise Exception(msg)
+
+        response.outputs['output'].file = output
+
+        response.update_status('Execution completed', 100)
+        LOGGER.debug("Total execution took {}".format(dt.datetime.now() - tic))
+        return response
+
+    @staticmethod
+    def _candidate_index(candidate, indices, time_range):
+        """Return the analog index of the candidate files, from the server cache if enabled."""
+        if not analog_index():
+            return get_index(candidate, indices, time_range)
+        return get_index(candidate, indices, time_range, paths.cache, analog_index_size(), analog_index_age())
+
 
 def add_metadata(ncfile, **kwds):
-    """Add metadata to the dissimilarity variable."""
+    """Add metadata to the dissimilarity variables."""
     ds = nc.Dataset(ncfile, 'a')
-    v = ds.variables['dissimilarity']
-    for key, val in kwds.items():
-        v.setncattr(key, val)
+    for name, v in ds.variables.items():
+        if name.startswith('dissimilarity') or name.startswith('pvalue'):
+            for key, val in kwds.items():
+                v.setncattr(key, val)
     ds.close()
+
+
+def write_table(prefix, lon, lat, value, fmt=CSV):
+    """Write the ranked best analogs to a CSV or JSON file and return its path."""
+    rows = [{'rank': i + 1, 'lon': float(lon[i]), 'lat': float(lat[i]), 'dissimilarity': float(value[i])}
+            for i in range(len(value))]
+
+    if fmt is not None and fmt.mime_type == FORMATS.JSON.mime_type:
+        path = prefix + '.json'
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=2)
+    else:
+        path = prefix + '.csv'
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['rank', 'lon', 'lat', 'dissimilarity'])
+            writer.writeheader()
+            writer.writerows(rows)
+    return path
+
+
+def write_map(path, index, values, mask=None, **kwds):
+    """Write the dissimilarity map and p-values of a single target to a netCDF file.
+
+    Parameters
+    ----------
+    path : str
+      Output file path.
+    index : AnalogIndex
+      Candidate analog index, defining the output grid.
+    values : dict
+      Values over the candidate cells, keyed by variable name, as returned by `dissimilarity_maps`.
+    mask : array, optional
+      Cells evaluated when pruning, the others are flagged by the `pruned` variable.
+    kwds : dict
+      Attributes added to the dissimilarity and p-value variables.
+    """
+    ds = nc.Dataset(path, 'w')
+    _write_grid(ds, index)
+
+    # Climatology time spanning the candidate period.
+    if index.time is not None and len(index.time):
+        ds.createDimension('time', 1)
+        ds.createDimension('bounds', 2)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = index.time_units
+        time.calendar = index.calendar
+        time.climatology = 'climatology_bounds'
+        time[:] = (index.time[0] + index.time[-1]) / 2.
+        bnds = ds.createVariable('climatology_bounds', 'f8', ('time', 'bounds'))
+        bnds[0] = [index.time[0], index.time[-1]]
+
+    for name, value in values.items():
+        v = ds.createVariable(name, 'f8', index.dims, fill_value=np.nan)
+        v[:] = np.reshape(value, index.shape)
+        v.units = ''
+        for key, val in kwds.items():
+            v.setncattr(key, val)
+
+    if mask is not None:
+        v = ds.createVariable('pruned', 'i1', index.dims)
+        v[:] = np.reshape(~mask, index.shape)
+
+    ds.close()
+    return path
+
+
+def write_stacked(path, index, lon, lat, values, **kwds):
+    """Write the dissimilarity maps of many targets to a netCDF file, stacked along a `target` dimension.
+
+    Parameters
+    ----------
+    path : str
+      Output file path.
+    index : AnalogIndex
+      Candidate analog index, defining the output grid.
+    lon, lat : array
+      Coordinates of the targets.
+    values : dict
+      Dissimilarity of each target over the candidate cells, keyed by metric name.
+    kwds : dict
+      Attributes added to the dissimilarity variables.
+    """
+    ds = nc.Dataset(path, 'w')
+    ds.createDimension('target', len(lon))
+    _write_grid(ds, index)
+
+    for name, value, units in [('target_lon', lon, 'degrees_east'), ('target_lat', lat, 'degrees_north')]:
+        v = ds.createVariable(name, 'f8', ('target',))
+        v[:] = value
+        v.units = units
+
+    for name, value in values.items():
+        vname = 'dissimilarity' if len(values) == 1 else 'dissimilarity_' + name
+        v = ds.createVariable(vname, 'f8', ['target'] + index.dims, fill_value=np.nan)
+        v[:] = np.reshape(value, [len(lon)] + index.shape)
+        v.units = ''
+        for key, val in kwds.items():
+            v.setncattr(key, val)
+
+    ds.close()
+    return path
+
+
+def write_windows(path, index, windows, values, **kwds):
+    """Write the dissimilarity maps of moving windows to a netCDF file, stacked along time.
+
+    Parameters
+    ----------
+    path : str
+      Output file path.
+    index : AnalogIndex
+      Candidate analog index, defining the output grid.
+    windows : sequence
+      Windows as returned by `get_windows`.
+    values : dict
+      Dissimilarity of each window over the candidate cells, keyed by metric name.
+    kwds : dict
+      Attributes added to the dissimilarity variables.
+    """
+    units = 'days since 1850-01-01'
+    first = np.array([y for (_, _, y, _) in windows])
+    last = np.array([y for (_, _, _, y) in windows])
+
+    ds = nc.Dataset(path, 'w')
+    ds.createDimension('time', len(windows))
+    ds.createDimension('bnds', 2)
+    _write_grid(ds, index)
+
+    time = ds.createVariable('time', 'f8', ('time',))
+    time.units = units
+    time.calendar = 'standard'
+    time.climatology = 'climatology_bnds'
+    time[:] = nc.date2num([dt.datetime((a + b + 1) // 2, 1, 1) for a, b in zip(first, last)], units, 'standard')
+    bnds = ds.createVariable('climatology_bnds', 'f8', ('time', 'bnds'))
+    bnds[:, 0] = nc.date2num([dt.datetime(a, 1, 1) for a in first], units, 'standard')
+    bnds[:, 1] = nc.date2num([dt.datetime(b + 1, 1, 1) for b in last], units, 'standard')
+
+    for name, value in values.items():
+        vname = 'dissimilarity' if len(values) == 1 else 'dissimilarity_' + name
+        v = ds.createVariable(vname, 'f8', ['time'] + index.dims, fill_value=np.nan)
+        v[:] = np.reshape(value, [len(windows)] + index.shape)
+        v.units = ''
+        for key, val in kwds.items():
+            v.setncattr(key, val)
+
+    ds.close()
+    return path
+
+
+def get_windows(dates, window, step=1):
+    """Return the (start, stop, first year, last year) of the moving windows of `window` years over sorted dates."""
+    years = np.array([d.year for d in dates])
+    out = []
+    for year in range(years[0], years[-1] - window + 2, step):
+        start, stop = np.searchsorted(years, [year, year + window])
+        out.append((int(start), int(stop), year, year + window - 1))
+    return out
+
+
+def _write_grid(ds, index):
+    """Create the grid dimensions and coordinate variables of the analog index in a netCDF dataset."""
+    for dim, n in zip(index.dims, index.shape):
+        ds.createDimension(dim, n)
+
+    for name, (cdims, units, value) in index.coords.items():
+        v = ds.createVariable(name, 'f8', cdims)
+        v[:] = value
+        if units:
+            v.units = units
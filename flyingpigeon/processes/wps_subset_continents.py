@@ -1,14 +1,15 @@
 import logging
 
-from pywps import ComplexInput, Format, LiteralInput, Process, FORMATS
+from pywps import ComplexInput, Format, Process, FORMATS
 # from pywps import Process, LiteralInput
 from pywps.ext_autodoc import MetadataUrl
 
 from pywps.inout.outputs import MetaFile, MetaLink4
-from flyingpigeon.processes.wpsio import output, metalink
+from flyingpigeon.processes.wpsio import LazyLiteralInput, output, metalink
 
-from flyingpigeon.subset import _CONTINENTS_
-from flyingpigeon.subset import clipping
+from flyingpigeon.subset import continents
+from flyingpigeon.config import subset_processes
+from flyingpigeon.subset import clipping_each
 from flyingpigeon.utils import extract_archive
 # from flyingpigeon.utils import rename_complexinputs
 from os.path import abspath, basename
@@ -23,13 +24,11 @@ class SubsetcontinentProcess(Process):
 
     def __init__(self):
         inputs = [
-            LiteralInput('region', 'Region',
-                         data_type='string',
-                         abstract="Continent name.",
-                         min_occurs=1,
-                         max_occurs=len(_CONTINENTS_),
-                         default='Africa',
-                         allowed_values=_CONTINENTS_),  # REGION_EUROPE #COUNTRIES
+            LazyLiteralInput('region', 'Region', continents,
+                             data_type='string',
+                             abstract="Continent name.",
+                             min_occurs=1,
+                             default='Africa'),  # REGION_EUROPE #COUNTRIES
 
             ComplexInput('resource', 'Resource',
                          abstract='NetCDF Files or archive (tar/zip) containing netCDF files.',
@@ -85,16 +84,17 @@ class SubsetcontinentProcess(Process):
 
         try:
             ml = MetaLink4('subset', workdir=self.workdir)
-            for nc in ncs:
-                out = clipping(
-                    resource=nc,
-                    polygons=regions,
-                    mosaic=True,
-                    spatial_wrapping='wrap',
-                    # variable=variable,
-                    dir_output=self.workdir,
-                    # dimension_map=dimension_map,
-                )
+            outs = clipping_each(
+                ncs,
+                processes=subset_processes(),
+                polygons=regions,
+                mosaic=True,
+                spatial_wrapping='wrap',
+                # variable=variable,
+                dir_output=self.workdir,
+                # dimension_map=dimension_map,
+            )
+            for nc, out in zip(ncs, outs):
                 LOGGER.info('result: {}'.format(out[0]))
 
                 prefix = basename(nc).replace('.nc', '')
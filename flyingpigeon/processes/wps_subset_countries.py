@@ -1,11 +1,12 @@
 import logging
 
-from pywps import ComplexInput, Format, LiteralInput, Process, FORMATS
+from pywps import ComplexInput, Format, Process, FORMATS
 from pywps.ext_autodoc import MetadataUrl
 from pywps.inout.outputs import MetaFile, MetaLink4
-from flyingpigeon.processes.wpsio import output, metalink
+from flyingpigeon.processes.wpsio import LazyLiteralInput, output, metalink
 
-from flyingpigeon.subset import clipping
+from flyingpigeon.config import subset_processes
+from flyingpigeon.subset import clipping_each
 from flyingpigeon.subset import countries
 from flyingpigeon.utils import extract_archive
 # from flyingpigeon.utils import rename_complexinputs
@@ -22,16 +23,14 @@ class SubsetcountryProcess(Process):
 
     def __init__(self):
         inputs = [
-            LiteralInput('region', 'Region',
-                         data_type='string',
-                         # abstract= countries_longname(),
-                         # need to handle special non-ascii char in countries.
-                         abstract="Country code, see ISO-3166-3:\
-                          https://en.wikipedia.org/wiki/ISO_3166-1_alpha-3#Officially_assigned_code_elements",
-                         min_occurs=1,
-                         max_occurs=len(countries()),
-                         default='DEU',
-                         allowed_values=countries()),
+            LazyLiteralInput('region', 'Region', countries,
+                             data_type='string',
+                             # abstract= countries_longname(),
+                             # need to handle special non-ascii char in countries.
+                             abstract="Country code, see ISO-3166-3:\
+                              https://en.wikipedia.org/wiki/ISO_3166-1_alpha-3#Officially_assigned_code_elements",
+                             min_occurs=1,
+                             default='DEU'),
 
             ComplexInput('resource', 'Resource',
                          abstract='NetCDF Files or archive (tar/zip) containing NetCDF files.',
@@ -87,17 +86,17 @@ class SubsetcountryProcess(Process):
 
         try:
             ml = MetaLink4('subset', workdir=self.workdir)
-            for nc in ncs:
-                out = clipping(
-                    resource=nc,
-                    polygons=regions,  # self.region.getValue(),
-                    mosaic=True,
-                    spatial_wrapping='wrap',
-                    # variable=variable,
-                    dir_output=self.workdir,
-                    # dimension_map=dimension_map,
-                )
-
+            outs = clipping_each(
+                ncs,
+                processes=subset_processes(),
+                polygons=regions,  # self.region.getValue(),
+                mosaic=True,
+                spatial_wrapping='wrap',
+                # variable=variable,
+                dir_output=self.workdir,
+                # dimension_map=dimension_map,
+            )
+            for nc, out in zip(ncs, outs):
                 LOGGER.info('result: {}'.format(out[0]))
 
                 prefix = basename(nc).replace('.nc', '')
@@ -1,5 +1,44 @@
 from pywps import LiteralInput, ComplexInput, ComplexOutput
 from pywps import FORMATS
+from pywps.inout.literaltypes import make_allowedvalues
+
+
+class LazyLiteralInput(LiteralInput):
+    """Literal input whose allowed values are computed when first needed, to describe the process or validate a
+    request, rather than when the process is instantiated at import. The input accepts up to as many occurrences as
+    there are allowed values.
+
+    :param values: callable returning the allowed values.
+    """
+    def __init__(self, identifier, title, values, **kwargs):
+        # Behave as a regular input accepting any value while LiteralInput sets itself up.
+        self._values = None
+        self._allowed_values = []
+        self._max_occurs = 1
+        super(LazyLiteralInput, self).__init__(identifier, title, **kwargs)
+        self._values = values
+        self._allowed_values = None
+        self.any_value = False
+
+    @property
+    def allowed_values(self):
+        if self._allowed_values is None:
+            self._allowed_values = make_allowedvalues(self._values())
+        return self._allowed_values
+
+    @allowed_values.setter
+    def allowed_values(self, value):
+        self._allowed_values = value
+
+    @property
+    def max_occurs(self):
+        if self._values is None:
+            return self._max_occurs
+        return len(self.allowed_values)
+
+    @max_occurs.setter
+    def max_occurs(self, value):
+        self._max_occurs = value
 
 
 resource = ComplexInput('resource',
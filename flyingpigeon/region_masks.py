@@ -0,0 +1,383 @@
+"""
+Region masks
+------------
+
+Clipping a dataset to a country or continent with ocgis intersects the region polygons with every grid cell, and
+this is repeated for every request, although users clip the same grids to the same regions over and over. A
+:class:`RegionMask` stores the cells of a grid covered by a region and the fraction of each cell covered by it, as a
+sparse array of flat cell indices and weights. Masks are stored in the server cache directory, under a key built from
+a fingerprint of the grid coordinates, the shapefile and the UGIDs of the region geometries.
+
+With a mask, clipping a file reduces to reading the hyperslab of the grid enclosing the region, and masking the cells
+outside of it. No geometry operation is needed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from netCDF4 import Dataset, default_fillvals
+from ocgis import ShpCabinetIterator
+from shapely.geometry import Point, box
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+# Increment when the layout of the files or the computation of the weights changes.
+VERSION = 1
+
+
+class RegionMask(object):
+    """Cells of a grid covered by a region.
+
+    Parameters
+    ----------
+    shape : sequence
+      Shape of the (y, x) grid.
+    index : ndarray
+      Sorted flat indices of the cells intersecting the region.
+    weight : ndarray
+      Fraction of the area of each cell covered by the region. For curvilinear grids, whose cell boundaries are
+      unknown, the weight is 1 for the cells whose center is in the region.
+    """
+
+    def __init__(self, shape, index, weight):
+        self.shape = tuple(int(n) for n in shape)
+        self.index = np.asarray(index, dtype=np.int64)
+        self.weight = np.asarray(weight, dtype=np.float32)
+
+    @property
+    def mask(self):
+        """Boolean (y, x) array, True for the cells intersecting the region."""
+        out = np.zeros(self.shape, bool)
+        out.flat[self.index] = True
+        return out
+
+    @property
+    def weights(self):
+        """Dense (y, x) array of the fraction of each cell covered by the region."""
+        out = np.zeros(self.shape, np.float32)
+        out.flat[self.index] = self.weight
+        return out
+
+    @property
+    def slices(self):
+        """Slices of the smallest hyperslab of the grid holding all the cells of the region."""
+        if len(self.index) == 0:
+            return slice(0, 0), slice(0, 0)
+        j, i = np.unravel_index(self.index, self.shape)
+        return slice(j.min(), j.max() + 1), slice(i.min(), i.max() + 1)
+
+    def save(self, path):
+        """Write the mask to `path`. The file is first written to a temporary file and then moved in place."""
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        fd, tmp = tempfile.mkstemp(dir=parent, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=VERSION, shape=self.shape, index=self.index, weight=self.weight)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a mask written by :meth:`save`."""
+        with np.load(path) as data:
+            if int(data['version']) != VERSION:
+                raise ValueError("Region mask version {} is not supported.".format(int(data['version'])))
+            return cls(data['shape'], data['index'], data['weight'])
+
+
+def grid_fingerprint(lon, lat):
+    """Return a key identifying a grid from its coordinates."""
+    h = hashlib.sha1()
+    for a in [lon, lat]:
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        h.update(str(a.shape).encode('utf-8'))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def _edges(x):
+    """Return the cell edges of a 1D coordinate, half way between the cell centers."""
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 1:
+        return np.array([x[0] - .5, x[0] + .5])
+    mid = (x[1:] + x[:-1]) / 2.
+    return np.concatenate([[2 * x[0] - mid[0]], mid, [2 * x[-1] - mid[-1]]])
+
+
+def _wrap(lon):
+    """Shift longitudes to the -180 to 180 domain of the shapefiles."""
+    return (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+
+
+def cell_weights(lon, lat, geometry):
+    """Compute the fraction of each grid cell covered by a geometry.
+
+    Parameters
+    ----------
+    lon, lat : ndarray
+      Coordinates of the cell centers. 1D coordinates describe a rectilinear grid, whose cell edges are half way
+      between the centers, 2D coordinates a curvilinear grid.
+    geometry : shapely geometry
+      Region, in longitude and latitude.
+
+    Returns
+    -------
+    shape, index, weight
+      Shape of the grid, flat indices of the cells intersecting the geometry and their covered fraction.
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    pg = prep(geometry)
+    index, weight = [], []
+
+    if np.ndim(lon) == 1:
+        shape = (len(lat), len(lon))
+        xe, ye = _edges(lon), _edges(lat)
+
+        # Shift each column so that its center is in the domain of the geometry.
+        shift = _wrap(lon) - np.asarray(lon, dtype=np.float64)
+        x0 = np.minimum(xe[:-1], xe[1:]) + shift
+        x1 = np.maximum(xe[:-1], xe[1:]) + shift
+        y0, y1 = np.minimum(ye[:-1], ye[1:]), np.maximum(ye[:-1], ye[1:])
+
+        cols = np.flatnonzero((x1 >= minx) & (x0 <= maxx))
+        rows = np.flatnonzero((y1 >= miny) & (y0 <= maxy))
+        for j in rows:
+            for i in cols:
+                cell = box(x0[i], y0[j], x1[i], y1[j])
+                if pg.contains(cell):
+                    w = 1.
+                elif pg.intersects(cell):
+                    w = geometry.intersection(cell).area / cell.area
+                else:
+                    continue
+                if w > 0:
+                    index.append(j * shape[1] + i)
+                    weight.append(w)
+    else:
+        shape = np.shape(lon)
+        x, y = _wrap(lon).ravel(), np.asarray(lat, dtype=np.float64).ravel()
+        for k in np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)):
+            if pg.contains(Point(x[k], y[k])):
+                index.append(k)
+                weight.append(1.)
+
+    return shape, np.array(index, dtype=np.int64), np.array(weight, dtype=np.float32)
+
+
+def crosses_seam(lon, mask):
+    """Return whether a region crosses the edge of a global rectilinear grid, for example a country across the
+    Greenwich meridian on a 0 to 360 grid.
+
+    The region is then split between the first and last columns of the grid, and the hyperslab enclosing it spans
+    most of the grid width.
+    """
+    if np.ndim(lon) != 1 or len(mask.index) == 0:
+        return False
+    xe = _edges(lon)
+    if abs(xe[-1] - xe[0]) < 360 - 1e-6:
+        return False
+    cols = np.unique(np.unravel_index(mask.index, mask.shape)[1])
+    return cols[0] == 0 and cols[-1] == len(lon) - 1 and (np.diff(cols) > 1).any()
+
+
+def needs_wrapping(lon, spatial_wrapping=None):
+    """Return whether the ocgis `spatial_wrapping` option changes the longitude domain of a grid.
+
+    Wrapping moves longitudes above 180 to the -180 to 180 domain, unwrapping moves negative longitudes to the 0 to
+    360 domain. Clipping with a mask keeps the longitudes of the input file.
+    """
+    if spatial_wrapping == 'wrap':
+        return bool((np.asarray(lon) > 180).any())
+    if spatial_wrapping == 'unwrap':
+        return bool((np.asarray(lon) < 0).any())
+    return False
+
+
+def mask_key(lon, lat, geom, ugids, shapefile_key=None):
+    """Return the key identifying the mask of the given grid and region geometries."""
+    desc = json.dumps([VERSION, grid_fingerprint(lon, lat), geom, sorted(ugids), shapefile_key])
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+def get_region_mask(lon, lat, geom, ugids, cache=None, shapefile_key=None):
+    """Return the mask of the region made of the given geometries, computing it if it is not cached yet.
+
+    Parameters
+    ----------
+    lon, lat : ndarray
+      Coordinates of the grid cell centers.
+    geom : str
+      Name of the shapefile.
+    ugids : sequence
+      UGIDs of the region geometries in the shapefile.
+    cache : str, optional
+      Cache directory. If None, the mask is computed and not stored.
+    shapefile_key : optional
+      JSON serializable value identifying the state of the shapefile, so that editing it invalidates the masks.
+    """
+    if cache is not None:
+        path = os.path.join(cache, 'region_masks', mask_key(lon, lat, geom, ugids, shapefile_key) + '.npz')
+        if os.path.exists(path):
+            LOGGER.debug("Using region mask {}".format(path))
+            return RegionMask.load(path)
+
+    geometry = unary_union([row['geom'] for row in ShpCabinetIterator(geom, select_uid=list(ugids))])
+    mask = RegionMask(*cell_weights(lon, lat, geometry))
+
+    if cache is not None:
+        try:
+            mask.save(path)
+        except Exception as ex:
+            LOGGER.warning("Failed to store region mask {}: {}".format(path, ex))
+    return mask
+
+
+def grid_coordinates(ds, variable):
+    """Return the names of the (y, x) dimensions of a variable and the longitudes and latitudes of its cells.
+
+    The coordinates are the 1D coordinate variables of the last two dimensions of the variable, or the 2D variables
+    named by its `coordinates` attribute for curvilinear grids.
+    """
+    var = ds.variables[variable]
+    dims = var.dimensions[-2:]
+    names = getattr(var, 'coordinates', '').split()
+
+    lon = lat = None
+    for name in names + list(dims):
+        if name not in ds.variables:
+            continue
+        c = ds.variables[name]
+        units = getattr(c, 'units', '')
+        std = getattr(c, 'standard_name', '')
+        if lon is None and (std == 'longitude' or units.startswith('degree') and units.endswith('east')):
+            lon = c[:]
+        elif lat is None and (std == 'latitude' or units.startswith('degree') and units.endswith('north')):
+            lat = c[:]
+    if lon is None or lat is None:
+        raise ValueError("No longitude and latitude coordinates found for variable {}.".format(variable))
+    return dims, np.ma.getdata(lon), np.ma.getdata(lat)
+
+
+def apply_mask(resource, variable, mask, path, dims=None, chunk=100):
+    """Write the hyperslab of a netCDF file enclosing a region, with the values outside the region masked.
+
+    Variables depending on the grid dimensions are sliced to the hyperslab, the others are copied as is.
+
+    Parameters
+    ----------
+    resource : str
+      Path to the input netCDF file.
+    variable : str
+      Name of the variable to mask.
+    mask : RegionMask
+      Region mask on the grid of the variable.
+    path : str
+      Output file path.
+    dims : sequence, optional
+      Names of the (y, x) dimensions. Defaults to the last two dimensions of the variable.
+    chunk : int
+      Number of steps along the first dimension of the variable read at once.
+    """
+    return apply_masks(resource, variable, [mask], [path], dims, chunk)[0]
+
+
+def apply_masks(resource, variable, masks, paths, dims=None, chunk=100):
+    """Write the hyperslabs of a netCDF file enclosing many regions, reading the variable once.
+
+    The variable is read over the hyperslab enclosing all the regions, one chunk of steps along its first dimension
+    at a time, and each chunk is written to the output of every region. The memory used is bounded by the chunk of
+    the enclosing hyperslab, whatever the number of regions.
+
+    Parameters
+    ----------
+    resource : str
+      Path to the input netCDF file.
+    variable : str
+      Name of the variable to mask.
+    masks : sequence of RegionMask
+      Region masks on the grid of the variable. Masks must not be empty.
+    paths : sequence of str
+      Output file path for each region.
+    dims : sequence, optional
+      Names of the (y, x) dimensions. Defaults to the last two dimensions of the variable.
+    chunk : int
+      Number of steps along the first dimension of the variable read at once.
+
+    Returns
+    -------
+    list
+      Output file paths.
+    """
+    if any(len(mask.index) == 0 for mask in masks):
+        raise ValueError("Region masks must not be empty.")
+    slabs = [mask.slices for mask in masks]
+    union = [slice(min(s[k].start for s in slabs), max(s[k].stop for s in slabs)) for k in range(2)]
+
+    with Dataset(resource) as src:
+        var = src.variables[variable]
+        dims = dims or var.dimensions[-2:]
+        index = tuple(dict(zip(dims, union)).get(d, slice(None)) for d in var.dimensions)
+
+        outputs = []
+        try:
+            for mask, (sy, sx), path in zip(masks, slabs, paths):
+                dst = Dataset(path, 'w')
+                outputs.append(dst)
+                _copy_structure(src, dst, variable, dict(zip(dims, [sy, sx])))
+
+            # Position of each region hyperslab in the enclosing hyperslab.
+            local = []
+            for mask, (sy, sx) in zip(masks, slabs):
+                sub = {dims[0]: slice(sy.start - union[0].start, sy.stop - union[0].start),
+                       dims[1]: slice(sx.start - union[1].start, sx.stop - union[1].start)}
+                local.append((tuple(sub.get(d, slice(None)) for d in var.dimensions), ~mask.mask[sy, sx]))
+
+            if var.ndim == 2:
+                steps = [()]
+            else:
+                n = var.shape[0]
+                steps = [(slice(start, min(start + chunk, n)),) for start in range(0, n, chunk)]
+            for step in steps:
+                values = var[step + index[len(step):]]
+                for dst, (sub, outside) in zip(outputs, local):
+                    v = values[sub]
+                    dst.variables[variable][step or slice(None)] = \
+                        np.ma.masked_where(np.broadcast_to(outside, v.shape), v)
+        finally:
+            for dst in outputs:
+                dst.close()
+    return list(paths)
+
+
+def _copy_structure(src, dst, variable, slices):
+    """Create the dimensions and variables of `src` in `dst`, with the grid dimensions sliced, and copy the values
+    of all variables but `variable`."""
+    dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+    for name, dim in src.dimensions.items():
+        if name in slices:
+            size = len(range(*slices[name].indices(len(dim))))
+        else:
+            size = None if dim.isunlimited() else len(dim)
+        dst.createDimension(name, size)
+
+    for name, var in src.variables.items():
+        attrs = {k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'}
+        fill = getattr(var, '_FillValue', None)
+        if name == variable and fill is None:
+            fill = default_fillvals[var.dtype.str[1:]]
+        out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill, zlib=True)
+        out.setncatts(attrs)
+
+        if name == variable:
+            continue
+        if var.ndim == 0:
+            out.assignValue(var.getValue())
+        else:
+            out[:] = var[tuple(slices.get(d, slice(None)) for d in var.dimensions)]
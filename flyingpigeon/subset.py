@@ -1,9 +1,15 @@
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool, current_process
+
 from flyingpigeon.ocg_utils import call, get_variable
 from flyingpigeon.nc_utils import sort_by_filename
 from ocgis import env, ShpCabinetIterator, ShpCabinet
 
 
-from flyingpigeon.config import Paths
+from flyingpigeon.config import Paths, region_masks
 import flyingpigeon as fp
 
 import logging
@@ -17,19 +23,27 @@ def countries():
     """
     :return: a list of all country codes.
     """
-    countries = _COUNTRIES_.keys()
+    countries = region_index('countries').keys()
     # countries = ['DEU', 'FRA', 'GBR', 'ESP', 'ITA']
     # countries.sort()
     return list(countries)
 
 
+def continents():
+    """
+    :return: a list of all continent names.
+    """
+    return region_index('continents').keys()
+
+
 def countries_longname():
     """
     :return: the long name of all countries.
     """
+    index = region_index('countries')
     longname = ''
     for country in countries():
-        longname = longname + "%s : %s \n" % (country, _COUNTRIES_[country]['longname'])
+        longname = longname + "%s : %s \n" % (country, index.properties[country]['NAME_LONG'])
     return longname
 
 
@@ -77,7 +91,7 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
              calc_grouping=None, time_range=None, time_region=None,
              historical_concatination=True, prefix=None,
              spatial_wrapping='wrap', polygons=None, mosaic=False,
-             dir_output=None, memory_limit=None):
+             dir_output=None, memory_limit=None, processes=1):
     """ returns list of clipped netCDF files
 
     :param resource: list of input netCDF files
@@ -99,6 +113,9 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
            None (default)	Do not attempt a wrap or unwrap operation.
            "wrap" Wrap spherical coordinates to the -180 to 180 longitudinal domain.
            "unwrap"	Unwrap spherical coordinate to the 0 to 360 longitudinal domain.
+    :param processes: number of worker processes clipping the (dataset, polygon) pairs in parallel (default=1).
+                      Failures are logged for each pair, and the files are returned in the same order as with a
+                      single process.
 
     :returns list: path to clipped files
     """
@@ -111,10 +128,15 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
         if type(prefix) != list:
             prefix = list([prefix])
 
+    options = dict(calc=calc, calc_grouping=calc_grouping, output_format=output_format, time_range=time_range,
+                   time_region=time_region, spatial_wrapping=spatial_wrapping, memory_limit=memory_limit,
+                   dir_output=dir_output, dimension_map=dimension_map)
+
     geoms = set()
     ncs = sort_by_filename(resource, historical_concatination=historical_concatination)  # historical_concatenation=True
     geom_files = []
     if mosaic is True:
+        identified = False
         try:
             nameadd = '_'
             for polygon in polygons:
@@ -125,58 +147,264 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
             else:
                 geom = geoms.pop()
             ugids = get_ugid(polygons=polygons, geom=geom)
+            identified = True
         except Exception as ex:
             LOGGER.exception('geom identification failed {}'.format(str(ex)))
-        for i, key in enumerate(ncs.keys()):
-            try:
-                # if variable is None:
-                variable = get_variable(ncs[key])
-                LOGGER.info('variable %s detected in resource' % (variable))
-                if prefix is None:
-                    name = key + nameadd
-                else:
-                    name = prefix[i]
-                geom_file = call(resource=ncs[key], variable=variable, calc=calc, calc_grouping=calc_grouping,
-                                 output_format=output_format, prefix=name,
-                                 geom=geom, select_ugid=ugids, time_range=time_range,
-                                 time_region=time_region,
-                                 spatial_wrapping=spatial_wrapping, memory_limit=memory_limit,
-                                 dir_output=dir_output, dimension_map=dimension_map)
-                geom_files.append(geom_file)
-                LOGGER.info('ocgis mosaik clipping done for %s' % (key))
-            except Exception as ex:
-                msg = 'ocgis mosaik clipping failed for %s, %s ' % (key, ex)
-                LOGGER.exception(msg)
+
+        if identified:
+            tasks = [(key, ncs[key], prefix, i, nameadd, geom, ugids, True, options)
+                     for i, key in enumerate(ncs.keys())]
+            for done, geom_file in _pool_map(_clip_task, tasks, processes):
+                if done:
+                    geom_files.append(geom_file)
     else:
+        # Datasets clipped with region masks are read once for all the polygons.
+        masked = _multi_mask_clipping(ncs, polygons, prefix, dir_output, processes, spatial_wrapping, calc=calc,
+                                      calc_grouping=calc_grouping, time_range=time_range, time_region=time_region,
+                                      output_format=output_format, dimension_map=dimension_map)
+
+        # Output of each (polygon, dataset) pair, in order, or the index of the task clipping it.
+        results, tasks = [], []
         for i, polygon in enumerate(polygons):
             try:
                 geom = get_geom(polygon)
                 ugid = get_ugid(polygons=polygon, geom=geom)
                 for key in ncs.keys():
-                    try:
-                        # if variable is None:
-                        variable = get_variable(ncs[key])
-                        LOGGER.info('variable %s detected in resource' % (variable))
-                        if prefix is None:
-                            name = key + '_' + polygon.replace(' ', '')
-                        else:
-                            name = prefix[i]
-                        geom_file = call(resource=ncs[key], variable=variable, calc=calc, calc_grouping=calc_grouping,
-                                         output_format=output_format,
-                                         prefix=name, geom=geom, select_ugid=ugid, dir_output=dir_output,
-                                         dimension_map=dimension_map, spatial_wrapping=spatial_wrapping,
-                                         memory_limit=memory_limit, time_range=time_range, time_region=time_region,
-                                         )
-                        geom_files.append(geom_file)
-                        LOGGER.info('ocgis clipping done for %s' % (key))
-                    except Exception as ex:
-                        msg = 'ocgis clipping failed for %s: %s ' % (key, ex)
-                        LOGGER.exception(msg)
+                    if (i, key) in masked:
+                        results.append((True, masked[(i, key)]))
+                    else:
+                        results.append(len(tasks))
+                        tasks.append((key, ncs[key], prefix, i, '_' + polygon.replace(' ', ''), geom, ugid, False,
+                                      options))
             except Exception as ex:
                 LOGGER.exception('geom identification failed {}'.format(str(ex)))
+
+        clipped = _pool_map(_clip_task, tasks, processes)
+        for result in results:
+            done, geom_file = clipped[result] if isinstance(result, int) else result
+            if done:
+                geom_files.append(geom_file)
     return geom_files
 
 
+def clipping_each(resources, processes=1, **kwargs):
+    """ clips each resource separately with `clipping`, in parallel if `processes` is larger than 1
+
+    :param resources: list of input netCDF files
+    :param processes: number of worker processes
+    :param kwargs: other `clipping` arguments
+
+    :returns list: list of clipped files for each resource, in the order of the resources
+    """
+    return _pool_map(_clipping_task, [(resource, kwargs) for resource in resources], processes)
+
+
+def _clipping_task(args):
+    resource, kwargs = args
+    return clipping(resource=resource, **kwargs)
+
+
+def _clip_task(args):
+    """ clips a dataset to the geometries of a polygon or mosaic
+
+    :returns tuple: (True, path to the clipped file) or (False, None) if the clipping failed
+    """
+    key, resource, prefix, i, nameadd, geom, ugids, mosaic, options = args
+    kind = 'mosaik clipping' if mosaic else 'clipping'
+    try:
+        # if variable is None:
+        variable = get_variable(resource)
+        LOGGER.info('variable %s detected in resource' % (variable))
+        if prefix is None:
+            name = key + nameadd
+        else:
+            name = prefix[i]
+        geom_file = None
+        if mosaic:
+            geom_file = _mask_clipping(resource, variable, geom, ugids, name, options['dir_output'],
+                                       **_mask_options(options))
+        if geom_file is None:
+            geom_file = call(resource=resource, variable=variable, prefix=name, geom=geom, select_ugid=ugids,
+                             **options)
+        LOGGER.info('ocgis %s done for %s' % (kind, key))
+        return True, geom_file
+    except Exception as ex:
+        msg = 'ocgis %s failed for %s: %s ' % (kind, key, ex)
+        LOGGER.exception(msg)
+        return False, None
+
+
+def _mask_options(options):
+    """ returns the clipping options checked by `_mask_clipping` """
+    keys = ['calc', 'calc_grouping', 'time_range', 'time_region', 'output_format', 'dimension_map',
+            'spatial_wrapping']
+    return dict((k, options[k]) for k in keys)
+
+
+def _pool_map(func, tasks, processes=1):
+    """ applies `func` to each task, in a pool of at most `processes` worker processes if larger than 1
+
+    :returns list: results in the order of the tasks
+    """
+    if processes is None or processes <= 1 or len(tasks) <= 1 or current_process().daemon:
+        return [func(task) for task in tasks]
+
+    with Pool(min(processes, len(tasks))) as pool:
+        return pool.map(func, tasks, chunksize=1)
+
+
+def mask_clipping(resource, variable, geom, ugids, prefix, dir_output=None, spatial_wrapping=None):
+    """ clips a netCDF file to regions of the countries or continents shapefile using a cached region mask
+
+    The grid cells intersecting the regions are computed once per grid and set of regions and stored in the
+    cache directory (see :mod:`flyingpigeon.region_masks`). The file is then clipped to the hyperslab enclosing
+    the regions, and the values outside of them are masked, without any geometry operation.
+    Longitudes are kept in the domain of the input file.
+
+    :param resource: path to a netCDF file
+    :param variable: variable to be clipped
+    :param geom: name of the shapefile. Possible entries: 'countries', 'continents'
+    :param ugids: ugids of the region polygons
+    :param prefix: output file base name
+    :param dir_output: output directory (default= curdir)
+    :param spatial_wrapping: ocgis wrapping option the output has to comply with (see `clipping`)
+
+    :returns str: path to the clipped file, or None if the file has to be clipped by ocgis (see
+                  `multi_mask_clipping`)
+    """
+    return multi_mask_clipping(resource, variable, [(geom, ugids)], [prefix], dir_output,
+                               spatial_wrapping=spatial_wrapping)[0]
+
+
+def multi_mask_clipping(resource, variable, regions, prefixes, dir_output=None, chunk=100, spatial_wrapping=None):
+    """ clips a netCDF file to many regions using cached region masks, reading the file once
+
+    The variable is read over the hyperslab enclosing all the regions, one chunk of time steps at a time, and
+    each chunk is written to the file of every region (see `mask_clipping`).
+
+    :param resource: path to a netCDF file
+    :param variable: variable to be clipped
+    :param regions: list of (geom, ugids) tuples, one for each output file
+    :param prefixes: list of output file base names
+    :param dir_output: output directory (default= curdir)
+    :param chunk: number of time steps read at once
+    :param spatial_wrapping: ocgis wrapping option the output has to comply with (see `clipping`)
+
+    :returns list: path to the clipped file of each region, None for the regions that do not intersect the grid
+                   and for the regions that have to be clipped by ocgis: all of them if `spatial_wrapping` changes
+                   the longitude domain of the file, and the regions crossing the edge of a global grid
+    """
+    from netCDF4 import Dataset
+    from flyingpigeon.region_masks import apply_masks, crosses_seam, get_region_mask, grid_coordinates, \
+        needs_wrapping
+
+    if dir_output is None:
+        dir_output = os.path.abspath(os.curdir)
+
+    with Dataset(resource) as ds:
+        dims, lon, lat = grid_coordinates(ds, variable)
+
+    out = [None] * len(regions)
+    if needs_wrapping(lon, spatial_wrapping):
+        LOGGER.info('spatial wrapping %s changes the longitudes of %s, clipping with ocgis' %
+                    (spatial_wrapping, resource))
+        return out
+
+    masks = [get_region_mask(lon, lat, geom, ugids, cache=paths.cache, shapefile_key=_shapefile_key(geom))
+             for (geom, ugids) in regions]
+
+    keep = []
+    for i, mask in enumerate(masks):
+        if len(mask.index) == 0:
+            LOGGER.warning('no grid cell of %s intersects the region %s' % (resource, prefixes[i]))
+        elif crosses_seam(lon, mask):
+            LOGGER.info('region %s crosses the edge of the grid of %s, clipping with ocgis' % (prefixes[i], resource))
+        else:
+            keep.append(i)
+    if keep:
+        files = apply_masks(resource, variable, [masks[i] for i in keep],
+                            [os.path.join(dir_output, prefixes[i] + '.nc') for i in keep], dims, chunk)
+        for i, geom_file in zip(keep, files):
+            out[i] = geom_file
+    return out
+
+
+def _mask_resource(resource, calc=None, calc_grouping=None, time_range=None, time_region=None, output_format='nc',
+                   dimension_map=None):
+    """ returns the path of the file if region masks are enabled and the clipping options allow using them,
+    or None if the file has to be clipped by ocgis """
+    if isinstance(resource, list):
+        if len(resource) != 1:
+            return None
+        resource = resource[0]
+
+    if not region_masks() or output_format != 'nc':
+        return None
+    if any(opt is not None for opt in [calc, calc_grouping, time_range, time_region, dimension_map]):
+        return None
+    return resource
+
+
+def _mask_clipping(resource, variable, geom, ugids, prefix, dir_output, spatial_wrapping=None, **options):
+    """ returns the path of the file clipped with `mask_clipping`, or None if the file has to be clipped by ocgis """
+    resource = _mask_resource(resource, **options)
+    if resource is None or geom not in _REGION_COLUMNS_:
+        return None
+
+    try:
+        geom_file = mask_clipping(resource, variable, geom, ugids, prefix, dir_output, spatial_wrapping)
+        if geom_file is None:
+            return None
+        LOGGER.info('mask clipping done for %s' % (resource))
+        return geom_file
+    except Exception as ex:
+        LOGGER.exception('mask clipping failed for %s, clipping with ocgis: %s' % (resource, ex))
+        return None
+
+
+def _multi_mask_clipping(ncs, polygons, prefix, dir_output, processes=1, spatial_wrapping=None, **options):
+    """ clips each dataset to all the polygons with `multi_mask_clipping`
+
+    :returns dict: path of the clipped file of each (polygon index, dataset key). Missing entries have to be
+                   clipped by ocgis.
+    """
+    tasks = []
+    for key in ncs.keys():
+        resource = _mask_resource(ncs[key], **options)
+        if resource is not None:
+            tasks.append((key, ncs[key], resource, polygons, prefix, dir_output, spatial_wrapping))
+
+    out = {}
+    for result in _pool_map(_multi_mask_task, tasks, processes):
+        out.update(result)
+    return out
+
+
+def _multi_mask_task(args):
+    key, nc, resource, polygons, prefix, dir_output, spatial_wrapping = args
+    out = {}
+    try:
+        variable = get_variable(nc)
+        regions, names, index = [], [], []
+        for i, polygon in enumerate(polygons):
+            geom = get_geom(polygon)
+            if geom in _REGION_COLUMNS_:
+                regions.append((geom, get_ugid(polygons=polygon, geom=geom)))
+                names.append(key + '_' + polygon.replace(' ', '') if prefix is None else prefix[i])
+                index.append(i)
+        if not regions:
+            return out
+
+        files = multi_mask_clipping(resource, variable, regions, names, dir_output, spatial_wrapping=spatial_wrapping)
+        for i, geom_file in zip(index, files):
+            if geom_file is not None:
+                out[(i, key)] = geom_file
+        LOGGER.info('mask clipping done for %s and %s regions' % (key, len(regions)))
+    except Exception as ex:
+        LOGGER.exception('mask clipping failed for %s, clipping with ocgis: %s' % (key, ex))
+    return out
+
+
 def get_dimension_map(resource):
     """ returns the dimension map for a file, required for ocgis processing.
     file must have a DRS-conformant filename (see: utils.drs_filename())
@@ -250,7 +478,7 @@ def get_ugid(polygons=None, geom=None):
     returns geometry id of given polygon in a given shapefile.
 
     :param polygons: string or list of the region polygons
-    :param geom: available shapefile. Possible entries: '50m_country', 'NUTS2'
+    :param geom: available shapefile. Possible entries: 'countries', 'continents'
 
     :returns list: ugids used by ocgis
     """
@@ -261,28 +489,10 @@ def get_ugid(polygons=None, geom=None):
         if type(polygons) != list:
             polygons = list([polygons])
 
-        # env.DIR_SHPCABINET = shapefiles_path()
-        sc_iter = ShpCabinetIterator(geom)
-        result = []
-
-        if geom == 'countries':
-            for row in sc_iter:
-                for polygon in polygons:
-                    if row['properties']['ADM0_A3'] == polygon:
-                        result.append(row['properties']['UGID'])
-
-        # elif geom == 'extremoscope':
-        #     for row in sc_iter:
-        #         for polygon in polygons:
-        #             if row['properties']['HASC_1'] == polygon:
-        #                 result.append(row['properties']['UGID'])
-
-        elif geom == 'continents':
-            for row in sc_iter:
-                for polygon in polygons:
-                    if row['properties']['CONTINENT'] == polygon:
-                        result.append(row['properties']['UGID'])
+        if geom in _REGION_COLUMNS_:
+            result = region_index(geom).get_ugids(polygons)
         else:
+            result = []
             sc = ShpCabinet(paths.shapefiles)
             LOGGER.debug('geom: %s not found in shape cabinet. Available geoms are: %s ', geom, sc)
     return result
@@ -299,36 +509,193 @@ def get_geom(polygon=None):
     if polygon is None:
         geom = None
     else:
-        if polygon in _COUNTRIES_:  # (polygon) == 3:
+        if polygon in region_index('countries'):  # (polygon) == 3:
             geom = 'countries'
         # elif polygon in _POLYGONS_EXTREMOSCOPE_:  # len(polygon) == 5 and polygon[2] == '.':
         #     geom = 'extremoscope'
         # elif polygon in _EUREGIONS_:
         #     geom = 'extremoscope'
-        elif polygon in _CONTINENTS_:
+        elif polygon in region_index('continents'):
             geom = 'continents'
         else:
+            geom = None
             LOGGER.debug('polygon: %s not found in geoms' % polygon)
     return geom
 
 
-# === Available Polygons
-_CONTINENTS_ = get_shp_column_values(geom='continents', columnname='CONTINENT')
+# Column identifying the regions of each shapefile, and other columns kept in the region index.
+_REGION_COLUMNS_ = {'countries': 'ADM0_A3', 'continents': 'CONTINENT'}
+_REGION_PROPERTIES_ = {'countries': ['NAME_LONG', 'CONTINENT'], 'continents': []}
+
+# Increment when the layout of the region index cache changes.
+_REGION_INDEX_VERSION_ = 1
+
+_REGION_INDICES_ = {}
+
 
-_COUNTRIES_ = {}
-# _COUNTRIES_Europe_ = {}
+class RegionIndex(object):
+    """Index of the regions of a shapefile.
 
-# === populate polygon dictionaries
-ADM0_A3 = get_shp_column_values(geom='countries', columnname='ADM0_A3')
-NAMELONG = get_shp_column_values(geom='countries', columnname='NAME_LONG')
-CONTINENT = get_shp_column_values(geom='countries', columnname='CONTINENT')
+    For each region, the index holds the UGIDs and the offsets of its records in the shapefile, the bounding box
+    of its geometries and a few properties of its first record, so that region lookups do not read the shapefile.
 
-for c, key in enumerate(ADM0_A3):
-    _COUNTRIES_[key] = dict(longname=NAMELONG[c])
+    :param geom: name of the shapefile
+    :param column: column name identifying the regions
+    :param ugids: dictionary of the UGIDs of each region, in the order of the shapefile
+    :param offsets: dictionary of the record offsets of each region
+    :param bboxes: dictionary of the (minx, miny, maxx, maxy) bounding box of each region
+    :param properties: dictionary of the properties of each region
+    """
+
+    def __init__(self, geom, column, ugids, offsets, bboxes, properties):
+        self.geom = geom
+        self.column = column
+        self.ugids = ugids
+        self.offsets = offsets
+        self.bboxes = bboxes
+        self.properties = properties
+
+    @classmethod
+    def from_shapefile(cls, geom, column, columns=()):
+        """ builds the index from a single pass over the shapefile records
+
+        :param geom: name of the shapefile
+        :param column: column name identifying the regions
+        :param columns: names of the other columns kept for each region
+        """
+        ugids = OrderedDict()
+        offsets, bboxes, properties = {}, {}, {}
+
+        for offset, row in enumerate(ShpCabinetIterator(geom)):
+            key = row['properties'][column]
+            bounds = tuple(row['geom'].bounds)
+            if key not in ugids:
+                ugids[key] = []
+                offsets[key] = []
+                properties[key] = dict((c, row['properties'][c]) for c in columns)
+                bboxes[key] = bounds
+            else:
+                bboxes[key] = _union_bbox(bboxes[key], bounds)
+            ugids[key].append(row['properties']['UGID'])
+            offsets[key].append(offset)
+        return cls(geom, column, ugids, offsets, bboxes, properties)
+
+    def to_dict(self):
+        """
+        :return: the index as a JSON serializable dictionary
+        """
+        return {'geom': self.geom, 'column': self.column, 'regions': [
+            [key, ugids, self.offsets[key], self.bboxes[key], self.properties[key]]
+            for key, ugids in self.ugids.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ builds the index from the dictionary returned by `to_dict` """
+        ugids = OrderedDict()
+        offsets, bboxes, properties = {}, {}, {}
+        for key, ugid, offset, bbox, props in data['regions']:
+            ugids[key] = ugid
+            offsets[key] = offset
+            bboxes[key] = tuple(bbox)
+            properties[key] = props
+        return cls(data['geom'], data['column'], ugids, offsets, bboxes, properties)
+
+    def __contains__(self, region):
+        return region in self.ugids
+
+    def keys(self):
+        """
+        :return: a list of the regions, in the order of the shapefile.
+        """
+        return list(self.ugids.keys())
+
+    def get_ugids(self, regions):
+        """
+        :param regions: list of region names
+        :return: list of the UGIDs of the geometries of the regions
+        """
+        result = []
+        for region in regions:
+            result.extend(self.ugids.get(region, []))
+        return result
+
+    def bbox(self, regions):
+        """
+        :param regions: list of region names
+        :return: (minx, miny, maxx, maxy) bounding box of the regions, or None if none is in the index
+        """
+        result = None
+        for region in regions:
+            if region in self.bboxes:
+                result = self.bboxes[region] if result is None else _union_bbox(result, self.bboxes[region])
+        return result
+
+
+def _union_bbox(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def _shapefile_key(geom):
+    """ returns the version, modification times and sizes identifying the state of a shapefile """
+    files = []
+    for ext in ['.shp', '.shx', '.dbf']:
+        path = os.path.join(paths.shapefiles, geom + ext)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            files.append([ext, stat.st_mtime, stat.st_size])
+    return [_REGION_INDEX_VERSION_, files]
+
+
+def _load_region_index(geom):
+    """ returns the region index of a shapefile from its cache, rebuilding the cache if the shapefile changed
+
+    The cache is a JSON file stored in the `region_index` directory of the server cache, as the shapefiles are
+    usually installed in a read-only location. If it cannot be written, the index is rebuilt from the shapefile in
+    each process.
+    """
+    cache = os.path.join(paths.cache, 'region_index')
+    path = os.path.join(cache, geom + '.json')
+    key = _shapefile_key(geom)
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data['key'] == key:
+            return RegionIndex.from_dict(data)
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    LOGGER.debug('building region index of shapefile %s', geom)
+    index = RegionIndex.from_shapefile(geom, _REGION_COLUMNS_[geom], _REGION_PROPERTIES_[geom])
+
+    data = index.to_dict()
+    data['key'] = key
+    tmp = None
+    try:
+        if not os.path.exists(cache):
+            os.makedirs(cache)
+        fd, tmp = tempfile.mkstemp(dir=cache, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as ex:
+        LOGGER.debug('failed to write region index cache %s: %s', path, ex)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+def region_index(geom):
+    """ returns the region index of a shapefile, loaded once per process on first use
+
+    :param geom: name of the shapefile. Possible entries: 'countries', 'continents'
+
+    returns RegionIndex: index of the shapefile regions
+    """
+    if geom not in _REGION_INDICES_:
+        _REGION_INDICES_[geom] = _load_region_index(geom)
+    return _REGION_INDICES_[geom]
 
-# for c, key in enumerate(ADM0_A3):
-#     if CONTINENT[c] == 'Europe':
-#         _COUNTRIES_Europe_[key] = dict(longname=NAMELONG[c])
 
 # _EUREGIONS_ = {}
 #
@@ -0,0 +1,84 @@
+import os
+import time
+
+import numpy as np
+
+from flyingpigeon import dissimilarity as dd
+from flyingpigeon.analog_index import AnalogIndex, evict, index_key
+
+
+def get_index():
+    np.random.seed(2)
+    samples = np.random.randn(12, 30, 2)
+    samples[3, :5, 0] = np.nan
+    samples[7, :28] = np.nan
+    coords = {'lon': (['lon'], 'degrees_east', np.arange(4.)),
+              'lat': (['lat'], 'degrees_north', np.arange(3.))}
+    lon, lat = [a.ravel() for a in np.meshgrid(np.arange(4.), np.arange(3.))]
+    return AnalogIndex(samples, lon, lat, coords, ['lat', 'lon'], [3, 4], np.arange(30.), 'days since 2000-01-01',
+                       'standard')
+
+
+def test_save_load(tmpdir):
+    index = get_index()
+    path = str(tmpdir.join('index'))
+    index.save(path)
+    loaded = AnalogIndex.load(path)
+
+    assert isinstance(loaded.samples, np.memmap)
+    np.testing.assert_array_equal(loaded.samples, index.samples)
+    np.testing.assert_array_equal(loaded.mean, index.mean)
+    assert loaded.dims == ['lat', 'lon']
+    assert loaded.shape == [3, 4]
+    np.testing.assert_array_equal(loaded.coords['lat'][2], index.coords['lat'][2])
+    np.testing.assert_array_equal(loaded.time, index.time)
+    assert loaded.time_units == 'days since 2000-01-01'
+
+
+def test_moments():
+    index = get_index()
+    x = dd.Target(np.random.randn(40, 2))
+    np.testing.assert_allclose(index.seuclidean(x), dd.spatial_analog(x, index.samples, 'seuclidean'))
+    np.testing.assert_array_equal(index.screen(x, fraction=.5), dd.screen(x, index.samples, fraction=.5))
+
+
+def test_index_key(tmpdir):
+    f = tmpdir.join('a.nc')
+    f.write('a')
+    key = index_key([str(f)], ['meantemp'], [1970, 2000])
+    assert key == index_key([str(f)], ['meantemp'], [1970, 2000])
+    assert key != index_key([str(f)], ['meantemp'], [1971, 2000])
+
+    f.write('ab')
+    assert key != index_key([str(f)], ['meantemp'], [1970, 2000])
+
+
+def test_index_key_across_requests(tmpdir):
+    # pywps links local inputs into a new directory for each request.
+    src = tmpdir.join('data', 'a.nc')
+    src.write('a', ensure=True)
+    keys = []
+    for request in ['r1', 'r2']:
+        work = tmpdir.mkdir(request)
+        work.join('link.nc').mksymlinkto(src)
+        keys.append(index_key([str(work.join('link.nc'))], ['meantemp']))
+    assert keys[0] == keys[1]
+    assert keys[0] == index_key([str(src)], ['meantemp'])
+
+    src.write('ab')
+    assert keys[0] != index_key([str(tmpdir.join('r2', 'link.nc'))], ['meantemp'])
+
+
+def test_evict(tmpdir):
+    index = get_index()
+    now = time.time()
+    for i, key in enumerate(['a', 'b', 'c']):
+        path = str(tmpdir.join('analog_index', key))
+        index.save(path)
+        os.utime(path, (now - 10 * (3 - i), now - 10 * (3 - i)))
+    size = sum(f.size() for f in tmpdir.join('analog_index', 'a').listdir())
+
+    assert evict(str(tmpdir)) == []
+    assert evict(str(tmpdir), max_size=2 * size) == [str(tmpdir.join('analog_index', 'a'))]
+    assert evict(str(tmpdir), max_age=15) == [str(tmpdir.join('analog_index', 'b'))]
+    assert tmpdir.join('analog_index').listdir() == [tmpdir.join('analog_index', 'c')]
@@ -70,6 +70,39 @@ class TestSEuclidean():
         aaeq(dm, 2.8463, 4)
 
 
+class TestMahalanobis:
+    def test_simple(self):
+        np.random.seed(7)
+        n, m = 25, 30
+        x = np.random.multivariate_normal([0, 0], [[1, .8], [.8, 1]], n)
+        y = np.random.multivariate_normal([1, 1], [[1, .8], [.8, 1]], m)
+
+        s = ((n - 1) * np.cov(x.T) + (m - 1) * np.cov(y.T)) / (n + m - 2)
+        diff = x.mean(0) - y.mean(0)
+        aaeq(dd.mahalanobis(x, y), np.sqrt(diff.dot(np.linalg.solve(s, diff))))
+
+        # Uncorrelated univariate samples.
+        aaeq(dd.mahalanobis(x[:, 0], y[:, 0]), abs(diff[0]) / np.sqrt(s[0, 0]))
+
+    def test_singular(self):
+        np.random.seed(8)
+        x = np.random.randn(25, 2)
+        y = np.random.randn(30, 2) + 1
+        x[:, 1] = 3
+        y[:, 1] = 3
+        aaeq(dd.mahalanobis(x, y), dd.mahalanobis(x[:, 0], y[:, 0]))
+
+    def test_batch(self):
+        np.random.seed(9)
+        t = dd.Target(np.random.randn(30, 2))
+        c = np.random.randn(20, 40, 2)
+        c[0, :3] = np.nan
+        c[1, :, 1] = c[1, :, 0]
+
+        out = dd.spatial_analog(t, c, 'mahalanobis', blocksize=7)
+        aaeq(out, [dd.mahalanobis(t, ci[~np.isnan(ci).any(1)]) for ci in c])
+
+
 class TestNN():
     def test_simple(self):
         d = 2
@@ -113,6 +146,42 @@ class TestZAE():
         dm = dd.zech_aslan(x, y)
         aaeq(dm, 0.77802, 4)
 
+    def test_blocksize(self):
+        np.random.seed(3)
+        x = np.random.randn(90, 2)
+        y = np.random.randn(70, 2) + .5
+        dm = dd.zech_aslan(x, y)
+        aaeq(dd.zech_aslan(x, y, blocksize=16), dm)
+        aaeq(dd.zech_aslan(x, y, blocksize=16, dtype=np.float32), dm, 5)
+
+
+class TestSR():
+    def brute(self, x, y):
+        from scipy.spatial.distance import pdist, cdist
+        x, y = dd.reshape_sample(x, y)
+        n, m = len(x), len(y)
+        v = x.std(0, ddof=1) * y.std(0, ddof=1)
+        dx = pdist(x, 'seuclidean', V=v)
+        dy = pdist(y, 'seuclidean', V=v)
+        dxy = cdist(x, y, 'seuclidean', V=v)
+        z = 2. / (n * m) * dxy.sum() - 2. / n ** 2 * dx.sum() - 2. / m ** 2 * dy.sum()
+        return z * n * m / (n + m)
+
+    @pytest.mark.parametrize('d', [1, 3])
+    def test_against_brute(self, d):
+        np.random.seed(d)
+        x = np.random.randn(57, d)
+        y = np.random.randn(43, d) + .3
+        aaeq(dd.skezely_rizzo(x, y), self.brute(x, y))
+        aaeq(dd.skezely_rizzo(x, y, blocksize=10), self.brute(x, y))
+
+    def test_simple(self):
+        np.random.seed(1)
+        x = np.random.randn(200, 2)
+        y = np.random.randn(200, 2)
+        assert dd.skezely_rizzo(x, y) < dd.skezely_rizzo(x, y + 1)
+        aaeq(dd.skezely_rizzo(x, x), 0)
+
 
 class TestFR():
     def test_simple(self):
@@ -135,6 +204,23 @@ class TestFR():
         aaeq(dm, 0.96667, 4)
 
 
+@pytest.mark.parametrize('d', [1, 2, 3, 5])
+def test_mst_edges(d):
+    from scipy.sparse.csgraph import minimum_spanning_tree
+    from scipy.spatial.distance import pdist, squareform
+
+    np.random.seed(d)
+    x = np.random.randn(150, d)
+
+    def length(edges):
+        return np.sqrt(((x[edges[:, 0]] - x[edges[:, 1]]) ** 2).sum(1)).sum()
+
+    edges = dd.mst_edges(x)
+    assert edges.shape == (149, 2)
+    aaeq(length(edges), minimum_spanning_tree(squareform(pdist(x))).sum())
+    aaeq(length(dd._prim_edges(x)), length(edges))
+
+
 class TestKS():
     def test_1D_ks_2samp(self):
         # Compare with scipy.stats.ks_2samp
@@ -149,6 +235,13 @@ class TestKS():
         dm = dd.kolmogorov_smirnov(x, y)
         aaeq(dm, 0.96667, 4)
 
+    def test_blocksize(self):
+        np.random.seed(2)
+        x = np.random.randn(60, 3)
+        y = np.random.randn(40, 3) + .5
+        aaeq(dd.kolmogorov_smirnov(x, y, blocksize=50), dd.kolmogorov_smirnov(x, y))
+        aaeq(dd.kolmogorov_smirnov(x[:, :1], y[:, :1]), dd.kolmogorov_smirnov(x[:, :1], y[:, :1], blocksize=1))
+
 
 def analytical_KLDiv(p, q):
     """Return the Kullback-Leibler divergence between two distributions.
@@ -254,3 +347,381 @@ class TestKLDIV:
 
         aaeq(dd.kldiv(p, q), 1.39, 1)
         aaeq(dd.kldiv(q, p), 0.62, 1)
+
+    def test_approximate(self):
+        np.random.seed(3)
+        d = 12
+        x = np.random.randn(500, d)
+        y = np.random.randn(500, d) + .3
+
+        ex = dd.kldiv(x, y)
+        ap = dd.kldiv(x, y, eps=.5)
+        assert abs(ap - ex) < d * np.log(1.5)
+        aaeq(ap, ex, 1)
+
+        t = dd.Target(x)
+        aaeq(dd.spatial_analog(t, y[np.newaxis], 'kldiv', kwds={'kldiv': {'eps': .5}}), [ap])
+
+
+class TestHellinger:
+    def test_against_analytic(self):
+        np.random.seed(4)
+        n = 20000
+        # The kernel density estimates are normal with variance 1 + h**2.
+        h2 = n ** (-.4)
+        for mu in [.5, 1, 2]:
+            x = np.random.randn(n)
+            y = np.random.randn(n) + mu
+            aaeq(dd.hellinger(x, y), np.sqrt(1 - np.exp(-mu ** 2 / (8 * (1 + h2)))), 2)
+
+    def test_mvnormal(self):
+        np.random.seed(5)
+        n = 5000
+        x = np.random.randn(n, 2)
+        y = np.random.randn(n, 2) + 1
+        h2 = n ** (-1. / 3)
+        aaeq(dd.hellinger(x, y), np.sqrt(1 - np.exp(-2 / (8 * (1 + h2)))), 1)
+
+    def test_4d(self):
+        """The binned estimate matches the Hellinger distance between the exact kernel density estimates, computed
+        by importance sampling of the reference density."""
+        rng = np.random.RandomState(1)
+        n, d = 300, 4
+        for shift in [0, 1]:
+            x = rng.randn(n, d)
+            y = rng.randn(n, d) + shift
+
+            h = x.std(0, ddof=1) * n ** (-1. / (d + 4))
+            z = x[rng.randint(n, size=10000)] + h * rng.randn(10000, d)
+            p, q = [np.exp(-.5 * (((z[:, np.newaxis] - s) / h) ** 2).sum(-1)).mean(1) for s in [x, y]]
+            ex = np.sqrt(1 - np.sqrt(q / p).mean())
+            assert abs(dd.hellinger(x, y) - ex) < .02
+
+    def test_dimension_limit(self):
+        with pytest.raises(ValueError):
+            dd.hellinger(np.random.randn(30, 5), np.random.randn(30, 5))
+
+    def test_batch(self):
+        np.random.seed(6)
+        t = dd.Target(np.random.randn(30, 2))
+        c = np.random.randn(20, 40, 2) + np.linspace(0, 3, 20)[:, np.newaxis, np.newaxis]
+        c[0, :3] = np.nan
+
+        out = dd.spatial_analog(t, c, 'hellinger', blocksize=7)
+        ex = [dd.hellinger(t, ci[~np.isnan(ci).any(1)]) for ci in c]
+        aaeq(out, ex)
+        assert np.all(np.diff(out) > -.1)
+        assert 0 <= out.min() and out.max() <= 1
+
+
+class TestSpatialAnalog:
+    def test_against_loop(self):
+        np.random.seed(3)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(12, 25, 2) + np.random.rand(12, 1, 2)
+        c[2, 3, 1] = np.nan
+        c[4, :22, 0] = np.nan
+
+        for dist in ['seuclidean', 'zech_aslan']:
+            out = dd.spatial_analog(x, c, dist, blocksize=5)
+            assert np.isnan(out[4])
+
+            for i in [0, 2, 7]:
+                y = c[i][~np.isnan(c[i]).any(1)]
+                aaeq(out[i], getattr(dd, dist)(x, y))
+
+    def test_1D(self):
+        x = np.random.randn(30)
+        c = np.random.randn(4, 20)
+        out = dd.spatial_analog(x, c, 'kolmogorov_smirnov')
+        aaeq(out[1], dd.kolmogorov_smirnov(x, c[1]))
+
+    def test_processes(self):
+        np.random.seed(5)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(50, 20, 2)
+        c[7, :, 1] = np.nan
+        ex = dd.spatial_analog(x, c, 'kldiv', blocksize=4)
+        out = dd.spatial_analog(x, c, 'kldiv', blocksize=4, processes=2)
+        np.testing.assert_array_equal(out, ex)
+
+    def test_processes_in_daemon(self):
+        """Daemonic processes cannot have children and fall back to a serial evaluation."""
+        from multiprocessing import Pool
+
+        np.random.seed(5)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(50, 20, 2)
+        with Pool(1) as pool:
+            out = pool.apply(dd.spatial_analog, (x, c, 'seuclidean'), {'blocksize': 4, 'processes': 2})
+        np.testing.assert_array_equal(out, dd.spatial_analog(x, c, 'seuclidean', blocksize=4))
+
+    def test_many_metrics(self):
+        np.random.seed(8)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(20, 25, 2)
+        c[1, 5] = np.nan
+        dists = ['kldiv', 'nearest_neighbor', 'seuclidean']
+
+        out = dd.spatial_analog(x, c, dists, blocksize=6)
+        assert set(out.keys()) == set(dists)
+        for dist in dists:
+            np.testing.assert_array_equal(out[dist], dd.spatial_analog(x, c, dist, blocksize=6))
+
+        out = dd.spatial_analog(x, c, dists, blocksize=6, processes=2)
+        aaeq(out['kldiv'], dd.spatial_analog(x, c, 'kldiv'))
+
+
+class TestTarget:
+    @pytest.mark.parametrize('dist', dd.__all__)
+    def test_same_as_array(self, dist):
+        np.random.seed(4)
+        x = np.random.randn(40, 2)
+        t = dd.Target(x)
+        for i in range(2):
+            y = np.random.randn(30, 2) + i
+            aaeq(getattr(dd, dist)(t, y), getattr(dd, dist)(x, y))
+
+    @pytest.mark.parametrize('dist', ['nearest_neighbor', 'friedman_rafsky', 'kldiv', 'skezely_rizzo'])
+    def test_buffer_modified_in_place(self, dist):
+        np.random.seed(4)
+        x = np.random.randn(40, 2)
+        t = dd.Target(x)
+        y = np.random.randn(30, 2)
+        getattr(dd, dist)(t, y)
+
+        y += 10
+        aaeq(getattr(dd, dist)(t, y), getattr(dd, dist)(x, y))
+
+    def test_cell(self):
+        np.random.seed(4)
+        t = dd.Target(np.random.randn(40, 2))
+        y = np.random.randn(30, 2)
+        with t.cell(y):
+            dd.nearest_neighbor(t, y)
+            assert 'pooled_tree' in t.candidate(y)
+            assert t.candidate(y.copy()) == {}
+        assert t.candidate(y) == {}
+
+
+class TestScreen:
+    def test_fraction(self):
+        np.random.seed(6)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(40, 20, 2) + np.linspace(0, 4, 40)[:, np.newaxis, np.newaxis]
+        c[0] = np.nan
+
+        keep = dd.screen(x, c, fraction=.25)
+        assert keep.sum() == 10
+        assert not keep[0]
+        np.testing.assert_array_equal(np.flatnonzero(keep), np.arange(1, 11))
+
+        out = dd.spatial_analog(x, c, 'kldiv', mask=keep)
+        assert np.isnan(out[~keep]).all()
+        aaeq(out[keep], dd.spatial_analog(x, c, 'kldiv')[keep])
+
+    def test_threshold(self):
+        np.random.seed(6)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(40, 20, 2)
+        se = dd.spatial_analog(x, c)
+        np.testing.assert_array_equal(dd.screen(x, c, threshold=.3), se <= .3)
+
+
+def test_best_analogs():
+    np.random.seed(7)
+    x = np.random.randn(30, 2)
+    c = np.random.randn(50, 20, 2) + np.random.rand(50, 1, 2) * 2
+    c[3] = np.nan
+
+    ex = dd.spatial_analog(x, c, 'kldiv')
+    ind, val = dd.best_analogs(x, c, 5, 'kldiv', blocksize=7)
+    np.testing.assert_array_equal(ind, np.argsort(np.where(np.isnan(ex), np.inf, ex))[:5])
+    aaeq(val, ex[ind])
+
+    pind, pval = dd.best_analogs(x, c, 5, 'kldiv', blocksize=7, processes=2)
+    np.testing.assert_array_equal(pind, ind)
+    aaeq(pval, val)
+
+
+def test_sliding_analog():
+    np.random.seed(4)
+    x = np.random.randn(30, 2)
+    y = np.random.randn(6, 40, 2) + np.linspace(0, 1, 6)[:, np.newaxis, np.newaxis]
+    y[1, 3:9, 0] = np.nan
+    y[4, :35] = np.nan
+
+    windows = [(i, i + 20) for i in range(0, 21, 5)]
+    dists = ['seuclidean', 'mahalanobis', 'nearest_neighbor']
+    out = dd.sliding_analog(x, y, windows, dists)
+    for i, (start, stop) in enumerate(windows):
+        expected = dd.spatial_analog(x, y[:, start:stop], dists)
+        for name in dists:
+            np.testing.assert_allclose(out[name][i], expected[name])
+
+    se = dd.sliding_analog(x, y, windows)
+    np.testing.assert_allclose(se, out['seuclidean'])
+
+    pout = dd.sliding_analog(x, y, windows, dists, blocksize=2, processes=2)
+    for name in dists:
+        np.testing.assert_allclose(pout[name], out[name])
+
+
+def test_candidate_pool():
+    np.random.seed(5)
+    targets = np.random.randn(3, 30, 2)
+    c = np.random.randn(10, 25, 2) + np.linspace(0, 2, 10)[:, np.newaxis, np.newaxis]
+    c[4, :3] = np.nan
+    mask = np.arange(10) != 7
+
+    for processes in [1, 2]:
+        with dd.CandidatePool(c, processes) as pool:
+            for x in targets:
+                out = pool.spatial_analog(x, ['kldiv', 'seuclidean'], blocksize=3, mask=mask)
+                ex = dd.spatial_analog(x, c, ['kldiv', 'seuclidean'], mask=mask)
+                for name in ex:
+                    np.testing.assert_allclose(out[name], ex[name])
+
+                aaeq(pool.spatial_analog(x, 'kldiv', blocksize=3, window=(5, 20)),
+                     dd.spatial_analog(x, c[:, 5:20], 'kldiv'))
+
+
+class TestSignificance:
+    @pytest.mark.parametrize('dist', dd.__all__)
+    def test_permutation_test(self, dist):
+        np.random.seed(8)
+        x = np.random.randn(30, 2)
+
+        y = np.random.randn(30, 2) + 3
+        stat, p = dd.permutation_test(x, y, dist, 99, seed=1)
+        aaeq(stat, getattr(dd, dist)(x, y))
+        aaeq(p, .01)
+
+        _, p = dd.permutation_test(x, np.random.randn(30, 2), dist, 99, seed=1)
+        assert p > .01
+
+    def test_energy(self):
+        """The permutations computed from the pooled distances match the sums over each split."""
+        from scipy.spatial.distance import cdist, pdist
+        np.random.seed(6)
+        x = np.random.randn(20, 2)
+        y = np.random.randn(25, 2) + .5
+        z = np.vstack([x, y]) / np.sqrt(x.std(0, ddof=1) * y.std(0, ddof=1))
+        labels = np.random.rand(4, 45).argsort(1) < 20
+
+        sr = dd._perm_skezely_rizzo(dd.Target(x), y, labels)
+        za = dd._perm_zech_aslan(dd.Target(x), y, labels)
+        for i, lab in enumerate(labels):
+            a, b = z[lab], z[~lab]
+            ex = 2 * cdist(a, b).mean() - pdist(a).sum() * 2 / 400. - pdist(b).sum() * 2 / 625.
+            aaeq(sr[i], ex * 500 / 45.)
+            ex = np.log(cdist(a, b)).mean() - np.log(pdist(a)).sum() / 380. - np.log(pdist(b)).sum() / 600.
+            aaeq(za[i], ex)
+
+    def test_significance(self):
+        np.random.seed(7)
+        x = np.random.randn(30, 2)
+        c = np.random.randn(9, 30, 2) + np.linspace(0, 2, 9)[:, np.newaxis, np.newaxis]
+        c[2, :28] = np.nan
+
+        p = dd.significance(x, c, 'friedman_rafsky', 49, seed=3, blocksize=2)
+        assert np.isnan(p[2])
+        assert p[-1] < p[0]
+        aaeq(p, dd.significance(x, c, 'friedman_rafsky', 49, seed=3, blocksize=2, processes=2))
+
+
+class TestPrecision:
+    @pytest.mark.parametrize('dist', dd.__all__)
+    def test_float32(self, dist):
+        """The single precision path deviates from the double precision one by rounding errors only."""
+        np.random.seed(9)
+        x = np.random.randn(40, 2)
+        c = np.random.randn(10, 50, 2) + np.linspace(0, 1, 10)[:, np.newaxis, np.newaxis]
+        c[3, :4, 1] = np.nan
+
+        ex = dd.spatial_analog(x, c, dist)
+        out = dd.spatial_analog(x, c.astype(np.float32), dist, dtype=np.float32)
+        np.testing.assert_allclose(out, ex, rtol=1e-4, atol=1e-5)
+
+    def test_dtype(self):
+        np.random.seed(10)
+        t = dd.Target(np.random.randn(10, 2), np.float32)
+        assert t.x.dtype == np.float32
+        assert t.var.dtype == np.float64
+
+        _, y = dd.reshape_sample(t, np.random.randn(12, 2))
+        assert y.dtype == np.float32
+        assert dd.standardize(t, y)[1].dtype == np.float32
+
+
+class TestUnivariate:
+    def test_batch(self):
+        """The univariate kernels match the multivariate algorithms."""
+        np.random.seed(11)
+        x = np.random.randn(30)
+        c = np.random.randn(20, 40) + np.linspace(0, 2, 20)[:, np.newaxis]
+        c[2, :5] = np.nan
+
+        # Duplicating the dimension preserves the neighbours and the minimum spanning tree.
+        x2 = np.stack([x, x], -1)
+        c2 = np.stack([c, c], -1)
+        for name in ['nearest_neighbor', 'friedman_rafsky']:
+            aaeq(dd.spatial_analog(x, c, name), dd.spatial_analog(x2, c2, name))
+
+        # Distances are scaled by sqrt(2) and the dimension doubles the first term.
+        kl = np.log((~np.isnan(c)).sum(1) / 29.)
+        aaeq(dd.spatial_analog(x, c, 'kldiv') - kl, (dd.spatial_analog(x2, c2, 'kldiv') - kl) / 2)
+
+        for name in ['kolmogorov_smirnov', 'skezely_rizzo']:
+            aaeq(dd.spatial_analog(x, c, name), [getattr(dd, name)(x, ci[~np.isnan(ci)]) for ci in c])
+
+    def test_ties(self):
+        np.random.seed(12)
+        x = np.round(np.random.randn(30) * 2)
+        c = np.round(np.random.randn(10, 40) * 2)
+        for name in ['kolmogorov_smirnov', 'friedman_rafsky']:
+            aaeq(dd.spatial_analog(x, c, name), [getattr(dd, name)(x, ci) for ci in c])
+
+    def test_ties_expected(self):
+        """Tied values are credited with the expected fraction of same-sample neighbours and edges."""
+        x, y = [1., 1., 2.], [1., 3.]
+        aaeq(dd.nearest_neighbor(x, y), (.5 + .5 + 0 + .5 + 0) / 5)
+        aaeq(dd.friedman_rafsky(x, y), 1 - (1 + 4. / 3 + 1. / 3 + 1) / 5)
+
+    def test_ties_same_distribution(self):
+        """With integer samples from the same distribution, the order of tied values does not bias the metrics,
+        which agree with the KD-tree and minimum spanning tree algorithms on average."""
+        from scipy.spatial import cKDTree
+
+        nn, fr, nn_tree, fr_tree = [], [], [], []
+        for seed in range(100):
+            rng = np.random.RandomState(seed)
+            x = rng.poisson(20, 30).astype(float)
+            y = rng.poisson(20, 30).astype(float)
+            nn.append(dd.nearest_neighbor(x, y))
+            fr.append(dd.friedman_rafsky(x, y))
+
+            z = np.concatenate([x, y])[:, np.newaxis]
+            _, ind = cKDTree(z).query(z, k=2)
+            nn_tree.append((~np.logical_xor(*(ind < 30).T)).mean())
+            edges = dd._prim_edges(z)
+            fr_tree.append(1 - (1. + np.logical_xor(*(edges < 30).T).sum()) / 60)
+
+        assert abs(np.mean(nn) - .5) < .03
+        assert abs(np.mean(fr) - .5) < .03
+        assert abs(np.mean(nn) - np.mean(nn_tree)) < .03
+        assert abs(np.mean(fr) - np.mean(fr_tree)) < .03
+
+    @pytest.mark.parametrize('dist', ['nearest_neighbor', 'friedman_rafsky'])
+    def test_ties_calibration(self, dist):
+        """With tied samples from the same distribution, the permutation null is computed with the same tie-aware
+        kernel as the statistic, so that p-values below alpha occur at a rate close to alpha."""
+        p = []
+        for seed in range(1000):
+            rng = np.random.RandomState(seed)
+            x = rng.randint(0, 4, 30).astype(float)
+            y = rng.randint(0, 4, 40).astype(float)
+            p.append(dd.permutation_test(x, y, dist, 99, seed=seed)[1])
+
+        for alpha in [.05, .1]:
+            assert abs(np.mean(np.array(p) <= alpha) - alpha) < .03
@@ -0,0 +1,37 @@
+import numpy as np
+from numpy.testing import assert_array_almost_equal as aaeq
+
+from flyingpigeon import dissimilarity as dd
+from flyingpigeon import null_tables as nt
+
+
+def test_generate(tmpdir):
+    path = nt.generate(str(tmpdir.join('null.npz')), sizes=[10, 30], dims=[2], samples=200)
+    table = nt.NullTable(path)
+    assert table.values.shape == (3, 2, 2, 1, len(nt.PROBS))
+
+    # Quantiles at the table sizes are the tabulated ones.
+    aaeq(table.quantiles('friedman_rafsky', 30, [10], 2)[0], table.values[1, 1, 0, 0])
+
+    np.random.seed(2)
+    x = np.random.randn(30, 2)
+    near = dd.friedman_rafsky(x, np.random.randn(20, 2))
+    far = dd.friedman_rafsky(x, np.random.randn(20, 2) + 3)
+    p = table.pvalue('friedman_rafsky', [near, far, np.nan], 30, [20, 20, 20], 2)
+    assert p[0] > .05
+    aaeq(p[1], 1 - nt.PROBS[-1])
+    assert np.isnan(p[2])
+
+
+def test_packaged_table():
+    table = nt.get_table()
+    assert table.metrics == nt.METRICS
+    q = table.quantiles('nearest_neighbor', 30, [30, 40], 2)
+    assert np.all(np.diff(q, axis=1) >= -1e-12)
+
+
+def test_covers():
+    table = nt.get_table()
+    assert table.covers('friedman_rafsky', 4)
+    assert not table.covers('friedman_rafsky', 5)
+    assert not table.covers('seuclidean', 2)
@@ -0,0 +1,139 @@
+import numpy as np
+from numpy.testing import assert_almost_equal as aaeq
+from netCDF4 import Dataset
+from shapely.geometry import Polygon, box
+
+from flyingpigeon import region_masks as rm
+
+
+def test_cell_weights_rectilinear():
+    lon = np.arange(10) + .5
+    lat = np.arange(8) + .5
+    shape, index, weight = rm.cell_weights(lon, lat, box(2, 2, 4.5, 3))
+
+    assert shape == (8, 10)
+    aaeq(index, [22, 23, 24])
+    aaeq(weight, [1, 1, .5])
+
+
+def test_cell_weights_wrap():
+    # Grid in the 0 to 360 domain, region across the Greenwich meridian.
+    lon = np.arange(360) + .5
+    lat = np.array([-.5, .5])
+    shape, index, weight = rm.cell_weights(lon, lat, box(-2, 0, 2, 1))
+
+    aaeq(index, [360, 361, 718, 719])
+    aaeq(weight, 1)
+
+
+def test_crosses_seam():
+    lon = np.arange(360) + .5
+    lat = np.array([-.5, .5])
+    across = rm.RegionMask(*rm.cell_weights(lon, lat, box(-2, 0, 2, 1)))
+    assert rm.crosses_seam(lon, across)
+    assert across.slices[1] == slice(0, 360)
+
+    assert not rm.crosses_seam(lon, rm.RegionMask(*rm.cell_weights(lon, lat, box(2, 0, 6, 1))))
+    assert not rm.crosses_seam(lon, rm.RegionMask(*rm.cell_weights(lon, lat, box(-180, 0, 180, 1))))
+
+    # The same region on a -180 to 180 grid, or on a regional grid.
+    assert not rm.crosses_seam(lon - 180, rm.RegionMask(*rm.cell_weights(lon - 180, lat, box(-2, 0, 2, 1))))
+    assert not rm.crosses_seam(lon[:10], rm.RegionMask((2, 10), [0, 9], [1, 1]))
+
+
+def test_needs_wrapping():
+    lon = np.arange(360) + .5
+    assert rm.needs_wrapping(lon, 'wrap')
+    assert not rm.needs_wrapping(lon, 'unwrap')
+    assert not rm.needs_wrapping(lon - 180, 'wrap')
+    assert rm.needs_wrapping(lon - 180, 'unwrap')
+    assert not rm.needs_wrapping(lon, None)
+
+
+def test_cell_weights_curvilinear():
+    lon, lat = np.meshgrid(np.arange(10) + .5, np.arange(8) + .5)
+    shape, index, weight = rm.cell_weights(lon, lat, box(2, 2, 4.6, 3))
+
+    assert shape == (8, 10)
+    aaeq(index, [22, 23, 24])
+    aaeq(weight, 1)
+
+
+def test_save_load(tmpdir):
+    mask = rm.RegionMask((8, 10), [22, 23, 24, 35], [1, 1, .5, .25])
+    path = str(tmpdir.join('masks', 'mask.npz'))
+    mask.save(path)
+
+    out = rm.RegionMask.load(path)
+    assert out.shape == (8, 10)
+    aaeq(out.weights, mask.weights)
+    assert out.slices == (slice(2, 4), slice(2, 6))
+    assert out.mask.sum() == 4
+
+
+def write_tas(src):
+    """Write a (3, 8, 10) tas variable on a 1 degree grid."""
+    with Dataset(src, 'w') as ds:
+        ds.title = 'test'
+        ds.createDimension('time', None)
+        ds.createDimension('lat', 8)
+        ds.createDimension('lon', 10)
+        ds.createVariable('time', 'f8', ('time',))[:] = np.arange(3)
+        lat = ds.createVariable('lat', 'f8', ('lat',))
+        lat.units = 'degrees_north'
+        lat[:] = np.arange(8) + .5
+        lon = ds.createVariable('lon', 'f8', ('lon',))
+        lon.units = 'degrees_east'
+        lon[:] = np.arange(10) + .5
+        tas = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'))
+        tas.units = 'K'
+        tas[:] = np.arange(240).reshape(3, 8, 10)
+
+
+def test_apply_mask(tmpdir):
+    src = str(tmpdir.join('tas.nc'))
+    write_tas(src)
+
+    with Dataset(src) as ds:
+        dims, lon, lat = rm.grid_coordinates(ds, 'tas')
+    assert dims == ('lat', 'lon')
+
+    mask = rm.RegionMask(*rm.cell_weights(lon, lat, Polygon([(2, 2), (5, 2), (2, 4)])))
+    out = rm.apply_mask(src, 'tas', mask, str(tmpdir.join('out.nc')), chunk=2)
+
+    with Dataset(out) as ds:
+        assert ds.title == 'test'
+        assert ds.variables['tas'].units == 'K'
+        aaeq(ds.variables['lat'][:], [2.5, 3.5])
+        aaeq(ds.variables['lon'][:], [2.5, 3.5, 4.5])
+        aaeq(ds.variables['time'][:], np.arange(3))
+
+        tas = ds.variables['tas'][:]
+        assert tas.shape == (3, 2, 3)
+        aaeq(tas[1, 0], [102, 103, 104])
+        assert tas.mask.sum() == 3
+        assert tas.mask[:, 1, 2].all()
+
+
+def test_apply_masks(tmpdir):
+    src = str(tmpdir.join('tas.nc'))
+    write_tas(src)
+    with Dataset(src) as ds:
+        dims, lon, lat = rm.grid_coordinates(ds, 'tas')
+
+    geoms = [box(1, 1, 3, 2), Polygon([(2, 2), (5, 2), (2, 4)]), box(7, 6, 9, 7)]
+    masks = [rm.RegionMask(*rm.cell_weights(lon, lat, g)) for g in geoms]
+    paths = [str(tmpdir.join('out{}.nc'.format(i))) for i in range(3)]
+    out = rm.apply_masks(src, 'tas', masks, paths, chunk=2)
+    assert out == paths
+
+    # Same result as clipping each region separately.
+    for i, mask in enumerate(masks):
+        ex = rm.apply_mask(src, 'tas', mask, str(tmpdir.join('ex{}.nc'.format(i))))
+        with Dataset(out[i]) as a, Dataset(ex) as b:
+            for name in ['lat', 'lon', 'tas']:
+                aaeq(a.variables[name][:], b.variables[name][:])
+                assert (np.ma.getmaskarray(a.variables[name][:]) == np.ma.getmaskarray(b.variables[name][:])).all()
+
+    with Dataset(out[2]) as ds:
+        aaeq(ds.variables['tas'][2], [[227, 228]])
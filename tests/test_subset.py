@@ -1,3 +1,5 @@
+import pytest
+
 from flyingpigeon.subset_base import get_feature
 
 def test_get_feature():
@@ -9,3 +11,92 @@ def test_get_feature():
     features = [feature_pat.format(i) for i in range(67088, 67090)]
     get_feature(url, typename, features)
 
+
+def test_region_index():
+    from flyingpigeon import subset
+
+    index = subset.region_index('countries')
+    assert 'DEU' in index
+    assert 'Africa' not in index
+    assert subset.region_index('countries') is index
+
+    assert subset.get_geom('DEU') == 'countries'
+    assert subset.get_geom('Africa') == 'continents'
+    assert subset.get_geom('XYZ') is None
+
+    assert subset.get_ugid('DEU', 'countries') == index.ugids['DEU']
+    assert subset.get_ugid(['DEU', 'FRA'], 'countries') == index.ugids['DEU'] + index.ugids['FRA']
+
+    minx, miny, maxx, maxy = index.bbox(['DEU'])
+    assert 5 < minx < maxx < 16
+    assert 47 < miny < maxy < 56
+
+    assert 'Africa' in subset.continents()
+
+
+def test_region_index_cache():
+    from flyingpigeon import subset
+
+    index = subset.region_index('continents')
+    copy = subset.RegionIndex.from_dict(index.to_dict())
+    assert copy.keys() == index.keys()
+    assert copy.ugids == index.ugids
+    assert copy.bboxes == index.bboxes
+
+    # Loading again reads the cache written by the first load.
+    assert subset._load_region_index('continents').keys() == index.keys()
+
+
+def test_pool_map():
+    from flyingpigeon import subset
+
+    tasks = [-3, 2, -1, 5, -4]
+    assert subset._pool_map(abs, tasks, 1) == [3, 2, 1, 5, 4]
+    assert subset._pool_map(abs, tasks, 3) == [3, 2, 1, 5, 4]
+
+
+def test_clip_task_failure(tmpdir):
+    from flyingpigeon import subset
+
+    args = ('tas', str(tmpdir.join('missing.nc')), None, 0, '_DEU', 'countries', [1], False, {})
+    assert subset._clip_task(args) == (False, None)
+
+
+@pytest.mark.parametrize('spatial_wrapping', ['wrap', None])
+def test_mask_clipping_seam(tmpdir, monkeypatch, spatial_wrapping):
+    """A country across the Greenwich meridian on a 0 to 360 grid is clipped as ocgis does, with or without
+    wrapping."""
+    import numpy as np
+    from netCDF4 import Dataset
+    from flyingpigeon import subset
+
+    src = str(tmpdir.join('tas_day_global.nc'))
+    with Dataset(src, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('lat', 90)
+        ds.createDimension('lon', 180)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 2000-01-01'
+        time.calendar = 'standard'
+        time[:] = np.arange(2)
+        lat = ds.createVariable('lat', 'f8', ('lat',))
+        lat.units = 'degrees_north'
+        lat.standard_name = 'latitude'
+        lat[:] = np.arange(-89, 90, 2.)
+        lon = ds.createVariable('lon', 'f8', ('lon',))
+        lon.units = 'degrees_east'
+        lon.standard_name = 'longitude'
+        lon[:] = np.arange(1, 360, 2.)
+        tas = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'))
+        tas.units = 'K'
+        tas[:] = np.arange(2 * 90 * 180).reshape(2, 90, 180)
+
+    out = {}
+    for masks in [False, True]:
+        monkeypatch.setattr(subset, 'region_masks', lambda: masks)
+        out[masks], = subset.clipping(resource=src, polygons='FRA', prefix='fra_{}'.format(masks),
+                                      spatial_wrapping=spatial_wrapping, dir_output=str(tmpdir))
+
+    with Dataset(out[False]) as a, Dataset(out[True]) as b:
+        for name in ['lon', 'lat', 'tas']:
+            np.testing.assert_array_equal(a.variables[name][:], b.variables[name][:])
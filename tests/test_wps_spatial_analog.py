@@ -19,7 +19,7 @@ from ocgis.test.base import TestBase
 
 from flyingpigeon.utils import local_path
 from flyingpigeon.processes import SpatialAnalogProcess, PlotSpatialAnalogProcess
-from .common import TESTDATA, client_for, CFG_FILE
+from .common import TESTDATA, client_for, CFG_FILE, get_output
 
 
 @pytest.mark.skip("race condition")
@@ -119,7 +119,8 @@ class TestDissimilarity(TestBase):
                                                                         p4]]
         candidate = ocgis.MultiRequestDataset(can)
 
-        fig, axes = plt.subplots(2, 3)
+        nrows = int(np.ceil(len(dissimilarity.__all__) / 4.))
+        fig, axes = plt.subplots(nrows, 4, squeeze=False)
         for i, dist in enumerate(dissimilarity.__all__):
 
             calc = [{'func': 'dissimilarity',
@@ -226,6 +227,42 @@ def test_dissimilarity_op():
     np.testing.assert_array_equal(val > 0, True)
 
 
+def test_dissimilarity_op_null_table_dimension():
+    """P-values are NaN, not an error, for dimensions outside the null table."""
+    indices = ['meantemp', 'totalpr']
+    time_range = [dt.datetime(1970, 1, 1), dt.datetime(2000, 1, 1)]
+    trd = ocgis.RequestDataset(local_path(TESTDATA['indicators_medium_nc']), variable=indices, time_range=time_range)
+    target = ocgis.OcgOperations(dataset=trd, geom=Point(-72, 46), search_radius_mult=1.75,
+                                 select_nearest=True).execute().get_element()
+    candidate = ocgis.RequestDataset(local_path(TESTDATA['indicators_small_nc']), variable=indices,
+                                     time_range=time_range)
+
+    # Repeat the indices to get five dimensions.
+    ops = ocgis.OcgOperations(
+        calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
+               'kwds': {'dist': 'nearest_neighbor', 'target': target, 'candidate': indices * 2 + indices[:1],
+                        'null_table': True}}],
+        dataset=candidate
+    )
+    out = ops.execute().get_element()
+    assert np.isfinite(out['dissimilarity'].get_value()).all()
+    assert np.isnan(out['pvalue'].get_value()).all()
+
+
+def test_nearest_cells_wrap():
+    """Locations west of Greenwich are matched on a 0 to 360 grid."""
+    from flyingpigeon.ocgisDissimilarity import get_coordinates, nearest_cells
+
+    lon = Variable(value=np.arange(0., 360., 2.), name='lon', dimensions='lon')
+    lat = Variable(value=np.arange(-89., 90., 2.), name='lat', dimensions='lat')
+    field = Field(grid=Grid(lon, lat))
+    x, y = get_coordinates(field)
+
+    i = nearest_cells(field, [-72, 288, -0.6, 359.5], [45.5, 45.5, .5, .5])
+    np.testing.assert_array_equal(x[i], [288, 288, 0, 0])
+    np.testing.assert_array_equal(y[i], [45, 45, 1, 1])
+
+
 def test_wps_spatial_analog_process_small_sample():
     client = client_for(Service(processes=[SpatialAnalogProcess()]))
     datainputs = "candidate=files@xlink:href={c};" \
@@ -254,6 +291,99 @@ def test_wps_spatial_analog_process_small_sample():
     assert_response_success(resp)
 
 
+def test_wps_spatial_analog_process_top_k():
+    client = client_for(Service(processes=[SpatialAnalogProcess()]))
+    datainputs = "candidate=files@xlink:href={c};" \
+                 "target=files@xlink:href={t};" \
+                 "location={lon},{lat};" \
+                 "indices={i1};indices={i2};" \
+                 "dist={dist};" \
+                 "top_k={k};" \
+                 "dateStartCandidate={start};" \
+                 "dateEndCandidate={end};" \
+                 "dateStartTarget={start};" \
+                 "dateEndTarget={end}"\
+        .format(c=TESTDATA['indicators_small_nc'],
+                t=TESTDATA['indicators_medium_nc'],
+                lon=-72,
+                lat=46,
+                i1='meantemp',
+                i2='totalpr',
+                dist='seuclidean',
+                k=2,
+                start=dt.datetime(1970, 1, 1),
+                end=dt.datetime(1990, 1, 1))
+
+    resp = client.get(
+        service='wps', request='execute', version='1.0.0',
+        identifier='spatial_analog',
+        datainputs=datainputs)
+    assert_response_success(resp)
+    assert 'table' in get_output(resp.xml)
+
+
+def test_wps_spatial_analog_process_multi_target():
+    client = client_for(Service(processes=[SpatialAnalogProcess()]))
+    datainputs = "candidate=files@xlink:href={c};" \
+                 "target=files@xlink:href={t};" \
+                 "location={lon},{lat};" \
+                 "location={lon2},{lat};" \
+                 "indices={i1};indices={i2};" \
+                 "dist={dist};" \
+                 "dateStartCandidate={start};" \
+                 "dateEndCandidate={end};" \
+                 "dateStartTarget={start};" \
+                 "dateEndTarget={end}"\
+        .format(c=TESTDATA['indicators_small_nc'],
+                t=TESTDATA['indicators_medium_nc'],
+                lon=-72,
+                lon2=-70,
+                lat=46,
+                i1='meantemp',
+                i2='totalpr',
+                dist='seuclidean',
+                start=dt.datetime(1970, 1, 1),
+                end=dt.datetime(1990, 1, 1))
+
+    resp = client.get(
+        service='wps', request='execute', version='1.0.0',
+        identifier='spatial_analog',
+        datainputs=datainputs)
+    assert_response_success(resp)
+
+
+def test_wps_spatial_analog_process_window():
+    client = client_for(Service(processes=[SpatialAnalogProcess()]))
+    datainputs = "candidate=files@xlink:href={c};" \
+                 "target=files@xlink:href={t};" \
+                 "location={lon},{lat};" \
+                 "indices={i1};indices={i2};" \
+                 "dist={dist};" \
+                 "window={window};" \
+                 "step={step};" \
+                 "dateStartCandidate={start};" \
+                 "dateEndCandidate={end};" \
+                 "dateStartTarget={start};" \
+                 "dateEndTarget={end}"\
+        .format(c=TESTDATA['indicators_small_nc'],
+                t=TESTDATA['indicators_medium_nc'],
+                lon=-72,
+                lat=46,
+                i1='meantemp',
+                i2='totalpr',
+                dist='seuclidean',
+                window=10,
+                step=5,
+                start=dt.datetime(1970, 1, 1),
+                end=dt.datetime(1990, 1, 1))
+
+    resp = client.get(
+        service='wps', request='execute', version='1.0.0',
+        identifier='spatial_analog',
+        datainputs=datainputs)
+    assert_response_success(resp)
+
+
 def test_wps_plot_spatial_analog():
     client = client_for(
         Service(processes=[PlotSpatialAnalogProcess()], cfgfiles=CFG_FILE))
@@ -32,3 +32,16 @@ def test_wps_subset_countries():
     # ins = os.path.getsize(TESTDATA['cmip5_tasmax_2006_nc'][6:])
     # outs = os.path.getsize(out['ncout'][6:])
     # assert (outs < ins)
+
+
+def test_region_values_lazy():
+    """The country list is only loaded when the input is described or validated."""
+    from flyingpigeon import subset
+
+    subset._REGION_INDICES_.pop('countries', None)
+    process = SubsetcountryProcess()
+    assert 'countries' not in subset._REGION_INDICES_
+
+    region = process.inputs[0]
+    assert 'DEU' in [value.value for value in region.allowed_values]
+    assert region.max_occurs == len(subset.countries())